@@ -0,0 +1,278 @@
+import asyncio
+import json
+import signal
+import threading
+import time
+from fanout import AsyncClientOutbox, BACKPRESSURE
+from logs import get_logger
+from heartbeat import set_keepalive
+from filetransfer import validate_manifest
+from protocol import (FrameDecoder, MSG_HELLO, MSG_FILE, MSG_FILE_CHUNK, MSG_FILE_OFFER, MSG_FILE_REQUEST,
+                      MSG_TEXT)
+from server import ChatServer, MAX_CHUNKS_PER_REQUEST
+
+try:
+    import resource  # Нет на Windows
+except ImportError:
+    resource = None
+
+log = get_logger('async_server')
+
+FILE_FRAMES = (MSG_FILE_CHUNK, MSG_FILE_OFFER, MSG_FILE_REQUEST)  # Обработчики читают и пишут диск
+
+
+class AsyncChatServer(ChatServer):
+    """Сервер чата на asyncio: все соединения обслуживаются одним циклом событий"""
+
+    def __init__(self, *args, stream_limit=64 * 1024, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stream_limit = stream_limit  # Предел буфера StreamReader на клиента
+        self.server = None
+        self.handshake_slots = None  # asyncio.Semaphore создается внутри цикла событий
+        self.loop = None
+        self.reaper_task = None
+        self.presence_task = None
+        self.congested_outboxes = set()  # Переполненные очереди при BACKPRESSURE; ведут их сами очереди
+
+    def raise_file_limit(self):
+        """Поднимает мягкий лимит открытых файлов до жесткого"""
+        if resource is None:
+            return
+        try:
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if hard == resource.RLIM_INFINITY or soft < hard:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+                log.info("Лимит открытых файлов: %s -> %s", soft, hard)
+        except (ValueError, OSError) as e:
+            log.warning("Не удалось поднять лимит открытых файлов: %s", e)
+
+    async def verify_client_key(self, reader, decoder):
+        """Проверяет, что клиент использует правильный ключ; как в ChatServer, вместе с кадрами после HELLO"""
+        try:
+            frames = []
+            while not frames:
+                data = await reader.read(1024)
+                if not data:
+                    log.debug("Клиент закрыл соединение при проверке ключа")
+                    return False, None, None, []
+                frames = decoder.feed(data)
+
+            msg_type, payload = frames[0]
+            if msg_type != MSG_HELLO:
+                log.warning("Ожидался кадр рукопожатия, получен тип %s", msg_type)
+                return False, None, None, []
+
+            try:
+                nickname, params = self.parse_hello(payload)
+                log.debug("Успешная проверка ключа, никнейм: %s", nickname)
+                return True, nickname, params, frames[1:]
+            except Exception as e:
+                log.warning("Ошибка проверки ключа: %s", e)
+                return False, None, None, []
+
+        except Exception as e:
+            log.warning("Ошибка при получении данных для проверки ключа: %s", e)
+            return False, None, None, []
+
+    async def run_handshake(self, reader, decoder):
+        """Проверяет ключ, не превышая лимит одновременных рукопожатий"""
+        async with self.handshake_slots:
+            return await self.verify_client_key(reader, decoder)
+
+    async def handle_connection(self, reader, writer):
+        """Проводит рукопожатие и обрабатывает сообщения клиента"""
+        address = writer.get_extra_info('peername')
+        log.debug("Новое подключение с %s", address)
+        set_keepalive(writer.get_extra_info('socket'), *self.keepalive)
+
+        decoder = FrameDecoder()
+        started = time.perf_counter()
+        try:
+            # Срок считается вместе с ожиданием свободного слота рукопожатия
+            is_valid, nickname, params, pending = await asyncio.wait_for(
+                self.run_handshake(reader, decoder), self.handshake_timeout
+            )
+        except asyncio.TimeoutError:
+            log.info("Клиент %s не завершил рукопожатие за %s с", address, self.handshake_timeout)
+            is_valid, nickname, pending = False, None, []
+        self.handshake_seconds.observe(time.perf_counter() - started)
+        if not (is_valid and nickname):
+            self.handshake_failures.inc()
+            log.warning("Клиент %s использует неверный ключ", address)
+            writer.close()
+            return
+
+        self.admit_client(writer, nickname, params)
+
+        try:
+            await self.handle_client(reader, writer, decoder, pending)
+        finally:
+            self.remove_client(writer)
+
+    async def handle_client(self, reader, writer, decoder, pending=()):
+        """Обрабатывает сообщения от клиента; pending - кадры, пришедшие вместе с рукопожатием"""
+        frames = list(pending)
+        try:
+            while True:
+                if not frames:
+                    data = await reader.read(self.recv_size)
+                    if not data:
+                        log.debug("Клиент закрыл соединение")
+                        break
+                    self.received_bytes.inc(len(data))
+                    if self.heartbeat is not None:
+                        self.heartbeat.touch(writer)
+
+                try:
+                    if not frames:
+                        frames = decoder.feed(data)
+                    # Предел трафика - до расшифровки; пока клиент ждет, его сокет не читается
+                    delay = self.check_flood(writer, frames)
+                    if delay:
+                        await asyncio.sleep(delay)
+                    # Шифр читается заново: после смены ключа он другой
+                    messages = self.decrypt_frames(self.client_ciphers[writer], frames)
+                    for (msg_type, _), decrypted_message in zip(frames, messages):
+                        if msg_type in FILE_FRAMES:
+                            # Чтение клиента ждет диска, остальные сессии - нет
+                            await self.process_file_frame(writer, msg_type, decrypted_message)
+                        elif msg_type == MSG_FILE or (msg_type == MSG_TEXT
+                                                      and bytes(decrypted_message[:5]) == b"FILE:"):
+                            await self.process_legacy_file(writer, msg_type, decrypted_message)
+                        else:
+                            self.process_message(writer, msg_type, decrypted_message)
+                    frames = []
+                except Exception as e:
+                    log.warning("Ошибка обработки сообщения: %s", e)
+                    break
+                await self.wait_for_backpressure(writer)
+
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            log.warning("Ошибка соединения с клиентом: %s", e)
+
+    async def process_file_frame(self, writer, msg_type, data):
+        """Обработчики файлов ChatServer, но работа с диском - в пуле потоков, а не в цикле событий"""
+        store = self.file_store
+        if msg_type == MSG_FILE_REQUEST:
+            request = json.loads(data)
+            manifest, chunks = await self.run_blocking(store.read_request, request['file_id'],
+                                                       request.get('chunks'), MAX_CHUNKS_PER_REQUEST)
+            self.send_file_reply(writer, request['file_id'], manifest, chunks)
+            return
+        if msg_type == MSG_FILE_OFFER:
+            manifest, missing = await self.run_blocking(store.prepare_upload, validate_manifest(json.loads(data)))
+            if missing:
+                self.upload_pending(writer, manifest, missing)
+                return
+        else:
+            upload = self.find_upload(writer, data)
+            if upload is None:
+                return
+            manifest, pending, index, chunk = upload
+            await self.run_blocking(store.put_chunk, manifest['chunks'][index], chunk)
+            pending.discard(index)
+            if pending:
+                return
+        verified = await self.run_blocking(store.finish_upload, manifest)
+        self.upload_verified(writer, manifest, verified)
+
+    async def process_legacy_file(self, writer, msg_type, data):
+        """Файл старого клиента, как в ChatServer.process_message, но сохранение - в пуле потоков"""
+        file_data = self.legacy_file(msg_type, data.decode())
+        if file_data is None:
+            self.process_message(writer, msg_type, data)  # Обычный текст или отклоненный кадр
+            return
+        manifest = await self.run_blocking(self.file_store.legacy_manifest, file_data)
+        self.publish_legacy_file(writer, manifest)
+
+    def run_blocking(self, func, *args):
+        return self.loop.run_in_executor(None, func, *args)
+
+    def create_outbox(self, client_socket):
+        """Создает очередь отправки с писателем-задачей asyncio"""
+        return AsyncClientOutbox(client_socket, self.send_queue_size, self.slow_client_policy,
+                                 congested=self.congested_outboxes)
+
+    async def wait_for_backpressure(self, client_socket):
+        """Приостанавливает чтение от отправителя, пока его комната не разгрузится"""
+        if self.slow_client_policy != BACKPRESSURE or not self.congested_outboxes:
+            return
+        # Обходим только переполненные очереди, а не всю комнату
+        room = self.rooms.room_of(client_socket)
+        for outbox in list(self.congested_outboxes):
+            if outbox.congested() and self.rooms.room_of(outbox.writer) == room:
+                await outbox.wait_for_space()
+
+    def start_reaper(self):
+        """Проверяет сроки PING задачей в цикле событий: очереди клиентов трогаем только из него"""
+        if self.heartbeat is not None:
+            self.reaper_task = self.loop.create_task(self.run_reaper())
+
+    def start_presence(self):
+        """Рассылает сводки входов и выходов задачей в цикле событий"""
+        self.presence_task = self.loop.create_task(self.run_presence())
+
+    def install_reload_signal(self):
+        """SIGHUP перечитывает ключ прямо в цикле событий; сигналы ловит только главный поток"""
+        if hasattr(signal, 'SIGHUP') and threading.current_thread() is threading.main_thread():
+            self.loop.add_signal_handler(signal.SIGHUP, self.reload_keys)
+
+    async def run_reaper(self):
+        while True:
+            await asyncio.sleep(self.heartbeat.tick)
+            self.heartbeat.expire()
+
+    async def run_presence(self):
+        while True:
+            await asyncio.sleep(self.presence.window)
+            self.flush_presence()
+
+    def evict_client(self, writer):
+        """Разрывает соединение клиента, не ответившего на PING"""
+        log.info("Клиент %s не ответил на проверку связи, отключаем", self.clients.get(writer))
+        self.evicted_clients.inc()
+        writer.transport.abort()
+
+    def handle_bus_event(self, event):
+        """События шины приходят из ее потока: очереди клиентов трогаем только из цикла событий"""
+        if self.loop is None:
+            super().handle_bus_event(event)
+        else:
+            self.loop.call_soon_threadsafe(super().handle_bus_event, event)
+
+    async def serve(self):
+        """Запускает цикл приема подключений"""
+        self.raise_file_limit()
+        self.handshake_slots = asyncio.Semaphore(self.max_handshakes)
+        self.loop = asyncio.get_running_loop()
+        self.start_metrics()
+        self.start_reaper()
+        self.start_presence()
+        self.install_reload_signal()
+        self.server = await asyncio.start_server(
+            self.handle_connection, self.host, self.port,
+            limit=self.stream_limit, reuse_address=True, reuse_port=self.reuse_port,
+            backlog=self.backlog
+        )
+        log.info("Асинхронный сервер запущен на %s:%s", self.host, self.port)
+        async with self.server:
+            await self.server.serve_forever()
+
+    def start(self):
+        """Запускает сервер"""
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            log.error("Ошибка сервера: %s", e)
+
+    def stop(self):
+        """Останавливает сервер"""
+        if self.server:
+            self.server.close()
+        if self.metrics_server:
+            self.metrics_server.stop()
+        for writer, outbox in list(self.outboxes.items()):
+            outbox.close()
+            writer.close()
+        self.history.close()
+        log.info("Сервер остановлен")
@@ -0,0 +1,116 @@
+import queue
+import threading
+import time
+from PySide6.QtCore import QObject, QTimer, QUrl
+from logs import get_logger
+
+log = get_logger('audio')
+
+VOICES = 3  # Сколько раз звук может звучать одновременно
+MIN_INTERVAL = 0.25  # Запуски звука не чаще, секунд; срабатывания между ними схлопываются в один
+
+
+class QtVoices:
+    """Пул QSoundEffect с одним источником: Qt декодирует файл один раз и держит его в памяти"""
+
+    def __init__(self, path, voices):
+        from PySide6.QtMultimedia import QSoundEffect
+        self.error_status = QSoundEffect.Error
+        self.voices = []
+        for _ in range(voices):
+            voice = QSoundEffect()
+            voice.setSource(QUrl.fromLocalFile(path))
+            voice.setVolume(1.0)
+            self.voices.append(voice)
+
+    def failed(self):
+        return self.voices[0].status() == self.error_status
+
+    def play(self):
+        """Запускает звук на свободном голосе; False, если все заняты"""
+        for voice in self.voices:
+            if not voice.isPlaying():
+                voice.play()
+                return True
+        return False
+
+
+class WorkerVoice:
+    """Один голос на постоянном потоке: запасной вариант без QtMultimedia.
+
+    На Windows звук играется из памяти через winsound, иначе - playsound
+    из файла. Поток создается один раз; пока звук играет, новые запуски
+    пропускаются.
+    """
+
+    def __init__(self, path):
+        try:
+            import winsound
+            with open(path, 'rb') as f:
+                data = f.read()  # Файл читается один раз
+            self.play_once = lambda: winsound.PlaySound(data, winsound.SND_MEMORY)
+        except ImportError:
+            from playsound import playsound
+            self.play_once = lambda: playsound(path)
+        self.requests = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def failed(self):
+        return False
+
+    def play(self):
+        try:
+            self.requests.put_nowait(None)
+            return True
+        except queue.Full:
+            return False
+
+    def _run(self):
+        while True:
+            self.requests.get()
+            try:
+                self.play_once()
+            except Exception as e:
+                log.warning("Ошибка воспроизведения звука: %s", e)
+
+
+class SoundPlayer(QObject):
+    """Звук уведомления: загружается один раз и играет из небольшого пула голосов.
+
+    trigger() можно вызывать на каждое сообщение. Звук запускается не чаще
+    min_interval; срабатывания внутри интервала схлопываются в один
+    отложенный запуск, а если заняты все голоса - пропускаются. Пачка
+    сообщений не создает потоков и не читает диск. Вызывается из потока GUI.
+    """
+
+    def __init__(self, path, voices=VOICES, min_interval=MIN_INTERVAL, parent=None):
+        super().__init__(parent)
+        self.path = path
+        self.min_interval = min_interval
+        self.last_started = float('-inf')
+        self.skipped = 0  # Запуски, пропущенные из-за занятых голосов
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self._start)
+        try:
+            self.backend = QtVoices(path, voices)
+        except ImportError as e:
+            log.info("QtMultimedia недоступен (%s), звук через запасной вариант", e)
+            self.backend = WorkerVoice(path)
+
+    def trigger(self):
+        """Просит сыграть звук; лишние запросы схлопываются"""
+        wait = self.last_started + self.min_interval - time.monotonic()
+        if wait <= 0:
+            self._start()
+        elif not self.timer.isActive():
+            self.timer.start(int(wait * 1000) + 1)
+
+    def _start(self):
+        self.last_started = time.monotonic()
+        if self.backend.failed():
+            log.warning("QSoundEffect не смог загрузить звук, переключаемся на запасной вариант")
+            self.backend = WorkerVoice(self.path)
+        if not self.backend.play():
+            self.skipped += 1
@@ -0,0 +1,434 @@
+import argparse
+import asyncio
+import base64
+import json
+import os
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from compression import COMPRESSION_METHODS, compressed_cipher
+from crypto import CIPHER_BACKENDS, get_cipher, load_key_from_file, save_key_to_file
+from metrics import Histogram
+from protocol import FrameDecoder, encode_frame, MSG_FILE, MSG_HELLO, MSG_TEXT
+
+try:
+    import psutil  # Необязательно: без него RSS и CPU читаются из /proc (только Linux)
+except ImportError:
+    psutil = None
+
+try:
+    import resource  # Нет на Windows
+except ImportError:
+    resource = None
+
+SCENARIOS = ('idle', 'storm', 'files', 'reconnect')
+MARK = 'bench@'  # Метка времени отправки в тексте сообщения: bench@<perf_counter>
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def quantiles(histogram):
+    """Квантили гистограммы в миллисекундах"""
+    return {name: round(histogram.quantile(q) * 1000, 3)
+            for name, q in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999))}
+
+
+class ProcessStats:
+    """RSS и процессорное время процесса сервера"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.process = psutil.Process(pid) if psutil and pid else None
+        self.peak_rss = 0
+        self.started = time.monotonic()
+        self.start_cpu = self.cpu_seconds()
+
+    def rss(self):
+        if self.process is not None:
+            return self.process.memory_info().rss
+        try:
+            with open(f'/proc/{self.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except (OSError, TypeError):
+            return None
+
+    def cpu_seconds(self):
+        if self.process is not None:
+            times = self.process.cpu_times()
+            return times.user + times.system
+        try:
+            with open(f'/proc/{self.pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        except (OSError, TypeError, ValueError):
+            return None
+
+    def sample(self):
+        rss = self.rss()
+        if rss:
+            self.peak_rss = max(self.peak_rss, rss)
+
+    def report(self):
+        if not self.pid:
+            return None
+        cpu = self.cpu_seconds()
+        elapsed = time.monotonic() - self.started
+        cpu_used = cpu - self.start_cpu if cpu is not None and self.start_cpu is not None else None
+        return {
+            'pid': self.pid,
+            'rss_bytes': self.rss(),
+            'peak_rss_bytes': self.peak_rss or None,
+            'cpu_seconds': round(cpu_used, 3) if cpu_used is not None else None,
+            'cpu_percent': round(100 * cpu_used / elapsed, 1) if cpu_used is not None else None
+        }
+
+
+class BenchStats:
+    """Общие счетчики прогона"""
+
+    def __init__(self):
+        self.handshake = Histogram('handshake', "Рукопожатие")
+        self.latency = Histogram('latency', "Доставка от отправителя до получателя")
+        self.sent = 0
+        self.delivered = 0
+        self.received_bytes = 0
+        self.connects = 0
+        self.errors = 0
+
+
+class BenchClient:
+    """Клиент без интерфейса: рукопожатие, отправка и прием кадров.
+
+    Только слушатели расшифровывают входящие кадры и меряют задержку,
+    остальные вычитывают сокет без расшифровки, чтобы генератор нагрузки
+    не упирался в собственный процессор.
+    """
+
+    def __init__(self, name, key, host, port, stats, listener=False, compression=True):
+        self.name = name
+        self.compression = compression
+        self.key = key
+        self.host = host
+        self.port = port
+        self.stats = stats
+        self.listener = listener
+        self.cipher = None
+        self.writer = None
+        self.task = None
+
+    async def connect(self):
+        started = time.perf_counter()
+        reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        handshake_cipher = get_cipher(self.key)
+        hello = json.dumps({'nickname': self.name, 'ciphers': list(CIPHER_BACKENDS),
+                            'compression': list(COMPRESSION_METHODS) if self.compression else []})
+        self.writer.write(encode_frame(MSG_HELLO, handshake_cipher.encrypt(hello.encode())))
+        decoder = FrameDecoder()
+        frames = []
+        while not frames:
+            data = await reader.read(65536)
+            if not data:
+                raise ConnectionError("Сервер закрыл соединение при рукопожатии")
+            frames = decoder.feed(data)
+        msg_type, payload = frames[0]
+        if msg_type != MSG_HELLO:
+            raise ConnectionError(f"Ожидался ответ на рукопожатие, получен тип {msg_type}")
+        reply = json.loads(handshake_cipher.decrypt(payload))
+        self.cipher = compressed_cipher(get_cipher(self.key, reply['cipher']), reply.get('compression'))
+        self.stats.handshake.observe(time.perf_counter() - started)
+        self.stats.connects += 1
+        self.task = asyncio.get_running_loop().create_task(self.receive(reader, decoder))
+
+    async def receive(self, reader, decoder):
+        stats = self.stats
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    return
+                stats.received_bytes += len(data)
+                if not self.listener:
+                    continue
+                for msg_type, payload in decoder.feed(data):
+                    if msg_type == MSG_TEXT:
+                        self.record(self.cipher.decrypt(payload).decode())
+                    elif msg_type == MSG_FILE:
+                        self.record(json.loads(self.cipher.decrypt(payload))['name'])
+        except (ConnectionError, OSError):
+            pass
+
+    def record(self, text):
+        position = text.find(MARK)
+        if position < 0:
+            return
+        sent_at = float(text[position + len(MARK):].split()[0])
+        self.stats.latency.observe(time.perf_counter() - sent_at)
+        self.stats.delivered += 1
+
+    def send(self, msg_type, payload):
+        self.writer.write(encode_frame(msg_type, self.cipher.encrypt(payload)))
+        self.stats.sent += 1
+
+    def send_text(self):
+        self.send(MSG_TEXT, f"{MARK}{time.perf_counter()!r}".encode())
+
+    def send_file(self, data):
+        # Старый формат: файл целиком в одном кадре, метка времени в имени файла
+        file_data = {'name': f"{MARK}{time.perf_counter()!r} .bin",
+                     'data': base64.b64encode(data).decode()}
+        self.send(MSG_FILE, json.dumps(file_data).encode())
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.task is not None:
+            self.task.cancel()
+
+
+async def connect_all(args, key, stats):
+    """Подключает клиентов, не больше args.concurrency рукопожатий одновременно"""
+    slots = asyncio.Semaphore(args.concurrency)
+    clients = [BenchClient(f"bench{index}", key, args.host, args.port, stats, index < args.listeners,
+                           not args.no_compression)
+               for index in range(args.clients)]
+
+    async def connect(client):
+        async with slots:
+            try:
+                await client.connect()
+                return client
+            except (ConnectionError, OSError, ValueError):
+                stats.errors += 1
+
+    connected = await asyncio.gather(*(connect(client) for client in clients))
+    return [client for client in connected if client is not None]
+
+
+async def send_loop(client, rate, duration, send):
+    """Отправляет сообщения с частотой rate в секунду до истечения duration"""
+    interval = 1.0 / rate
+    deadline = time.monotonic() + duration
+    next_send = time.monotonic()
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            return
+        if now < next_send:
+            await asyncio.sleep(next_send - now)
+            continue
+        try:
+            send()
+            await client.writer.drain()
+        except (ConnectionError, OSError):
+            client.stats.errors += 1
+            return
+        next_send += interval
+
+
+async def reconnect_loop(index, args, key, stats, deadline):
+    """Подключается, отправляет одно сообщение и отключается, пока не выйдет время"""
+    while time.monotonic() < deadline:
+        client = BenchClient(f"bench{index}", key, args.host, args.port, stats,
+                             compression=not args.no_compression)
+        try:
+            await client.connect()
+            client.send_text()
+            await client.writer.drain()
+        except (ConnectionError, OSError, ValueError):
+            stats.errors += 1
+        finally:
+            await client.close()
+
+
+async def run_scenario(args, key, server):
+    stats = BenchStats()
+    started = time.monotonic()
+
+    async def sample_server():
+        while True:
+            server.sample()
+            await asyncio.sleep(0.5)
+
+    sampler = asyncio.get_running_loop().create_task(sample_server())
+    clients = []
+    try:
+        if args.scenario == 'reconnect':
+            deadline = time.monotonic() + args.duration
+            await asyncio.gather(*(reconnect_loop(index, args, key, stats, deadline)
+                                   for index in range(args.clients)))
+        else:
+            clients = await connect_all(args, key, stats)
+            ramp_up = time.monotonic() - started
+            if args.scenario == 'idle':
+                await asyncio.sleep(args.duration)
+            elif args.scenario == 'storm':
+                await asyncio.gather(*(send_loop(client, args.rate, args.duration, client.send_text)
+                                       for client in clients))
+            else:
+                data = os.urandom(args.file_size)
+                senders = clients[:args.senders]
+                await asyncio.gather(*(send_loop(client, args.rate, args.duration,
+                                                 lambda client=client: client.send_file(data))
+                                       for client in senders))
+            await asyncio.sleep(args.settle)  # Дожидаемся доставки последних сообщений
+    finally:
+        sampler.cancel()
+        for client in clients:
+            await client.close()
+
+    elapsed = time.monotonic() - started
+    result = {
+        'scenario': args.scenario,
+        'clients': args.clients,
+        'listeners': min(args.listeners, args.clients),
+        'duration': round(elapsed, 3),
+        'connected': stats.connects,
+        'errors': stats.errors,
+        'sent': stats.sent,
+        'delivered': stats.delivered,
+        'messages_per_sec': round(stats.sent / args.duration, 1) if args.duration else None,
+        'deliveries_per_sec': round(stats.delivered / args.duration, 1) if args.duration else None,
+        'received_bytes': stats.received_bytes,
+        'handshake_ms': quantiles(stats.handshake),
+        'latency_ms': quantiles(stats.latency),
+        'server': server.report(),
+        'server_rate_limit': args.server_rate_limit
+    }
+    if args.scenario != 'reconnect':
+        result['ramp_up_seconds'] = round(ramp_up, 3)
+    else:
+        result['reconnects_per_sec'] = round(stats.connects / args.duration, 1)
+    return result
+
+
+def compare(result, baseline, tolerance):
+    """Сравнивает прогон с эталонным; возвращает список ухудшений больше tolerance"""
+    regressions = []
+    for section in ('latency_ms', 'handshake_ms'):
+        for name in ('p50', 'p99'):
+            old, new = baseline.get(section, {}).get(name), result[section].get(name)
+            if old and new > old * (1 + tolerance):
+                regressions.append(f"{section}.{name}: {old} -> {new}")
+    for name in ('messages_per_sec', 'deliveries_per_sec', 'reconnects_per_sec'):
+        old, new = baseline.get(name), result.get(name)
+        if old and new is not None and new < old * (1 - tolerance):
+            regressions.append(f"{name}: {old} -> {new}")
+    return regressions
+
+
+def raise_file_limit():
+    """Тысячам клиентов нужно столько же открытых сокетов"""
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
+
+
+def spawn_server(args, workdir):
+    """Запускает сервер в каталоге workdir с новым файлом ключа.
+
+    Предел трафика сервера - --server-rate-limit, если его не переопределяет
+    --server-args; действующее значение попадает в результат.
+    """
+    key = save_key_to_file('127.0.0.1', os.path.join(workdir, 'key.2pk'))
+    extra = shlex.split(args.server_args)
+    for index, item in enumerate(extra):
+        if item == '--rate-limit' and index + 1 < len(extra):
+            args.server_rate_limit = extra[index + 1]
+        elif item.startswith('--rate-limit='):
+            args.server_rate_limit = item.partition('=')[2]
+    command = [sys.executable, os.path.join(SERVER_DIR, 'server.py'), '--engine', args.spawn,
+               '--host', '127.0.0.1', '--port', str(args.port), '--log-level', 'WARNING',
+               '--rate-limit', args.server_rate_limit]
+    command += extra
+    process = subprocess.Popen(command, cwd=workdir)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', args.port), timeout=0.5).close()
+            return process, key
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Сервер не запустился за 10 секунд")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест сервера SafeSpace")
+    parser.add_argument('scenario', choices=SCENARIOS,
+                        help="idle - много молчащих клиентов, storm - все пишут, "
+                             "files - крупные файлы, reconnect - поток переподключений")
+    parser.add_argument('--key', default='key.2pk', help="Файл ключа (как у клиента)")
+    parser.add_argument('--host', help="Адрес сервера; по умолчанию - из файла ключа")
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--spawn', choices=['thread', 'async'],
+                        help="Запустить сервер с этим движком на время теста")
+    parser.add_argument('--server-args', default='', help="Дополнительные параметры server.py для --spawn")
+    parser.add_argument('--server-rate-limit', default='0:0',
+                        help="Предел трафика на клиента для --spawn (--rate-limit server.py); 0:0 - без ограничения")
+    parser.add_argument('--server-pid', type=int, help="PID уже запущенного сервера для замера RSS и CPU")
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--listeners', type=int, default=10,
+                        help="Сколько клиентов расшифровывают входящие и меряют задержку")
+    parser.add_argument('--senders', type=int, default=1, help="Сколько клиентов отправляют файлы (files)")
+    parser.add_argument('--rate', type=float, default=1.0, help="Сообщений в секунду на отправителя")
+    parser.add_argument('--duration', type=float, default=10.0, help="Длительность нагрузки, секунд")
+    parser.add_argument('--settle', type=float, default=1.0, help="Ожидание доставки после нагрузки, секунд")
+    parser.add_argument('--file-size', type=int, default=1024 * 1024, help="Размер файла для files, байт")
+    parser.add_argument('--no-compression', action='store_true', help="Не предлагать серверу сжатие")
+    parser.add_argument('--concurrency', type=int, default=200, help="Одновременных подключений при разгоне")
+    parser.add_argument('--output', help="Записать результат в JSON-файл (иначе - в stdout)")
+    parser.add_argument('--baseline', help="JSON прошлого прогона: код возврата 1 при ухудшении")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Допустимое ухудшение относительно --baseline")
+    args = parser.parse_args()
+
+    raise_file_limit()
+    process = None
+    workdir = None
+    try:
+        if args.spawn:
+            workdir = tempfile.mkdtemp(prefix='safespace-bench-')
+            process, key = spawn_server(args, workdir)
+            args.host = '127.0.0.1'
+            pid = process.pid
+        else:
+            key, server_ip = load_key_from_file(args.key)
+            args.host = args.host or server_ip
+            args.server_rate_limit = None  # Предел внешнего сервера неизвестен
+            pid = args.server_pid
+        result = asyncio.run(run_scenario(args, key, ProcessStats(pid)))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if workdir is not None:
+            # Ключ, история и файлы запущенного сервера
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Ухудшение: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
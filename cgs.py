@@ -1,21 +1,32 @@
 import sys
-import socket
 import threading
 import os
 import json
-import base64
-from playsound import playsound
+from collections import deque
 from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
-                            QHBoxLayout, QTextEdit, QLineEdit, QPushButton, 
+                            QHBoxLayout, QLineEdit, QPushButton, 
                             QLabel, QMessageBox, QInputDialog, QFileDialog,
                             QSystemTrayIcon, QMenu)
-from PySide6.QtCore import Qt, Signal, QObject, Slot, QTimer, QUrl
+from PySide6.QtCore import Qt, Signal, QObject, Slot, QTimer
 from PySide6.QtGui import QIcon
-from PySide6.QtMultimedia import QSoundEffect
-from cryptography.fernet import Fernet
-import pystray
-from pystray import MenuItem, Icon
-from PIL import Image, ImageDraw
+from chatview import ChatView
+from filetransfer import (DOWNLOAD_WINDOW, FileDownload, describe_file, iter_chunks,
+                          pack_chunk, unpack_chunk)
+from logs import get_logger, setup_logging
+from protocol import (MSG_TEXT, MSG_FILE, MSG_HISTORY,
+                      MSG_FILE_OFFER, MSG_FILE_STATUS, MSG_FILE_CHUNK, MSG_FILE_REQUEST,
+                      MSG_JOIN, MSG_ENTRY, MSG_PRESENCE)
+
+# Тяжелые модули (cryptography, QtMultimedia, playsound) импортируются при первом
+# использовании, а не при запуске: окно должно появиться как можно раньше.
+# Бюджет времени импорта проверяет startup_check.py.
+
+log = get_logger('client')
+
+DIGEST_INTERVAL_MS = 1000  # Не чаще одного звука и уведомления за это время
+MESSAGE_HISTORY_SIZE = 1000  # Сколько последних сообщений клиент хранит в памяти
+HISTORY_PAGE_SIZE = 50  # Сколько сообщений запрашивать за одну прокрутку
+SERVER_PORT = 5000
 
 def resource_path(relative_path):
     """Получает абсолютный путь к ресурсу"""
@@ -27,10 +38,15 @@ def resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 class SignalHandler(QObject):
-    message_received = Signal(str)
+    message_received = Signal(str)  # Служебная строка в чате: без звука и уведомлений
+    messages_received = Signal(list)  # Пачка сообщений одного чтения: [(текст, id записи истории или None)]
+    history_page_received = Signal(list)
+    history_page_failed = Signal()
+    newer_page_received = Signal(list, bool)  # (строки, больше новых нет)
+    newer_page_failed = Signal()
+    room_changed = Signal(str)
     connection_status = Signal(str)
-    notification = Signal(str)
-    play_sound = Signal()
+    file_frame_received = Signal(int, object)  # (тип, данные): состояние загрузок меняется только в потоке окна
 
 class ChatWindow(QMainWindow):
     def __init__(self):
@@ -38,16 +54,29 @@ class ChatWindow(QMainWindow):
         self.setWindowTitle("SafeSpace")
         self.setMinimumSize(600, 400)
         
-        self.client_socket = None
+        self.connection = None  # ClientConnection: прием, отправка и переподключение
+        self.session_started = False
         self.encryption_key = None
+        self.key_id = None  # Номер ключа из файла; None - файл старого сервера
+        self.key_file = None  # Сюда сохраняется новый ключ, если сервер его сменит
         self.server_ip = None
+        self.known_files = {}  # {file_id: ссылка на файл из чата}
+        self.uploads = {}  # {file_id: (путь, манифест)}
+        self.download_targets = {}  # {file_id: куда сохранить}, пока ждем манифест
+        self.downloads = {}  # {file_id: FileDownload}
+        self.message_history = deque(maxlen=MESSAGE_HISTORY_SIZE)  # Последние сообщения сессии
         self.signal_handler = SignalHandler()
+        self.tray_icon = None  # Трей и звук настраиваются после первой отрисовки окна
+        self.sound = None  # SoundPlayer
         self.setup_ui()
-        self.setup_notifications()
-        self.setup_sound()
-        
-        # Подключаем сигнал для воспроизведения звука
-        self.signal_handler.play_sound.connect(self.play_message_sound)
+
+        # Звук и уведомление о пачке сообщений не чаще раза в интервал, остальное - сводкой
+        self.unseen_count = 0
+        self.last_unseen = None
+        self.digest_timer = QTimer(self)
+        self.digest_timer.setSingleShot(True)
+        self.digest_timer.setInterval(DIGEST_INTERVAL_MS)
+        self.digest_timer.timeout.connect(self.flush_digest)
         
     def setup_ui(self):
         central_widget = QWidget()
@@ -69,9 +98,16 @@ class ChatWindow(QMainWindow):
         self.connect_button.setEnabled(False)
         layout.addWidget(self.connect_button)
         
-        # Область чата
-        self.chat_area = QTextEdit()
-        self.chat_area.setReadOnly(True)
+        # Подгрузка более ранних сообщений истории
+        self.older_button = QPushButton("Загрузить более ранние сообщения")
+        self.older_button.clicked.connect(self.request_older_history)
+        self.older_button.setEnabled(False)
+        layout.addWidget(self.older_button)
+        
+        # Область чата: в памяти только последние строки, ранние подгружаются при прокрутке вверх
+        self.chat_area = ChatView()
+        self.chat_area.older_requested.connect(self.request_older_history)
+        self.chat_area.newer_requested.connect(self.request_newer_history)
         layout.addWidget(self.chat_area)
         
         # Поле ввода сообщения и кнопка отправки
@@ -87,14 +123,48 @@ class ChatWindow(QMainWindow):
         input_layout.addWidget(self.send_button)
         layout.addLayout(input_layout)
         
+        # Передача файлов
+        files_layout = QHBoxLayout()
+        self.send_file_button = QPushButton("Отправить файл")
+        self.send_file_button.clicked.connect(self.send_file)
+        self.send_file_button.setEnabled(False)
+        files_layout.addWidget(self.send_file_button)
+        
+        self.download_button = QPushButton("Скачать файл")
+        self.download_button.clicked.connect(self.download_file)
+        self.download_button.setEnabled(False)
+        files_layout.addWidget(self.download_button)
+        
+        self.room_button = QPushButton("Сменить комнату")
+        self.room_button.clicked.connect(self.change_room)
+        self.room_button.setEnabled(False)
+        files_layout.addWidget(self.room_button)
+        
+        self.members_button = QPushButton("Кто в комнате")
+        self.members_button.clicked.connect(self.request_members)
+        self.members_button.setEnabled(False)
+        files_layout.addWidget(self.members_button)
+        layout.addLayout(files_layout)
+        
         # Статус подключения
         self.status_label = QLabel("Статус: Отключено")
         layout.addWidget(self.status_label)
         
         # Подключаем сигналы
         self.signal_handler.message_received.connect(self.display_message)
+        self.signal_handler.messages_received.connect(self.display_messages)
+        self.signal_handler.history_page_received.connect(self.display_history_page)
+        self.signal_handler.history_page_failed.connect(lambda: self.chat_area.prepend_history([]))
+        self.signal_handler.newer_page_received.connect(self.chat_area.append_history)
+        self.signal_handler.newer_page_failed.connect(self.chat_area.reset_newer_loading)
+        self.signal_handler.room_changed.connect(self.display_room)
         self.signal_handler.connection_status.connect(self.update_status)
-        self.signal_handler.notification.connect(self.show_notification)
+        self.signal_handler.file_frame_received.connect(self.handle_file_frame)
+
+    def setup_deferred(self):
+        """Настраивает трей и звук, когда окно уже на экране"""
+        self.setup_notifications()
+        self.setup_sound()
 
     def setup_notifications(self):
         """Настройка системы уведомлений"""
@@ -117,7 +187,9 @@ class ChatWindow(QMainWindow):
 
     def show_notification(self, message):
         """Показывает уведомление в системном трее"""
-        print(f"Показываем уведомление: {message}")  # Логирование уведомления
+        if self.tray_icon is None:
+            return
+        log.debug("Показываем уведомление")
         self.tray_icon.showMessage(
             "SafeSpace",
             message,
@@ -141,23 +213,14 @@ class ChatWindow(QMainWindow):
                 QMessageBox.critical(self, "Ошибка", "Файл не существует!")
                 return
                 
-            with open(file_path, 'r') as f:
-                data = json.load(f)
-                
-            if 'key' not in data or 'encrypted_ip' not in data:
-                QMessageBox.critical(self, "Ошибка", "Неверный формат файла ключа")
-                return
-                
-            self.encryption_key = data['key'].encode()
-            encrypted_ip = base64.b64decode(data['encrypted_ip'])
-            
-            f = Fernet(self.encryption_key)
-            self.server_ip = f.decrypt(encrypted_ip).decode()
+            from client import read_key_file
+            self.encryption_key, self.key_id, self.server_ip = read_key_file(file_path)
+            self.key_file = file_path
             
             self.key_label.setText(f"Выбран файл: {file_path}")
             self.connect_button.setEnabled(True)
             self.status_label.setText("Статус: Файл ключа загружен")
-            self.chat_area.append("Файл ключа успешно загружен")
+            self.chat_area.add_message("Файл ключа успешно загружен")
             
         except json.JSONDecodeError:
             QMessageBox.critical(self, "Ошибка", "Файл ключа поврежден или имеет неверный формат")
@@ -165,230 +228,387 @@ class ChatWindow(QMainWindow):
             QMessageBox.critical(self, "Ошибка", f"Не удалось загрузить файл ключа: {str(e)}")
             
     def connect_to_server(self):
-        try:
-            if not self.encryption_key or not self.server_ip:
-                QMessageBox.warning(self, "Ошибка", "Сначала выберите файл ключа!")
-                return
-                
-            if self.client_socket is not None:
-                self.client_socket.close()  # Закрываем старое соединение, если оно существует
+        if not self.encryption_key or not self.server_ip:
+            QMessageBox.warning(self, "Ошибка", "Сначала выберите файл ключа!")
+            return
 
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.settimeout(5)
-            self.client_socket.connect((self.server_ip, 5000))
-            self.client_socket.settimeout(None)
-            
-            nickname, ok = QInputDialog.getText(self, 'Никнейм', 'Введите ваш никнейм:')
-            if ok and nickname:
-                self.nickname = nickname
-                f = Fernet(self.encryption_key)
-                self.client_socket.send(f.encrypt(nickname.encode()))
-                self.signal_handler.connection_status.emit("Подключено")
-                
-                self.message_input.setEnabled(True)
-                self.send_button.setEnabled(True)
-                self.key_button.setEnabled(False)
-                self.connect_button.setEnabled(False)
-                
-                # Запускаем поток для получения сообщений только один раз
-                if not hasattr(self, 'receive_thread') or not self.receive_thread.is_alive():
-                    self.receive_thread = threading.Thread(target=self.receive_messages)
-                    self.receive_thread.daemon = True
-                    self.receive_thread.start()
-                    
-                self.chat_area.append("Успешно подключено к серверу")
-            else:
-                if self.client_socket:
-                    self.client_socket.close()
-                self.client_socket = None
-                
-        except socket.timeout:
-            QMessageBox.critical(self, "Ошибка", "Не удалось подключиться к серверу: превышено время ожидания")
-        except ConnectionRefusedError:
-            QMessageBox.critical(self, "Ошибка", "Сервер не запущен или недоступен")
-        except Exception as e:
-            QMessageBox.critical(self, "Ошибка", f"Не удалось подключиться к серверу: {str(e)}")
+        nickname, ok = QInputDialog.getText(self, 'Никнейм', 'Введите ваш никнейм:')
+        if not ok or not nickname:
+            return
+        # Подключение идет в фоне: окно не замирает, пока сервер недоступен
+        self.key_button.setEnabled(False)
+        self.connect_button.setEnabled(False)
+        self.status_label.setText("Статус: Подключение...")
+        self.start_connection(nickname)
             
     def setup_sound(self):
-        """Настройка звука"""
+        """Загружает звук уведомления один раз; дальше он играет из памяти"""
+        sound_path = resource_path("newmaseg.wav")
+        if not os.path.exists(sound_path):
+            log.warning("Файл звука не найден: %s", sound_path)
+            return
         try:
-            # Получаем путь к звуковому файлу
-            sound_path = resource_path("newmaseg.wav")
-            print(f"Путь к звуковому файлу: {sound_path}")
-            
-            if not os.path.exists(sound_path):
-                print("Файл звука не найден")
-                return
-                
-            # Пробуем инициализировать QSoundEffect
-            try:
-                self.message_sound = QSoundEffect()
-                self.message_sound.setSource(QUrl.fromLocalFile(sound_path))
-                self.message_sound.setVolume(1.0)
-                self.use_qsound = True
-                print("QSoundEffect успешно инициализирован")
-            except Exception as e:
-                print(f"Не удалось инициализировать QSoundEffect: {str(e)}")
-                self.use_qsound = False
-                
+            from audio import SoundPlayer
+            self.sound = SoundPlayer(sound_path, parent=self)
         except Exception as e:
-            print(f"Ошибка при настройке звука: {str(e)}")
-            self.use_qsound = False
+            log.error("Ошибка при настройке звука: %s", e)
 
     def add_message_to_history(self, message):
-        """Добавляет сообщение в историю (до 100 последних сообщений)."""
-        if not hasattr(self, 'message_history'):
-            self.message_history = []  # Инициализируем историю сообщений
-        if len(self.message_history) >= 100:
-            self.message_history.pop(0)  # Удаляем старое сообщение
+        """Добавляет сообщение в историю; самое старое вытесняется за O(1)"""
         self.message_history.append(message)
 
     def play_message_sound(self):
-        """Воспроизводит звук нового сообщения"""
-        try:
-            # Получаем путь к звуковому файлу
-            sound_path = resource_path("newmaseg.wav")
-            
-            if not os.path.exists(sound_path):
-                print("Файл звука не найден")
-                return
-                
-            if hasattr(self, 'use_qsound') and self.use_qsound:
-                try:
-                    self.message_sound.play()
-                except Exception as e:
-                    print(f"Ошибка воспроизведения через QSoundEffect: {str(e)}")
-                    self.use_qsound = False
-                    self._play_sound_with_playsound(sound_path)
+        """Воспроизводит звук нового сообщения; частые вызовы схлопываются в SoundPlayer"""
+        if self.sound is not None:
+            self.sound.trigger()
+
+    def start_connection(self, nickname):
+        """Запускает фоновое соединение: оно само переподключается и возобновляет сессию"""
+        from connection import ClientConnection
+        if self.connection is not None:
+            self.connection.stop()
+        self.nickname = nickname
+        self.connection = ClientConnection(
+            self.server_ip, SERVER_PORT, self.encryption_key, nickname,
+            on_frames=self.handle_frames, on_connected=self.on_connected,
+            on_disconnected=self.on_disconnected, key_id=self.key_id, key_file=self.key_file,
+            on_rekey=self.on_rekey
+        )
+        self.connection.start()
+
+    def on_rekey(self, key_id, key):
+        """Вызывается из потока соединения: сервер сменил ключ, файл ключа уже обновлен"""
+        self.encryption_key, self.key_id = key, key_id
+
+    def on_connected(self, resumed):
+        """Вызывается из потока соединения после рукопожатия"""
+        if not resumed and self.session_started:
+            # Сервер начал новую сессию в общей комнате и пришлет ее историю заново
+            from history import DEFAULT_ROOM
+            self.signal_handler.room_changed.emit(DEFAULT_ROOM)
+        self.session_started = True
+        self.signal_handler.connection_status.emit("Подключено")
+
+    def on_disconnected(self, delay):
+        """Вызывается из потока соединения перед паузой до следующей попытки"""
+        self.signal_handler.connection_status.emit(f"Нет соединения, переподключение через {delay:.1f} с")
+
+    def handle_frames(self, frames):
+        """Разбирает расшифрованные кадры одного чтения в потоке соединения"""
+        batch = []  # Сообщения одного чтения из сокета уходят в интерфейс одним сигналом
+
+        def flush_batch():
+            if batch:
+                self.signal_handler.messages_received.emit(list(batch))
+                batch.clear()
+
+        for msg_type, data in frames:
+            if msg_type in (MSG_FILE_STATUS, MSG_FILE_OFFER, MSG_FILE_CHUNK):
+                flush_batch()
+                self.signal_handler.file_frame_received.emit(msg_type, data)
+                continue
+
+            message = data.decode()
+            if msg_type == MSG_JOIN:
+                # Сервер перевел нас в комнату; следом придет ее история
+                flush_batch()
+                self.signal_handler.room_changed.emit(json.loads(message)['room'])
+                continue
+            if msg_type == MSG_ENTRY:
+                entry = json.loads(message)
+                rows = [(self.format_message(entry['text']), entry['id'])]
+            elif msg_type == MSG_HISTORY:
+                entries = json.loads(message)
+                rows = self.history_rows(entries)
+            elif msg_type == MSG_FILE:
+                rows = [(self.format_message(f"FILE:{message}"), None)]
+            elif msg_type == MSG_PRESENCE:
+                # Сводка входов и выходов: одна строка на всю пачку, без звука и уведомлений
+                from presence import presence_text
+                digest = json.loads(message)
+                flush_batch()
+                self.signal_handler.message_received.emit(
+                    presence_text(digest['room'], digest['joined'], digest['left']))
+                continue
             else:
-                self._play_sound_with_playsound(sound_path)
-                
-        except Exception as e:
-            print(f"Ошибка воспроизведения звука: {str(e)}")
-            
-    def _play_sound_with_playsound(self, sound_path):
-        """Воспроизводит звук с помощью playsound"""
-        try:
-            threading.Thread(target=playsound, args=(sound_path,), daemon=True).start()
-        except Exception as e:
-            print(f"Ошибка воспроизведения звука через playsound: {str(e)}")
+                rows = [(message, None)]
+            for message, _ in rows:
+                # Добавляем сообщение в историю
+                self.add_message_to_history(message)
+            batch.extend(rows)
+        flush_batch()
+
+    def history_rows(self, entries):
+        """Строки чата из страницы истории: [(текст, id записи или None)]"""
+        return [(self.format_message(entry['text']), entry['id']) if isinstance(entry, dict)
+                else (self.format_message(entry), None) for entry in entries]
 
-    def receive_messages(self):
-        f = Fernet(self.encryption_key)
-        while True:
-            try:
-                data = self.client_socket.recv(4096)
-                if not data:
-                    print("Соединение закрыто сервером")
-                    self.signal_handler.connection_status.emit("Соединение потеряно")
-                    break
-                    
-                try:
-                    message = f.decrypt(data).decode()
-                    print(f"Получено сообщение: {message}")
-                    
-                    # Добавляем сообщение в историю
-                    self.add_message_to_history(message)
-                    
-                    self.signal_handler.message_received.emit(message)
-                    self.signal_handler.play_sound.emit()
-                    
-                    if not self.isActiveWindow():
-                        print("Показываем уведомление")
-                        self.signal_handler.notification.emit(message)
-                        self.show_notification(message)
-                except Exception as decrypt_error:
-                    print(f"Ошибка расшифровки: {decrypt_error}")
-                    
-            except ConnectionResetError:
-                print("Соединение было сброшено сервером")
-                self.signal_handler.connection_status.emit("Соединение потеряно")
-                break
-            except ConnectionAbortedError:
-                print("Соединение было прервано")
-                self.signal_handler.connection_status.emit("Соединение потеряно")
-                break
-            except Exception as e:
-                print(f"Ошибка получения сообщения: {str(e)}")
-                self.signal_handler.connection_status.emit("Соединение потеряно")
-                break
-                
     def send_message(self):
         message = self.message_input.text().strip()
         if message:
             try:
-                if not self.client_socket or self.client_socket.fileno() == -1:
-                    # Пробуем переподключиться
-                    try:
-                        print("Попытка переподключения...")
-                        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                        self.client_socket.settimeout(5)
-                        self.client_socket.connect((self.server_ip, 5000))
-                        self.client_socket.settimeout(None)
-                        
-                        # Повторно отправляем никнейм
-                        self.client_socket.send(Fernet(self.encryption_key).encrypt(self.nickname.encode()))
-                        print("Переподключение успешно")
-                        
-                        # Перезапускаем поток приема сообщений
-                        receive_thread = threading.Thread(target=self.receive_messages)
-                        receive_thread.daemon = True
-                        receive_thread.start()
-                        
-                    except Exception as reconnect_error:
-                        raise Exception(f"Не удалось переподключиться: {str(reconnect_error)}")
-                
-                print(f"Отправка сообщения: {message}")
-                encrypted_message = Fernet(self.encryption_key).encrypt(message.encode())
-                print(f"Зашифрованное сообщение: {encrypted_message}")
-                
-                self.client_socket.send(encrypted_message)
-                print("Сообщение отправлено")
+                self.send_frame(MSG_TEXT, message.encode())
+                log.debug("Сообщение отправлено")
                 
                 self.message_input.clear()
                 
             except Exception as e:
-                print(f"Ошибка отправки: {str(e)}")
+                log.error("Ошибка отправки: %s", e)
                 QMessageBox.warning(self, "Ошибка", f"Не удалось отправить сообщение: {str(e)}")
-                self.signal_handler.connection_status.emit("Соединение потеряно")
                 
+    def send_frame(self, msg_type, data):
+        """Шифрует и отправляет кадр через текущее соединение, не дожидаясь сети"""
+        if self.connection is None:
+            raise ConnectionError("Нет соединения с сервером")
+        self.connection.send_frame(msg_type, data, on_error=self.on_send_failed)
+
+    def on_send_failed(self, error):
+        """Вызывается из потока соединения, если кадр не удалось отправить"""
+        self.signal_handler.message_received.emit(f"Не удалось отправить сообщение: {error}")
+
+    def format_message(self, message):
+        """Превращает ссылку на файл в читаемую строку и запоминает файл"""
+        if not message.startswith("FILE:"):
+            return message
+        try:
+            reference = json.loads(message[5:])
+            self.known_files[reference['file_id']] = reference
+            sender = reference.get('from', 'Кто-то')
+            return f"{sender} отправил файл: {reference['name']} ({reference['size']} байт)"
+        except (ValueError, KeyError):
+            return message
+
+    def send_file(self):
+        """Выбирает файл и начинает загрузку на сервер"""
+        file_path, _ = QFileDialog.getOpenFileName(self, "Выберите файл для отправки")
+        if not file_path:
+            return
+        threading.Thread(target=self._offer_file, args=(file_path,), daemon=True).start()
+
+    def _offer_file(self, file_path):
+        """Считает хэши файла и отправляет серверу манифест"""
+        try:
+            manifest = describe_file(file_path)
+            self.uploads[manifest['file_id']] = (file_path, manifest)
+            self.send_frame(MSG_FILE_OFFER, json.dumps(manifest).encode())
+            self.signal_handler.message_received.emit(f"Отправка файла {manifest['name']}...")
+        except Exception as e:
+            log.error("Ошибка отправки файла: %s", e)
+            self.signal_handler.message_received.emit(f"Не удалось отправить файл: {str(e)}")
+
+    def _upload_chunks(self, file_id, missing):
+        """Отправляет недостающие куски, читая файл с диска по одному куску"""
+        file_path, manifest = self.uploads[file_id]
+        try:
+            for index, chunk in iter_chunks(file_path, manifest['chunk_size'], missing):
+                # Рабочий поток ждет сокета: файл не читается в память быстрее, чем уходит в сеть
+                self.connection.send_frame_wait(MSG_FILE_CHUNK, pack_chunk(file_id, index, chunk))
+        except Exception as e:
+            # Загрузка продолжится с места обрыва при повторной отправке файла
+            log.error("Ошибка отправки файла: %s", e)
+
+    def download_file(self):
+        """Выбирает один из файлов чата и начинает (или продолжает) скачивание"""
+        if not self.known_files:
+            QMessageBox.information(self, "Файлы", "В чате пока нет файлов")
+            return
+        references = list(self.known_files.values())
+        names = [f"{ref['name']} ({ref['size']} байт)" for ref in references]
+        name, ok = QInputDialog.getItem(self, "Скачать файл", "Файл:", names, len(names) - 1, False)
+        if not ok:
+            return
+        reference = references[names.index(name)]
+        target_path, _ = QFileDialog.getSaveFileName(self, "Сохранить файл", reference['name'])
+        if not target_path:
+            return
+        self.download_targets[reference['file_id']] = target_path
+        try:
+            self.send_frame(MSG_FILE_REQUEST, json.dumps({'file_id': reference['file_id']}).encode())
+        except Exception as e:
+            log.error("Ошибка запроса файла: %s", e)
+            self.chat_area.add_message(f"Не удалось запросить файл: {str(e)}")
+
+    def _request_chunks(self, download):
+        """Запрашивает следующее окно недостающих кусков"""
+        window = download.missing()[:DOWNLOAD_WINDOW]
+        download.requested = set(window)
+        request = {'file_id': download.manifest['file_id'], 'chunks': window}
+        self.send_frame(MSG_FILE_REQUEST, json.dumps(request).encode())
+
+    @Slot(int, object)
+    def handle_file_frame(self, msg_type, data):
+        """Обрабатывает кадры передачи файлов в потоке окна: там же, где закрываются загрузки"""
+        try:
+            self._handle_file_frame(msg_type, data)
+        except (ValueError, KeyError, OSError) as e:
+            log.error("Ошибка обработки кадра файла: %s", e)
+
+    def _handle_file_frame(self, msg_type, data):
+        if msg_type == MSG_FILE_CHUNK:
+            file_id, index, chunk = unpack_chunk(data)
+            download = self.downloads.get(file_id)
+            if download is None or not download.write_chunk(index, chunk):
+                return
+            download.requested.discard(index)
+            if download.is_complete():
+                download.finish()
+                del self.downloads[file_id]
+                self.chat_area.add_message(f"Файл сохранен: {download.target_path}")
+            elif not download.requested:
+                self._request_chunks(download)
+            return
+
+        info = json.loads(data.decode())
+        file_id = info['file_id']
+        if msg_type == MSG_FILE_OFFER:
+            # Манифест файла, который мы хотим скачать
+            target_path = self.download_targets.pop(file_id, None)
+            if target_path is None:
+                return
+            download = FileDownload(info, target_path)
+            if download.is_complete():
+                download.finish()
+                self.chat_area.add_message(f"Файл сохранен: {target_path}")
+                return
+            self.downloads[file_id] = download
+            self._request_chunks(download)
+        elif info.get('complete'):
+            upload = self.uploads.pop(file_id, None)
+            if upload:
+                self.chat_area.add_message(f"Файл {upload[1]['name']} отправлен")
+        elif file_id in self.uploads and info.get('missing'):
+            threading.Thread(target=self._upload_chunks, args=(file_id, info['missing']), daemon=True).start()
+        elif file_id in self.download_targets:
+            self.download_targets.pop(file_id)
+            self.chat_area.add_message("Файл недоступен на сервере")
+
+    def change_room(self):
+        """Просит сервер перевести нас в другую комнату"""
+        room, ok = QInputDialog.getText(self, 'Комната', 'Название комнаты:')
+        room = room.strip()
+        if not ok or not room:
+            return
+        try:
+            self.send_frame(MSG_JOIN, json.dumps({'room': room}).encode())
+        except Exception as e:
+            log.error("Ошибка смены комнаты: %s", e)
+            self.chat_area.add_message(f"Не удалось сменить комнату: {str(e)}")
+
+    def request_members(self):
+        """Запрашивает у сервера участников текущей комнаты"""
+        if self.connection is not None:
+            self.connection.request_presence(self.handle_members)
+
+    def handle_members(self, members):
+        """Ответ на запрос участников (из потока соединения)"""
+        if members is None:
+            self.signal_handler.message_received.emit("Не удалось получить список участников")
+        else:
+            self.signal_handler.message_received.emit(f"В комнате ({len(members)}): {', '.join(members)}")
+
+    @Slot(str)
+    def display_room(self, room):
+        """Очищает чат под историю новой комнаты"""
+        self.setWindowTitle(f"SafeSpace — {room}")
+        self.chat_area.clear_messages()
+        self.chat_area.add_message(f"Комната: {room}")
+        self.older_button.setEnabled(True)
+        self.older_button.setText("Загрузить более ранние сообщения")
+
+    def request_older_history(self):
+        """Запрашивает у сервера страницу сообщений старше уже загруженных"""
+        before_id = self.chat_area.oldest_id()
+        if self.connection is None or before_id is None:
+            return
+        self.connection.request_history(before_id, HISTORY_PAGE_SIZE, self.handle_history_page)
+
+    def request_newer_history(self):
+        """Запрашивает сообщения новее загруженных, если низ ленты вытеснила ранняя история"""
+        if self.connection is None:
+            self.chat_area.reset_newer_loading()
+            return
+        after_id = self.chat_area.newest_id() or 0
+        self.connection.request_history(None, HISTORY_PAGE_SIZE, self.handle_newer_page, after=after_id)
+
+    def handle_newer_page(self, entries):
+        """Ответ на запрос более новых сообщений (из потока соединения)"""
+        if entries is None:
+            self.signal_handler.newer_page_failed.emit()
+        else:
+            self.signal_handler.newer_page_received.emit(self.history_rows(entries),
+                                                         len(entries) < HISTORY_PAGE_SIZE)
+
+    def handle_history_page(self, entries):
+        """Ответ на запрос более ранних сообщений (из потока соединения): без звука и уведомлений"""
+        if entries is None:
+            # Снимаем флаг загрузки; повторим после переподключения
+            self.signal_handler.history_page_failed.emit()
+        else:
+            self.signal_handler.history_page_received.emit(self.history_rows(entries))
+
+    @Slot(list)
+    def display_history_page(self, rows):
+        """Вставляет более ранние сообщения в начало чата"""
+        self.chat_area.prepend_history(rows)
+        if not rows:
+            self.older_button.setEnabled(False)
+            self.older_button.setText("Более ранних сообщений нет")
+
     def update_status(self, status):
         self.status_label.setText(f"Статус: {status}")
-        if status == "Соединение потеряно":
-            self.message_input.setEnabled(False)
-            self.send_button.setEnabled(False)
-            self.key_button.setEnabled(True)
-            self.connect_button.setEnabled(True)
-            if self.client_socket:
-                try:
-                    self.client_socket.close()
-                except:
-                    pass
-                self.client_socket = None
-            self.chat_area.append("Соединение потеряно")
+        connected = status == "Подключено"
+        was_connected = self.message_input.isEnabled()
+        for widget in (self.message_input, self.send_button, self.older_button,
+                       self.send_file_button, self.download_button, self.room_button,
+                       self.members_button):
+            widget.setEnabled(connected)
+        if connected and not was_connected:
+            self.chat_area.add_message("Успешно подключено к серверу")
+        elif was_connected and not connected:
+            # Соединение переподключается само; кнопки ключа и подключения не нужны
+            for download in self.downloads.values():
+                download.close()  # Куски остаются в .part и будут докачаны
+            self.downloads.clear()
+            self.chat_area.add_message("Соединение потеряно")
 
     @Slot(str)
     def display_message(self, message):
-        """Отображает сообщение в чате"""
-        print(f"Отображение сообщения: {message}")
-        self.chat_area.append(message)
-        # Прокручиваем чат вниз
-        self.chat_area.verticalScrollBar().setValue(
-            self.chat_area.verticalScrollBar().maximum()
-        )
+        """Отображает служебную строку в чате"""
+        self.chat_area.add_message(message)
+
+    @Slot(list)
+    def display_messages(self, rows):
+        """Отображает пачку сообщений; звук и уведомление - одно на интервал"""
+        self.chat_area.add_messages(rows)
+        self.unseen_count += len(rows)
+        self.last_unseen = rows[-1][0]
+        if not self.digest_timer.isActive():
+            self.flush_digest()
+
+    def flush_digest(self):
+        """Один звук и одно уведомление на все сообщения, пришедшие за интервал"""
+        count, message = self.unseen_count, self.last_unseen
+        if not count:
+            return
+        self.unseen_count = 0
+        self.last_unseen = None
+        self.digest_timer.start()  # Следующие сообщения интервала попадут в сводку
+        self.play_message_sound()
+        if not self.isActiveWindow():
+            self.show_notification(message if count == 1 else f"{count} новых сообщений")
         
     def closeEvent(self, event):
-        if self.client_socket:
-            try:
-                self.client_socket.close()
-            except:
-                pass
+        if self.connection is not None:
+            self.connection.stop()
         event.accept()
 
 def main():
+    setup_logging()
     app = QApplication(sys.argv)
     window = ChatWindow()
     window.show()
+    # Нулевой таймер срабатывает, когда цикл событий уже обработал первую отрисовку
+    QTimer.singleShot(0, window.setup_deferred)
     sys.exit(app.exec())
 
 if __name__ == "__main__":
@@ -0,0 +1,270 @@
+from PySide6.QtCore import QAbstractListModel, QModelIndex, QPoint, QRect, QSize, Qt, QTimer, Signal
+from PySide6.QtWidgets import QAbstractItemView, QListView, QStyle, QStyledItemDelegate
+
+MAX_CHAT_ROWS = 1000  # Сколько строк чата держать в памяти
+FLUSH_INTERVAL_MS = 16  # Пачка входящих сообщений добавляется не чаще раза в кадр
+ROW_PADDING = 4
+
+
+class ChatModel(QAbstractListModel):
+    """Строки чата: (текст, id записи истории или None).
+
+    При добавлении новых сообщений сверх предела самые старые строки
+    удаляются; их можно снова загрузить из истории по oldest_id().
+    Ранняя история, вставленная в начало, так же вытесняет самые новые
+    строки: пока они не загружены снова по newest_id(), новые сообщения
+    с id не добавляются (они есть в истории сервера), а служебные строки
+    откладываются до конца ленты.
+    """
+
+    def __init__(self, max_rows=MAX_CHAT_ROWS, parent=None):
+        super().__init__(parent)
+        self.max_rows = max_rows
+        self.rows = []
+        self.trimmed_id = None  # Наибольший id среди удаленных строк истории
+        self.newer_trimmed = False  # Низ ленты обрезан, новые строки нужно загрузить снова
+        self.held = []  # Служебные строки, пришедшие, пока низ ленты обрезан
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and index.isValid():
+            return self.rows[index.row()][0]
+        return None
+
+    def append_rows(self, rows):
+        """Добавляет строки в конец одной вставкой и обрезает начало до предела; число удаленных строк"""
+        if self.newer_trimmed:
+            self.held.extend(row for row in rows if row[1] is None)
+            del self.held[:-self.max_rows]
+            return 0
+        return self._append(rows)
+
+    def append_newer(self, rows, caught_up):
+        """Добавляет страницу более новых строк истории; caught_up - дальше сервер ничего не вернет"""
+        newest = self.newest_id()
+        if newest is not None:
+            rows = [row for row in rows if row[1] is not None and row[1] > newest]
+        if caught_up:
+            self.newer_trimmed = False
+            rows, self.held = rows + self.held, []
+        return self._append(rows)
+
+    def prepend_rows(self, rows):
+        """Вставляет более ранние строки истории в начало и обрезает конец до предела"""
+        if not rows:
+            return
+        self.beginInsertRows(QModelIndex(), 0, len(rows) - 1)
+        self.rows[:0] = rows
+        self.endInsertRows()
+        excess = len(self.rows) - self.max_rows
+        if excess > 0:
+            start = len(self.rows) - excess
+            self.beginRemoveRows(QModelIndex(), start, len(self.rows) - 1)
+            del self.rows[start:]
+            self.endRemoveRows()
+            self.newer_trimmed = True
+
+    def _append(self, rows):
+        if not rows:
+            return 0
+        start = len(self.rows)
+        self.beginInsertRows(QModelIndex(), start, start + len(rows) - 1)
+        self.rows.extend(rows)
+        self.endInsertRows()
+        excess = len(self.rows) - self.max_rows
+        if excess <= 0:
+            return 0
+        self.beginRemoveRows(QModelIndex(), 0, excess - 1)
+        ids = [entry_id for _, entry_id in self.rows[:excess] if entry_id is not None]
+        if ids:
+            self.trimmed_id = max(ids)
+        del self.rows[:excess]
+        self.endRemoveRows()
+        return excess
+
+    def clear(self):
+        self.beginResetModel()
+        self.rows = []
+        self.trimmed_id = None
+        self.newer_trimmed = False
+        self.held = []
+        self.endResetModel()
+
+    def oldest_id(self):
+        """id, с которого запрашивать более ранние сообщения у сервера"""
+        for _, entry_id in self.rows:
+            if entry_id is not None:
+                return entry_id
+        if self.trimmed_id is not None:
+            return self.trimmed_id + 1
+        return None
+
+    def newest_id(self):
+        """id последней строки истории в ленте: с него запрашиваются более новые сообщения"""
+        for _, entry_id in reversed(self.rows):
+            if entry_id is not None:
+                return entry_id
+        return None
+
+
+class ChatDelegate(QStyledItemDelegate):
+    """Рисует строку чата с переносом слов; высоты строк кэшируются по ширине"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.heights = {}  # {текст: высота} для текущей ширины
+        self.width = 0
+
+    def text_rect(self, option):
+        return option.rect.adjusted(ROW_PADDING, ROW_PADDING // 2, -ROW_PADDING, -ROW_PADDING // 2)
+
+    def paint(self, painter, option, index):
+        painter.save()
+        if option.state & QStyle.State_Selected:
+            painter.fillRect(option.rect, option.palette.highlight())
+            painter.setPen(option.palette.highlightedText().color())
+        painter.drawText(self.text_rect(option), Qt.TextWordWrap, index.data())
+        painter.restore()
+
+    def sizeHint(self, option, index):
+        # Ширина строки — ширина области просмотра, option.rect здесь еще не рассчитан
+        width = max(1, self.parent().viewport().width() - 2 * ROW_PADDING)
+        if width != self.width:
+            self.width = width
+            self.heights.clear()
+        text = index.data()
+        height = self.heights.get(text)
+        if height is None:
+            bounds = option.fontMetrics.boundingRect(QRect(0, 0, width, 0), Qt.TextWordWrap, text)
+            height = self.heights[text] = bounds.height() + ROW_PADDING
+        return QSize(width, height)
+
+
+class ChatView(QListView):
+    """Лента чата: рисуются только видимые строки, входящие сообщения добавляются пачками.
+
+    Прокрутка к самому верху запрашивает более ранние сообщения (older_requested),
+    к самому низу, если он был вытеснен ранней историей, - более новые
+    (newer_requested). Вниз лента прокручивается, только если пользователь
+    и так был внизу.
+    """
+    older_requested = Signal()
+    newer_requested = Signal()
+
+    def __init__(self, max_rows=MAX_CHAT_ROWS, parent=None):
+        super().__init__(parent)
+        self.chat_model = ChatModel(max_rows, self)
+        self.setModel(self.chat_model)
+        self.delegate = ChatDelegate(self)
+        self.setItemDelegate(self.delegate)
+        self.setWordWrap(True)
+        self.setResizeMode(QListView.Adjust)
+        self.setLayoutMode(QListView.Batched)
+        self.setBatchSize(100)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.setEditTriggers(QAbstractItemView.NoEditTriggers)
+
+        self.pending = []  # Сообщения, пришедшие с прошлого кадра
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(FLUSH_INTERVAL_MS)
+        self.flush_timer.timeout.connect(self.flush)
+        self.loading_older = False  # Запрос ранней истории отправлен, ответа еще нет
+        self.loading_newer = False  # То же для более новой истории
+        self.history_exhausted = False
+        self.verticalScrollBar().valueChanged.connect(self.on_scroll)
+
+    def add_message(self, text, entry_id=None):
+        """Ставит сообщение в очередь; на экран оно попадет со следующей пачкой"""
+        self.add_messages([(text, entry_id)])
+
+    def add_messages(self, rows):
+        """Ставит в очередь строки (текст, id записи истории или None)"""
+        self.pending.extend(rows)
+        if not self.flush_timer.isActive():
+            self.flush_timer.start()
+
+    def flush(self):
+        if not self.pending:
+            return
+        scrollbar = self.verticalScrollBar()
+        at_bottom = scrollbar.value() >= scrollbar.maximum() - ROW_PADDING
+        rows, self.pending = self.pending, []
+        anchor = self.anchor()
+        removed = self.chat_model.append_rows(rows)
+        if at_bottom and not self.chat_model.newer_trimmed:
+            self.scrollToBottom()
+        elif removed:
+            self.restore_anchor(anchor, -removed)
+
+    def prepend_history(self, rows):
+        """Вставляет страницу более ранних сообщений, не сдвигая видимую часть"""
+        self.loading_older = False
+        if not rows:
+            self.history_exhausted = True
+            return
+        anchor = self.anchor()
+        self.chat_model.prepend_rows(rows)
+        self.restore_anchor(anchor, len(rows))
+
+    def append_history(self, rows, caught_up):
+        """Добавляет страницу более новых сообщений после прокрутки вниз, не сдвигая видимую часть"""
+        self.loading_newer = False
+        anchor = self.anchor()
+        removed = self.chat_model.append_newer(rows, caught_up)
+        if removed:
+            self.history_exhausted = False  # Начало ленты снова можно загрузить
+            self.restore_anchor(anchor, -removed)
+
+    def reset_newer_loading(self):
+        """Запрос более новой истории не удался: повторим при следующей прокрутке вниз"""
+        self.loading_newer = False
+
+    def anchor(self):
+        """Верхняя видимая строка и ее сдвиг от верха области просмотра"""
+        index = self.indexAt(QPoint(ROW_PADDING, 0))
+        if not index.isValid():
+            return None
+        return index.row(), self.visualRect(index).top()
+
+    def restore_anchor(self, anchor, shift):
+        """Возвращает на место строку anchor, номер которой изменился на shift"""
+        if anchor is None:
+            return
+        row, top = anchor
+        row = min(max(row + shift, 0), self.chat_model.rowCount() - 1)
+        if row < 0:
+            return
+        self.doItemsLayout()
+        self.scrollTo(self.chat_model.index(row), QAbstractItemView.PositionAtTop)
+        scrollbar = self.verticalScrollBar()
+        scrollbar.setValue(scrollbar.value() - top)
+
+    def clear_messages(self):
+        self.flush_timer.stop()
+        self.pending = []
+        self.loading_older = False
+        self.loading_newer = False
+        self.history_exhausted = False
+        self.chat_model.clear()
+
+    def oldest_id(self):
+        return self.chat_model.oldest_id()
+
+    def newest_id(self):
+        return self.chat_model.newest_id()
+
+    def on_scroll(self, value):
+        scrollbar = self.verticalScrollBar()
+        if (value == scrollbar.minimum() and self.chat_model.rows
+                and not self.loading_older and not self.history_exhausted
+                and self.oldest_id() is not None):
+            self.loading_older = True
+            self.older_requested.emit()
+        elif (value == scrollbar.maximum() and self.chat_model.newer_trimmed
+                and not self.loading_newer):
+            self.loading_newer = True
+            self.newer_requested.emit()
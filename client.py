@@ -0,0 +1,404 @@
+import asyncio
+import base64
+import itertools
+import json
+import random
+from compression import COMPRESSION_METHODS, compressed_cipher
+from crypto import (CIPHER_BACKENDS, KEYED_HELLO, InvalidToken, KeyedCipher, UnknownKey,
+                    decrypt_ip, get_cipher, update_key_file)
+from heartbeat import set_keepalive
+from logs import get_logger
+from protocol import (FrameDecoder, ProtocolError, encode_frame, RECV_BUFFER_SIZE, MSG_HELLO, MSG_TEXT,
+                      MSG_HISTORY, MSG_HISTORY_REQUEST, MSG_JOIN, MSG_LEAVE, MSG_ENTRY, MSG_PING,
+                      MSG_PONG, MSG_REKEY, MSG_PRESENCE, MSG_HISTORY_PAGE)
+
+# Клиент SafeSpace без GUI на asyncio: рукопожатие, прием, переподключение,
+# возобновление сессии и смена ключа. Один процесс может вести тысячи сессий;
+# окно cgs.py работает поверх него через connection.ClientConnection.
+
+log = get_logger('chatclient')
+
+SERVER_PORT = 5000
+CONNECT_TIMEOUT = 5.0  # Срок на подключение и рукопожатие, секунд
+BACKOFF_BASE = 0.5  # Верхняя граница первой задержки переподключения, секунд
+BACKOFF_CAP = 30.0  # Больше этого между попытками не ждем
+SILENCE_FACTOR = 3  # Сервер молчит дольше стольких интервалов PING - соединение считаем мертвым
+INBOX_SIZE = 1024  # Сколько кадров ждут чтения через async for; дальше сокет не читается
+REQUEST_TIMEOUT = 10.0  # Сколько ждать ответа на history() и presence(), секунд
+
+
+def read_key_file(path):
+    """Читает key.2pk: (ключ, номер ключа или None, адрес сервера)"""
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if 'key' not in data or 'encrypted_ip' not in data:
+        raise ValueError("Неверный формат файла ключа")
+    key = data['key'].encode()
+    return key, data.get('key_id'), decrypt_ip(base64.b64decode(data['encrypted_ip']), key)
+
+
+class Backoff:
+    """Экспоненциальная задержка с полным разбросом: случайно от 0 до base * 2**n, но не больше cap.
+
+    Разброс не дает всем клиентам разом ломиться на только что перезапущенный сервер.
+    """
+
+    def __init__(self, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def next_delay(self):
+        limit = min(self.cap, self.base * 2 ** min(self.attempt, 32))
+        self.attempt += 1
+        return random.uniform(0, limit)
+
+    def reset(self):
+        self.attempt = 0
+
+
+class ChatClient:
+    """Сессия SafeSpace на asyncio.
+
+    После connect() (или start()) прием идет фоновой задачей; при обрыве она
+    переподключается с задержкой Backoff. Повторное рукопожатие несет токен
+    возобновления и id последней увиденной записи истории: сервер возвращает
+    клиента в его комнату и присылает только пропущенные сообщения.
+
+    Кадры (тип, расшифрованные данные) читаются через async for или, если
+    задан on_frames, передаются ему пачкой одного чтения. PING, смену ключа,
+    токены комнат, повторы записей истории и ответы на history() и presence()
+    (по номеру запроса) клиент обрабатывает сам; сводки входов и выходов комнаты приходят кадром
+    MSG_PRESENCE с JSON {"room", "joined", "left"}. Колбэки вызываются из цикла событий:
+    on_connected(resumed), on_disconnected(delay), on_rekey(key_id, key).
+
+    key_id - номер ключа из key.2pk; None для файлов старых серверов. Если
+    задан key_file, новый ключ сервера сохраняется в него.
+    """
+
+    def __init__(self, host, port, key, nickname, key_id=None, key_file=None, reconnect=True,
+                 on_frames=None, on_connected=None, on_disconnected=None, on_rekey=None):
+        self.host = host
+        self.port = port
+        self.key = key
+        self.key_id = key_id
+        self.key_file = key_file
+        self.nickname = nickname
+        self.reconnect = reconnect
+        self.on_frames = on_frames
+        self.on_connected = on_connected
+        self.on_disconnected = on_disconnected
+        self.on_rekey = on_rekey
+        self.backoff = Backoff()
+        self.reader = None
+        self.writer = None
+        self.decoder = None
+        self.cipher = None  # Шифр сессии, согласованный с сервером
+        self.session = None  # (шифр, сжатие) сессии с номерами ключей; None - сервер их не поддерживает
+        self.silence_timeout = None  # Сколько ждать кадра от сервера с PING, секунд
+        self.resume_token = None  # Выдается сервером при рукопожатии и смене комнаты
+        self.last_id = None  # id последней записи истории текущей комнаты, которую видел клиент
+        self.room = None
+        self.request_ids = itertools.count(1)
+        self.history_requests = {}  # {номер запроса: future} - ожидающие ответа history()
+        self.presence_requests = {}  # То же для presence()
+        self.inbox = None  # asyncio.Queue для async for, создается в цикле событий
+        self.task = None
+
+    @classmethod
+    def from_key_file(cls, path, nickname, port=SERVER_PORT, **kwargs):
+        """Клиент по файлу key.2pk; новый ключ сервера будет сохранен в тот же файл"""
+        key, key_id, host = read_key_file(path)
+        return cls(host, port, key, nickname, key_id=key_id, key_file=path, **kwargs)
+
+    @property
+    def connected(self):
+        return self.writer is not None
+
+    async def connect(self):
+        """Подключается и запускает прием в фоне; ошибка первой попытки - исключение"""
+        frames = await self.handshake()
+        self.task = asyncio.ensure_future(self.run(frames))
+
+    def start(self):
+        """Запускает прием в фоне, не дожидаясь подключения: первая попытка тоже повторяется"""
+        self.task = asyncio.ensure_future(self.run())
+
+    async def close(self):
+        """Закрывает соединение и останавливает прием; async for завершится"""
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.close_writer()
+
+    async def run(self, frames=None):
+        """Цикл сессии: подключение, прием, пауза и новое подключение"""
+        if self.inbox is None and self.on_frames is None:
+            self.inbox = asyncio.Queue(INBOX_SIZE)
+        try:
+            while True:
+                if frames is None:
+                    try:
+                        frames = await self.handshake()
+                    except (OSError, asyncio.TimeoutError, ProtocolError, InvalidToken, ValueError, KeyError) as e:
+                        log.info("Не удалось подключиться: %s", e)
+                if frames is not None:
+                    self.backoff.reset()
+                    await self.receive(frames)
+                    self.close_writer()
+                    frames = None
+                if not self.reconnect:
+                    break
+                delay = self.backoff.next_delay()
+                if self.on_disconnected is not None:
+                    self.on_disconnected(delay)
+                await asyncio.sleep(delay)
+        finally:
+            self.close_writer()
+            if self.inbox is not None:
+                if self.inbox.full():
+                    self.inbox.get_nowait()
+                self.inbox.put_nowait(None)  # Конец async for
+
+    async def handshake(self):
+        """Подключается и проводит рукопожатие; возвращает кадры, пришедшие после ответа"""
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), CONNECT_TIMEOUT
+        )
+        try:
+            set_keepalive(writer.get_extra_info('socket'))
+            hello = {'nickname': self.nickname, 'ciphers': list(CIPHER_BACKENDS),
+                     'compression': list(COMPRESSION_METHODS), 'resume': self.resume_token,
+                     'heartbeat': True, 'rekey': True, 'presence': True}
+            if self.resume_token is not None and self.last_id is not None:
+                hello['last_id'] = self.last_id
+            handshake_cipher = get_cipher(self.key)
+            payload = handshake_cipher.encrypt(json.dumps(hello).encode())
+            if self.key_id is not None:
+                # Номер ключа: сервер выберет ключ сразу, без перебора
+                payload = KEYED_HELLO + bytes([self.key_id]) + payload
+            writer.write(encode_frame(MSG_HELLO, payload))
+            self.decoder = FrameDecoder()
+            frames = await asyncio.wait_for(self.read_reply(reader), CONNECT_TIMEOUT)
+            msg_type, payload = frames[0]
+            if msg_type != MSG_HELLO:
+                raise ConnectionError(f"Сервер не ответил на рукопожатие (кадр типа {msg_type})")
+            reply = json.loads(handshake_cipher.decrypt(payload).decode())
+        except BaseException:
+            writer.close()
+            raise
+
+        # Сервер с PING пишет хотя бы раз в интервал; дольше тишина - обрыв, которого TCP не заметил
+        ping_interval = reply.get('ping_interval')
+        self.silence_timeout = ping_interval * SILENCE_FACTOR if ping_interval else None
+        resumed = bool(reply.get('resumed'))
+        if not resumed:
+            self.last_id = None  # Новая сессия: сервер пришлет последнюю страницу истории
+        self.resume_token = reply.get('resume')
+        cipher = compressed_cipher(get_cipher(self.key, reply['cipher']), reply.get('compression'))
+        key_id = reply.get('key_id')
+        self.session = None
+        if key_id is not None:
+            # Кадры сессии несут номер ключа, сервер может сменить ключ на лету
+            self.session = (reply['cipher'], reply.get('compression'))
+            self.key_id = key_id
+            cipher = KeyedCipher({key_id: cipher}, key_id)
+        self.cipher = cipher
+        self.reader, self.writer = reader, writer
+        log.debug("Подключено к серверу%s", " (сессия возобновлена)" if resumed else "")
+        if self.on_connected is not None:
+            self.on_connected(resumed)
+        # Остальные кадры уже под шифром сессии
+        return frames[1:]
+
+    async def read_reply(self, reader):
+        frames = []
+        while not frames:
+            data = await reader.read(RECV_BUFFER_SIZE)
+            if not data:
+                raise ConnectionError("Сервер закрыл соединение при рукопожатии")
+            frames = self.decoder.feed(data)
+        return frames
+
+    async def receive(self, frames):
+        """Читает и расшифровывает кадры, пока соединение живо"""
+        reader = self.reader
+        try:
+            while True:
+                if not frames:
+                    if self.silence_timeout:
+                        data = await asyncio.wait_for(reader.read(RECV_BUFFER_SIZE), self.silence_timeout)
+                    else:
+                        data = await reader.read(RECV_BUFFER_SIZE)
+                    if not data:
+                        log.info("Соединение закрыто сервером")
+                        return
+                    # Кадры - срезы data, они разбираются до следующего чтения
+                    frames = self.decoder.feed(data)
+                messages = []
+                for msg_type, payload in frames:
+                    try:
+                        data = self.cipher.decrypt(payload)
+                    except UnknownKey as e:
+                        # Кадр с новым ключом пропал из очереди сервера: при переподключении
+                        # прежним ключом (он еще действует) сервер пришлет новый заново
+                        log.info("%s, переподключаемся", e)
+                        return
+                    except (InvalidToken, ValueError) as e:
+                        log.warning("Ошибка расшифровки: %s", e)
+                        continue
+                    if self.accept(msg_type, data):
+                        messages.append((msg_type, data))
+                frames = []
+                if not messages:
+                    continue
+                if self.on_frames is not None:
+                    self.on_frames(messages)
+                else:
+                    for message in messages:
+                        await self.inbox.put(message)  # Медленный читатель притормаживает прием
+        except (OSError, asyncio.TimeoutError, ProtocolError) as e:
+            log.info("Соединение потеряно: %s", e or type(e).__name__)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.error("Ошибка получения сообщения: %s", e)
+
+    def accept(self, msg_type, data):
+        """Служебная обработка кадра; False - кадр поглощен клиентом и не передается дальше"""
+        if msg_type == MSG_PING:
+            self.write_frame(MSG_PONG, data)
+            return False
+        if msg_type == MSG_REKEY:
+            self.rekey(json.loads(data))
+            return False
+        if msg_type == MSG_JOIN:
+            # Сервер перевел клиента в комнату: id считаются заново по ее истории
+            info = json.loads(data)
+            self.room = info.get('room')
+            self.last_id = None
+            if info.get('resume'):
+                self.resume_token = info['resume']
+        elif msg_type == MSG_ENTRY:
+            return self.seen(json.loads(data)['id'])  # Уже пришло со страницей пропущенных
+        elif msg_type == MSG_HISTORY_PAGE:
+            # Ответ на history(); опоздавший ответ на отмененный запрос просто выбрасывается
+            reply = json.loads(data)
+            self.resolve(self.history_requests, reply.get('id'), reply['entries'])
+            return False
+        elif msg_type == MSG_HISTORY:
+            # Страница без запроса: история комнаты при входе или пропущенное при возобновлении
+            entries = json.loads(data)
+            if entries and isinstance(entries[-1], dict):
+                self.seen(entries[-1]['id'])
+        elif msg_type == MSG_PRESENCE:
+            message = json.loads(data)
+            if 'members' in message:
+                self.resolve(self.presence_requests, message.get('id'), message['members'])
+                return False
+        return True
+
+    @staticmethod
+    def resolve(requests, request_id, result):
+        future = requests.pop(request_id, None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    def seen(self, entry_id):
+        """Отмечает запись истории как полученную; False, если она уже была"""
+        if self.last_id is not None and entry_id <= self.last_id:
+            return False
+        self.last_id = entry_id
+        return True
+
+    def rekey(self, message):
+        """Переходит на новый ключ сервера; прежний остается для кадров, уже зашифрованных им"""
+        key_id, key = message['key_id'], message['key'].encode()
+        backend, compression = self.session
+        previous = self.cipher.ciphers[self.cipher.current]
+        self.cipher = KeyedCipher({self.key_id: previous,
+                                   key_id: compressed_cipher(get_cipher(key, backend), compression)}, key_id)
+        self.key, self.key_id = key, key_id
+        if message.get('resume'):
+            self.resume_token = message['resume']
+        log.info("Сервер сменил ключ, новый номер %s", key_id)
+        if self.key_file is not None:
+            try:
+                update_key_file(self.key_file, key, key_id)
+            except (OSError, ValueError, KeyError) as e:
+                log.error("Не удалось сохранить новый ключ: %s", e)
+        if self.on_rekey is not None:
+            self.on_rekey(key_id, key)
+
+    def write_frame(self, msg_type, data):
+        """Шифрует кадр и ставит его в буфер сокета, не дожидаясь отправки"""
+        if self.writer is None:
+            raise ConnectionError("Нет соединения с сервером")
+        self.writer.write(encode_frame(msg_type, self.cipher.encrypt(data)))
+
+    async def send_frame(self, msg_type, data):
+        """Шифрует и отправляет кадр; ждет, пока буфер сокета разгрузится"""
+        self.write_frame(msg_type, data)
+        await self.writer.drain()
+
+    async def send(self, text):
+        """Отправляет текстовое сообщение в текущую комнату"""
+        await self.send_frame(MSG_TEXT, text.encode())
+
+    async def join(self, room):
+        """Переходит в комнату; сервер ответит кадром MSG_JOIN и историей комнаты"""
+        await self.send_frame(MSG_JOIN, json.dumps({'room': room}).encode())
+
+    async def leave(self):
+        """Возвращается в общую комнату"""
+        await self.send_frame(MSG_LEAVE, b'')
+
+    async def history(self, before=None, limit=50, after=None):
+        """Страница истории текущей комнаты старше записи before (или новее after): список записей.
+
+        Ответ сопоставляется запросу по номеру. Если он не пришел за
+        REQUEST_TIMEOUT (например, выброшен из переполненной очереди сервера),
+        - asyncio.TimeoutError.
+        """
+        request = {'before': before, 'limit': limit} if after is None else {'after': after, 'limit': limit}
+        return await self.request(self.history_requests, MSG_HISTORY_REQUEST, request)
+
+    async def presence(self):
+        """Ники участников текущей комнаты по алфавиту"""
+        return await self.request(self.presence_requests, MSG_PRESENCE, {})
+
+    async def request(self, requests, msg_type, request, timeout=REQUEST_TIMEOUT):
+        """Отправляет запрос с новым номером и ждет ответа с тем же номером"""
+        request_id = next(self.request_ids)
+        future = requests[request_id] = asyncio.get_running_loop().create_future()
+        try:
+            await self.send_frame(msg_type, json.dumps(dict(request, id=request_id)).encode())
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            requests.pop(request_id, None)
+
+    def close_writer(self):
+        """Закрывает сокет; ожидающие history() и presence() получают ConnectionError"""
+        writer, self.writer = self.writer, None
+        if writer is not None:
+            writer.close()
+        for requests in (self.history_requests, self.presence_requests):
+            for future in requests.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Соединение потеряно"))
+            requests.clear()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.inbox is None:
+            self.inbox = asyncio.Queue(INBOX_SIZE)
+        message = await self.inbox.get()
+        if message is None:
+            self.inbox.put_nowait(None)  # Остальные читатели тоже завершатся
+            raise StopAsyncIteration
+        return message
@@ -0,0 +1,348 @@
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import struct
+import tempfile
+import threading
+import time
+from multiprocessing.connection import wait
+from fanout import ClientOutbox, DISCONNECT
+from history import DEFAULT_ROOM, MAX_ROOMS, MemoryHistory, make_entry
+from logs import get_logger, setup_logging
+
+# Кадр шины между процессами: длина (4 байта, big-endian), вид события (1 байт), затем JSON события.
+# Вид читается без разбора JSON: супервизор пересылает обычные события как есть
+BUS_HEADER = struct.Struct('!IB')
+BUS_EVENT = 1  # Пересылается остальным процессам без изменений
+BUS_HISTORY = 2  # Новое сообщение истории: супервизор выдает id и рассылает запись всем процессам
+BUS_PRESENCE = 3  # Переходы присутствия процесса: пересылаются как есть, супервизор их запоминает
+EVENT_KINDS = {'presence': BUS_PRESENCE}  # Вид кадра по типу события, остальные - BUS_EVENT
+BUS_QUEUE_SIZE = 65536  # Кадров в очереди к рабочему процессу; отставший сильнее отключается от шины
+WORKER_START_TIMEOUT = 30.0  # Сколько ждать подключения рабочего процесса к шине, секунд
+BUS_LOST_EXIT = 3  # Код выхода рабочего процесса, потерявшего шину: супервизор запускает его заново
+RESTART_DELAY = 1.0  # Пауза перед перезапуском рабочего процесса, секунд
+
+log = get_logger('cluster')
+
+
+def encode_event(event, kind=BUS_EVENT):
+    """Упаковывает событие шины в кадр"""
+    payload = json.dumps(event).encode()
+    return BUS_HEADER.pack(len(payload), kind) + payload
+
+
+def read_frames(sock):
+    """Читает кадры шины из сокета, пока его не закроют: (вид, кадр целиком)"""
+    buffer = bytearray()
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return
+        buffer += data
+        offset = 0
+        while len(buffer) - offset >= BUS_HEADER.size:
+            length, kind = BUS_HEADER.unpack_from(buffer, offset)
+            end = offset + BUS_HEADER.size + length
+            if len(buffer) < end:
+                break
+            yield kind, bytes(buffer[offset:end])
+            offset = end
+        del buffer[:offset]
+
+
+def read_events(sock):
+    """Читает события шины из сокета, пока его не закроют"""
+    for _, frame in read_frames(sock):
+        yield json.loads(frame[BUS_HEADER.size:])
+
+
+class MessageBus:
+    """Шина в процессе-супервизоре: пересылает события каждого рабочего процесса остальным.
+
+    Записи истории в памяти нумеруются здесь и рассылаются всем процессам,
+    включая отправителя, в одном порядке — поэтому id и страницы истории
+    совпадают, к какому бы процессу ни подключился клиент.
+
+    Обычные события пересылаются готовым кадром, без разбора JSON. У каждого
+    процесса своя очередь и свой поток-писатель (fanout.ClientOutbox), поэтому
+    медленный процесс не задерживает остальных; под замком события только
+    получают порядок и id.
+
+    Процесс, отставший от шины, отключается от нее, завершается и запускается
+    заново (см. run_cluster). Поэтому супервизор хранит копию истории в памяти
+    (history) и присутствие каждого процесса: новый процесс сначала получает
+    их снимок, а остальные - выход всех участников потерянного процесса.
+    """
+
+    def __init__(self, path, queue_size=BUS_QUEUE_SIZE, history=None):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen()
+        self.queue_size = queue_size
+        self.history = history  # MemoryHistory; None, если процессы пишут историю в общий SQLite
+        self.workers = {}  # {соединение с рабочим процессом: его очередь отправки}
+        self.presence = {}  # {соединение: {комната: множество ников, подключенных к процессу}}
+        self.lock = threading.Condition()  # Общий порядок событий для всех процессов
+        self.ids = itertools.count(1)
+
+    def start(self):
+        thread = threading.Thread(target=self._accept, daemon=True)
+        thread.start()
+
+    def wait_for_workers(self, count, timeout=WORKER_START_TIMEOUT):
+        """Ждет, пока к шине подключатся count процессов; False по таймауту"""
+        with self.lock:
+            return self.lock.wait_for(lambda: len(self.workers) >= count, timeout)
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with self.lock:
+                outbox = self.workers[conn] = ClientOutbox(conn, self.queue_size, DISCONNECT)
+                self.presence[conn] = {}
+                self._send_snapshot(outbox)
+                self.lock.notify_all()
+            thread = threading.Thread(target=self._relay, args=(conn,), daemon=True)
+            thread.start()
+
+    def _relay(self, conn):
+        try:
+            for kind, frame in read_frames(conn):
+                if kind == BUS_HISTORY:
+                    event = json.loads(frame[BUS_HEADER.size:])
+                    with self.lock:
+                        entry = make_entry(next(self.ids), event['room'], event['text'])
+                        if self.history is not None:
+                            self.history.insert(entry)
+                        self._send(encode_event({'type': 'history', 'entry': entry}))
+                elif kind == BUS_PRESENCE:
+                    event = json.loads(frame[BUS_HEADER.size:])
+                    with self.lock:
+                        self._track_presence(conn, event)
+                        self._send(frame, exclude=conn)
+                else:
+                    with self.lock:
+                        self._send(frame, exclude=conn)
+        except (OSError, ValueError) as e:
+            log.error("Ошибка шины: %s", e)
+        finally:
+            with self.lock:
+                outbox = self.workers.pop(conn, None)
+                # Участники потерянного процесса для остальных вышли
+                for room, nicknames in self.presence.pop(conn, {}).items():
+                    self._send(encode_event({'type': 'presence', 'room': room,
+                                             'joined': [], 'left': sorted(nicknames)}, BUS_PRESENCE))
+            if outbox is not None:
+                outbox.close()
+            conn.close()
+
+    def _track_presence(self, conn, event):
+        """Запоминает переходы присутствия процесса conn; вызывается под self.lock"""
+        rooms = self.presence.setdefault(conn, {})
+        nicknames = rooms.setdefault(event['room'], set())
+        nicknames.update(event['joined'])
+        nicknames.difference_update(event['left'])
+        if not nicknames:
+            del rooms[event['room']]
+
+    def _send_snapshot(self, outbox):
+        """Новому процессу - история и участники остальных процессов; вызывается под self.lock"""
+        if self.history is not None:
+            for room, entries in self.history.entries_by_room():
+                outbox.put(encode_event({'type': 'history_snapshot', 'entries': entries}))
+        for rooms in self.presence.values():
+            for room, nicknames in rooms.items():
+                outbox.put(encode_event({'type': 'presence', 'room': room,
+                                         'joined': sorted(nicknames), 'left': []}, BUS_PRESENCE))
+
+    def _send(self, frame, exclude=None):
+        """Ставит кадр в очереди процессов; вызывается под self.lock, сокеты не трогает"""
+        for conn, outbox in self.workers.items():
+            if conn is not exclude:
+                outbox.put(frame)  # Переполненная очередь разрывает соединение, его уберет _relay
+
+    def close(self):
+        self.sock.close()
+        with self.lock:
+            for conn, outbox in self.workers.items():
+                outbox.close()
+                conn.close()
+            self.workers.clear()
+
+
+class BusClient:
+    """Подключение рабочего процесса к шине супервизора.
+
+    publish() только ставит кадр в очередь: в сокет пишет свой поток
+    (fanout.ClientOutbox), поэтому публиковать можно и из цикла событий.
+    Если шина потеряна, вызывается on_lost() из потока чтения.
+    """
+
+    def __init__(self, path, handler, on_lost=None, queue_size=BUS_QUEUE_SIZE):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.handler = handler  # Вызывается из потока чтения шины
+        self.on_lost = on_lost
+        self.closed = False
+        self.outbox = ClientOutbox(self.sock, queue_size, DISCONNECT)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def publish(self, event, kind=None):
+        """Отправляет событие остальным процессам, не дожидаясь сокета"""
+        if kind is None:
+            kind = EVENT_KINDS.get(event['type'], BUS_EVENT)
+        if not self.outbox.put(encode_event(event, kind)):
+            log.error("Событие %s не отправлено: шина потеряна", event['type'])
+
+    def _run(self):
+        try:
+            for event in read_events(self.sock):
+                try:
+                    self.handler(event)
+                except Exception as e:
+                    log.error("Ошибка обработки события шины: %s", e)
+        except OSError as e:
+            log.warning("Ошибка чтения шины: %s", e)
+        if not self.closed:
+            log.error("Соединение с шиной потеряно")
+            if self.on_lost is not None:
+                self.on_lost()
+
+    def close(self):
+        self.closed = True
+        self.outbox.close()
+        self.sock.close()
+
+
+class ReplicatedHistory:
+    """История в памяти, общая для всех процессов кластера.
+
+    append() ничего не пишет сам и возвращает None: сообщение уходит на шину,
+    супервизор выдает ему id и возвращает запись всем процессам (см. apply),
+    и каждый процесс рассылает ее своим клиентам.
+    """
+
+    def __init__(self, local, bus):
+        self.local = local
+        self.bus = bus
+
+    def append(self, text, room=DEFAULT_ROOM):
+        self.bus.publish({'type': 'history', 'room': room, 'text': text}, BUS_HISTORY)
+
+    def apply(self, entry):
+        """Добавляет запись, пронумерованную супервизором"""
+        self.local.insert(entry)
+
+    def page(self, *args, **kwargs):
+        return self.local.page(*args, **kwargs)
+
+    def page_after(self, *args, **kwargs):
+        return self.local.page_after(*args, **kwargs)
+
+    def revision(self, room=DEFAULT_ROOM):
+        return self.local.revision(room)
+
+    def close(self):
+        self.local.close()
+
+
+def run_worker(index, engine, options, bus_path, log_level='INFO'):
+    """Рабочий процесс: обычный сервер на общем порту, подключенный к шине"""
+    listener = setup_logging(log_level)
+    if options.get('metrics_port'):
+        # У каждого процесса свои метрики и своя страница на следующем порту
+        options = dict(options, metrics_port=options['metrics_port'] + index)
+    if engine == 'async':
+        from async_server import AsyncChatServer as server_class
+    else:
+        from server import ChatServer as server_class
+    server = server_class(reuse_port=True, **options)
+
+    def bus_lost():
+        # Без шины процесс разошелся бы с остальными: выходим, супервизор запустит новый.
+        # os._exit из потока шины не вызывает atexit, поэтому журнал дописываем сами
+        listener.stop()
+        os._exit(BUS_LOST_EXIT)
+
+    bus = BusClient(bus_path, server.handle_bus_event, on_lost=bus_lost)
+    if options.get('history_backend', 'memory') == 'memory':
+        # SQLite и так общий файл для всех процессов; память нужно синхронизировать
+        server.history = ReplicatedHistory(server.history, bus)
+    server.bus = bus
+    log.info("Рабочий процесс %s (pid %s) запущен", index, os.getpid())
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+def forward_signal(processes, signum):
+    for process in processes:
+        if process.is_alive():
+            os.kill(process.pid, signum)
+
+
+def run_cluster(workers, engine='thread', options=None, log_level='INFO'):
+    """Запускает workers процессов сервера на одном порту (SO_REUSEPORT) и шину между ними"""
+    if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(socket, 'AF_UNIX'):
+        raise RuntimeError("Режим нескольких процессов требует SO_REUSEPORT и Unix-сокетов")
+    options = dict(options or {})
+    history = None
+    if options.get('history_backend', 'memory') == 'memory':
+        history = MemoryHistory(options.get('max_history', 1000), options.get('max_rooms', MAX_ROOMS))
+    bus_dir = tempfile.mkdtemp(prefix='safespace-')
+    bus = MessageBus(os.path.join(bus_dir, 'bus.sock'), history=history)
+    bus.start()
+    context = multiprocessing.get_context('spawn')
+    processes = []
+
+    def start_worker(index):
+        process = context.Process(target=run_worker, args=(index, engine, options, bus.path, log_level),
+                                  daemon=True)
+        process.start()
+        return process
+
+    def terminate(signum, frame):
+        # SIGTERM останавливает и рабочие процессы; каталог шины удалит finally
+        forward_signal(processes, signum)
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        for index in range(workers):
+            processes.append(start_worker(index))
+            # Первый процесс создает key.2pk и хранилища, остальные стартуют после него
+            if index == 0 and not bus.wait_for_workers(1):
+                raise RuntimeError("Первый рабочий процесс не подключился к шине")
+        log.info("Запущено рабочих процессов: %s, движок: %s", workers, engine)
+        if hasattr(signal, 'SIGHUP'):
+            # Новый ключ перечитывают все процессы: файл общий, ключ у всех одинаковый
+            signal.signal(signal.SIGHUP, lambda signum, frame: forward_signal(processes, signum))
+        while True:
+            running = [process for process in processes if process.exitcode is None]
+            if not running:
+                break
+            wait([process.sentinel for process in running])
+            for index, process in enumerate(processes):
+                if process.exitcode == BUS_LOST_EXIT:
+                    log.warning("Рабочий процесс %s потерял шину, перезапуск", index)
+                    time.sleep(RESTART_DELAY)
+                    processes[index] = start_worker(index)
+    except KeyboardInterrupt:
+        log.info("Остановка кластера...")
+    finally:
+        for process in processes:
+            process.join(5.0)
+            if process.is_alive():
+                process.terminate()
+        bus.close()
+        shutil.rmtree(bus_dir, ignore_errors=True)
@@ -0,0 +1,120 @@
+import zlib
+from functools import lru_cache
+from protocol import MAX_FRAME_SIZE
+
+# Сжатие перед шифрованием, согласуется при рукопожатии так же, как шифр сессии.
+# В согласованной сессии открытый текст каждого кадра начинается с байта-метки.
+RAW_DEFLATE = 'deflate'  # deflate без заголовка и контрольной суммы zlib: выгоден и на коротких репликах
+ZLIB = 'zlib'  # Формат zlib, для клиентов и серверов без RAW_DEFLATE
+COMPRESSION_METHODS = (RAW_DEFLATE, ZLIB)  # В порядке предпочтения
+
+RAW = 0  # Данные без сжатия
+DEFLATE = 1  # zlib с общим словарем
+BARE_DEFLATE = 2  # deflate с общим словарем, без обертки zlib (метод RAW_DEFLATE)
+
+# Короче этого сжатие не окупается. Обертка zlib с номером словаря добавляет 10 байт,
+# и реплика вроде "bob: привет, как дела?" (35 байт) выигрывает только от 32 байт;
+# без обертки 11-19-байтные реплики сжимаются почти вдвое
+MIN_COMPRESS_SIZE = {RAW_DEFLATE: 12, ZLIB: 32}
+FAST_COMPRESS_SIZE = 64 * 1024  # Крупные данные (куски файлов) сжимаются быстрым уровнем
+
+# Общий словарь для коротких сообщений: служебные JSON-поля и частые фразы чата.
+# zlib лучше находит совпадения ближе к концу словаря, поэтому частое - в конце.
+# Меняется только вместе с названием метода: у клиента и сервера он должен совпадать.
+COMPRESSION_DICT = (
+    '{"file_id": "", "missing": [], "complete": false, "chunk_size": 262144, "chunks": ["'
+    '{"before": , "limit": 50}{"room": "'
+    ' присоединился к комнате  покинул комнату Добро пожаловать, '
+    ' присоединился к чату  покинул чат'
+    'привет, как дела? спасибо, хорошо, да, нет, сейчас, это, что, ок'
+    '", "name": "", "size": , "from": "'
+    '[{"id": , "room": "main", "ts": 1700000000.0, "text": "FILE:{\\"file_id\\": \\"'
+).encode()
+
+
+def negotiate_compression(offered, supported=COMPRESSION_METHODS):
+    """Выбирает первый метод сжатия сервера, который предложил клиент; None - без сжатия"""
+    for method in supported:
+        if method in offered:
+            return method
+    return None
+
+
+def compress(data, method=ZLIB):
+    """Сжимает данные, если это выгодно: метка + данные"""
+    if len(data) >= MIN_COMPRESS_SIZE[method]:
+        level = 1 if len(data) >= FAST_COMPRESS_SIZE else 6
+        bare = method == RAW_DEFLATE
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS if bare else zlib.MAX_WBITS,
+                                      zdict=COMPRESSION_DICT)
+        packed = compressor.compress(data) + compressor.flush()
+        if len(packed) < len(data):
+            return bytes((BARE_DEFLATE if bare else DEFLATE,)) + packed
+    return bytes((RAW,)) + data
+
+
+def decompress(data, max_size=MAX_FRAME_SIZE):
+    """Разбирает метку и распаковывает данные не больше max_size байт"""
+    view = memoryview(data)
+    if not view:
+        raise ValueError("Пустой кадр в сессии со сжатием")
+    if view[0] == RAW:
+        return bytes(view[1:])
+    if view[0] == DEFLATE:
+        wbits = zlib.MAX_WBITS
+    elif view[0] == BARE_DEFLATE:
+        wbits = -zlib.MAX_WBITS
+    else:
+        raise ValueError(f"Неизвестная метка сжатия: {view[0]}")
+    decompressor = zlib.decompressobj(wbits, zdict=COMPRESSION_DICT)
+    result = decompressor.decompress(view[1:], max_size)
+    if decompressor.unconsumed_tail:
+        raise ValueError("Распакованный кадр слишком большой")
+    return result
+
+
+def encrypt_uncompressed(cipher, data):
+    """Шифрует без сжатия и в сессии со сжатием.
+
+    Для кадров, где рядом чужие тексты (страницы истории): по длине сжатого
+    кадра можно было бы угадывать их содержимое, подбирая свои сообщения.
+    """
+    return getattr(cipher, 'encrypt_uncompressed', cipher.encrypt)(data)
+
+
+class CompressedCipher:
+    """Шифр сессии со сжатием открытого текста перед шифрованием"""
+
+    def __init__(self, cipher, method=ZLIB):
+        self.cipher = cipher
+        self.method = method
+        self.name = cipher.name
+
+    def encrypt(self, data):
+        return self.cipher.encrypt(compress(data, self.method))
+
+    def encrypt_uncompressed(self, data):
+        return self.cipher.encrypt(bytes((RAW,)) + data)
+
+    def decrypt(self, token):
+        return decompress(self.cipher.decrypt(token))
+
+    def encrypt_many(self, items):
+        return self.cipher.encrypt_many(compress(data, self.method) for data in items)
+
+    def decrypt_many(self, tokens):
+        return [decompress(data) for data in self.cipher.decrypt_many(tokens)]
+
+
+@lru_cache(maxsize=64)
+def compressed_cipher(cipher, method=None):
+    """Шифр сессии с согласованным сжатием; один объект на пару (шифр, метод).
+
+    Рассылка шифрует сообщение один раз на объект шифра, поэтому клиенты
+    с одинаковыми шифром и сжатием получают одни и те же байты.
+    """
+    if method is None:
+        return cipher
+    if method in (RAW_DEFLATE, ZLIB):
+        return CompressedCipher(cipher, method)
+    raise ValueError(f"Неизвестный метод сжатия: {method}")
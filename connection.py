@@ -0,0 +1,107 @@
+import asyncio
+import concurrent.futures
+import threading
+from client import ChatClient
+from logs import get_logger
+
+log = get_logger('connection')
+
+SEND_TIMEOUT = 30.0  # Сколько send_frame_wait() ждет, пока кадр уйдет в сокет, секунд
+
+
+class ClientConnection:
+    """ChatClient (client.py) в фоновом потоке со своим циклом событий - для GUI.
+
+    Колбэки вызываются из потока соединения:
+    on_frames([(тип, расшифрованные данные)]) - кадры одного чтения из сокета,
+    on_connected(resumed) - рукопожатие завершено, resumed - сессия возобновлена,
+    on_disconnected(delay) - соединение потеряно, следующая попытка через delay секунд,
+    on_rekey(key_id, key) - сервер сменил ключ (MSG_REKEY).
+
+    send_frame(), request_history() и request_presence() можно вызывать из любого потока
+    и не ждут сети; send_frame_wait() - только из рабочих потоков (например, загрузки файла).
+    """
+
+    def __init__(self, host, port, key, nickname, on_frames, on_connected, on_disconnected,
+                 key_id=None, key_file=None, on_rekey=None):
+        self.client = ChatClient(host, port, key, nickname, key_id=key_id, key_file=key_file,
+                                 on_frames=on_frames, on_connected=on_connected,
+                                 on_disconnected=on_disconnected, on_rekey=on_rekey)
+        self.loop = asyncio.new_event_loop()
+        self.thread = None
+
+    def start(self):
+        self.client.task = self.loop.create_task(self.client.run())
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        try:
+            self.loop.call_soon_threadsafe(self.client.task.cancel)
+        except RuntimeError:
+            pass  # Цикл уже остановлен
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.client.task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.loop.close()
+
+    def send_frame(self, msg_type, data, on_error=None):
+        """Шифрует и отправляет кадр, не дожидаясь сети.
+
+        Ошибку отправки получает on_error(исключение) - из потока соединения.
+        """
+        if threading.current_thread() is self.thread:
+            # Из колбэка соединения: ждать самого себя нельзя
+            self.client.write_frame(msg_type, data)
+            return
+
+        def done(future):
+            try:
+                future.result()
+            except Exception as e:
+                log.error("Ошибка отправки кадра: %s", e)
+                if on_error is not None:
+                    on_error(e)
+
+        self.submit(self.client.send_frame(msg_type, data)).add_done_callback(done)
+
+    def send_frame_wait(self, msg_type, data, timeout=SEND_TIMEOUT):
+        """Отправляет кадр и ждет, пока буфер сокета разгрузится, но не дольше timeout секунд"""
+        future = self.submit(self.client.send_frame(msg_type, data))
+        try:
+            future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise ConnectionError("Сервер не принимает данные") from None
+
+    def submit(self, coroutine):
+        """Запускает корутину в цикле соединения из другого потока"""
+        if self.loop.is_closed():
+            coroutine.close()
+            raise ConnectionError("Нет соединения с сервером")
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def request_history(self, before, limit, callback, after=None):
+        """Запрашивает страницу истории; callback(записи или None при ошибке) - из потока соединения"""
+        self.request(self.client.history(before, limit, after), callback, "истории")
+
+    def request_presence(self, callback):
+        """Запрашивает участников комнаты; callback(ники или None при ошибке) - из потока соединения"""
+        self.request(self.client.presence(), callback, "участников комнаты")
+
+    def request(self, coroutine, callback, what):
+        def done(future):
+            try:
+                result = future.result()
+            except Exception as e:
+                log.error("Ошибка запроса %s: %s", what, e or type(e).__name__)
+                result = None
+            callback(result)
+
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        future.add_done_callback(done)
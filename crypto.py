@@ -3,41 +3,262 @@ import string
 import hashlib
 import os
 import json
-from cryptography.fernet import Fernet
+import time
+from functools import lru_cache
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 import base64
 
+# Шифры сессии. Fernet используется для рукопожатия и как запасной вариант,
+# AEAD-шифры обходятся без base64 и отдельного HMAC
+FERNET = 'fernet'
+AES_GCM = 'aes-gcm'
+CHACHA20_POLY1305 = 'chacha20-poly1305'
+CIPHER_BACKENDS = (AES_GCM, CHACHA20_POLY1305, FERNET)  # В порядке предпочтения
+
+# Смена ключа сервера без разрыва сессий: у каждого ключа номер (0-255).
+# Рукопожатие с номером: KEYED_HELLO + номер (1 байт) + токен Fernet; старые
+# клиенты присылают просто токен (он начинается с b'g')
+KEYED_HELLO = b'K'
+KEY_GRACE = 24 * 3600  # Сколько секунд после смены принимается прежний ключ
+
+class UnknownKey(InvalidToken):
+    """Кадр зашифрован ключом, которого нет среди действующих"""
+
+class FernetCipher:
+    """Шифр Fernet с однажды разобранным ключом"""
+    name = FERNET
+
+    def __init__(self, key):
+        self._fernet = Fernet(key)
+
+    def encrypt(self, data):
+        return self._fernet.encrypt(data)
+
+    def decrypt(self, token):
+        # Fernet принимает только bytes/str, срезы memoryview приходится копировать
+        if not isinstance(token, bytes):
+            token = bytes(token)
+        return self._fernet.decrypt(token)
+
+    def encrypt_many(self, items):
+        """Шифрует набор сообщений"""
+        return [self._fernet.encrypt(data) for data in items]
+
+    def decrypt_many(self, tokens):
+        """Расшифровывает набор токенов"""
+        return [self.decrypt(token) for token in tokens]
+
+class AEADCipher:
+    """AES-GCM или ChaCha20-Poly1305: nonce (12 байт) + шифртекст с тегом"""
+    NONCE_SIZE = 12
+    ALGORITHMS = {AES_GCM: AESGCM, CHACHA20_POLY1305: ChaCha20Poly1305}
+
+    def __init__(self, key, name=AES_GCM):
+        self.name = name
+        # Из общего ключа выводим отдельный ключ для каждого алгоритма
+        hkdf = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=b'safespace ' + name.encode()
+        )
+        self._aead = self.ALGORITHMS[name](hkdf.derive(base64.urlsafe_b64decode(key)))
+
+    def encrypt(self, data):
+        nonce = os.urandom(self.NONCE_SIZE)
+        return nonce + self._aead.encrypt(nonce, data, None)
+
+    def decrypt(self, token):
+        # Принимает и срезы memoryview, без копирования
+        token = memoryview(token)
+        try:
+            return self._aead.decrypt(token[:self.NONCE_SIZE], token[self.NONCE_SIZE:], None)
+        except InvalidTag:
+            raise InvalidToken
+
+    def encrypt_many(self, items):
+        """Шифрует набор сообщений"""
+        return [self.encrypt(data) for data in items]
+
+    def decrypt_many(self, tokens):
+        """Расшифровывает набор токенов"""
+        return [self.decrypt(token) for token in tokens]
+
+class KeyedCipher:
+    """Шифр сессии с несколькими ключами: перед шифртекстом номер ключа (1 байт).
+
+    Шифрует всегда текущий ключ, а расшифровка выбирает шифр по номеру из
+    кадра одним поиском в словаре, без перебора ключей. Номер с истекшим
+    сроком (expires) не принимается.
+    """
+
+    def __init__(self, ciphers, current, expires=None):
+        self.ciphers = ciphers  # {номер ключа: шифр}
+        self.current = current
+        self.expires = expires or {}  # {номер ключа: time.time() конца льготного срока}
+        self.name = ciphers[current].name
+        self._cipher = ciphers[current]
+        self._prefix = bytes([current])
+
+    def encrypt(self, data):
+        return self._prefix + self._cipher.encrypt(data)
+
+    def encrypt_uncompressed(self, data):
+        """См. compression.encrypt_uncompressed"""
+        return self._prefix + getattr(self._cipher, 'encrypt_uncompressed', self._cipher.encrypt)(data)
+
+    def decrypt(self, token):
+        token = memoryview(token)
+        if not token:
+            raise InvalidToken
+        key_id = token[0]
+        cipher = self.ciphers.get(key_id)
+        expires = self.expires.get(key_id)
+        if cipher is None or (expires is not None and time.time() > expires):
+            raise UnknownKey(f"Неизвестный номер ключа: {key_id}")
+        return cipher.decrypt(token[1:])
+
+    def encrypt_many(self, items):
+        """Шифрует набор сообщений"""
+        return [self.encrypt(data) for data in items]
+
+    def decrypt_many(self, tokens):
+        """Расшифровывает набор токенов"""
+        return [self.decrypt(token) for token in tokens]
+
+class KeyRing:
+    """Ключи сервера: текущий и прежние, которые принимаются до конца льготного срока"""
+
+    def __init__(self, keys, current, expires=None):
+        self.keys = keys  # {номер: ключ}
+        self.current = current
+        self.expires = expires or {}  # {номер прежнего ключа: time.time() конца срока}
+
+    @classmethod
+    def from_file_data(cls, data):
+        """Ключи из содержимого key.2pk; файлы без номера ключа считаются ключом 0"""
+        current = data.get('key_id', 0)
+        keys = {current: data['key'].encode()}
+        expires = {}
+        for item in data.get('previous_keys', []):
+            if item['key_id'] != current and item['expires'] > time.time():
+                keys[item['key_id']] = item['key'].encode()
+                expires[item['key_id']] = item['expires']
+        return cls(keys, current, expires)
+
+    @property
+    def current_key(self):
+        return self.keys[self.current]
+
+    def get(self, key_id):
+        """Ключ по номеру; None, если такого нет или его срок истек"""
+        key = self.keys.get(key_id)
+        expires = self.expires.get(key_id)
+        if key is None or (expires is not None and time.time() > expires):
+            return None
+        return key
+
+    def open_hello(self, payload):
+        """Расшифровывает кадр рукопожатия; возвращает (номер ключа, данные)"""
+        payload = bytes(payload)
+        if payload[:1] == KEYED_HELLO and len(payload) > 2:
+            key = self.get(payload[1])
+            if key is None:
+                raise UnknownKey(f"Неизвестный номер ключа: {payload[1]}")
+            return payload[1], get_cipher(key).decrypt(payload[2:])
+        # Старые клиенты не сообщают номер: текущий ключ, затем прежние (только при рукопожатии)
+        for key_id in [self.current] + [key_id for key_id in self.keys if key_id != self.current]:
+            key = self.get(key_id)
+            if key is None:
+                continue
+            try:
+                return key_id, get_cipher(key).decrypt(payload)
+            except InvalidToken:
+                continue
+        raise InvalidToken
+
+    def keyed_cipher(self, wrap, current=None):
+        """KeyedCipher по всем действующим ключам; wrap(ключ) - шифр сессии для ключа.
+
+        current - каким ключом шифровать (по умолчанию текущим ключом сервера).
+        """
+        ciphers = {key_id: wrap(key) for key_id, key in self.keys.items() if self.get(key_id) is not None}
+        if current not in ciphers:
+            current = self.current
+        return KeyedCipher(ciphers, current, self.expires)
+
+    def seal(self, data):
+        """Шифрует данные текущим ключом; в начале токена - номер ключа"""
+        return f"{self.current}.{get_cipher(self.current_key).encrypt(data).decode()}"
+
+    def unseal(self, token):
+        """Расшифровывает токен seal(); токены без номера - текущим ключом"""
+        key_id, _, sealed = token.rpartition('.')
+        if not key_id:
+            key = self.current_key  # Токен, выданный до появления номеров ключей
+        else:
+            key = self.get(int(key_id)) if key_id.isdigit() else None
+        if key is None:
+            raise InvalidToken
+        return get_cipher(key).decrypt(sealed.encode())
+
+@lru_cache(maxsize=64)
+def _cached_cipher(key, backend):
+    if backend == FERNET:
+        return FernetCipher(key)
+    if backend in AEADCipher.ALGORITHMS:
+        return AEADCipher(key, backend)
+    raise ValueError(f"Неизвестный шифр: {backend}")
+
+def get_cipher(key, backend=FERNET):
+    """Возвращает шифр для ключа; объект создается один раз и переиспользуется"""
+    if isinstance(key, str):
+        key = key.encode()
+    return _cached_cipher(key, backend)
+
+def negotiate_cipher(offered, supported=CIPHER_BACKENDS):
+    """Выбирает первый из поддерживаемых шифров, предложенный клиентом"""
+    for name in supported:
+        if name in offered:
+            return name
+    return FERNET
+
+def encrypt_many(items, key, backend=FERNET):
+    """Шифрует набор сообщений одним шифром"""
+    return get_cipher(key, backend).encrypt_many(
+        item.encode() if isinstance(item, str) else item for item in items
+    )
+
+def decrypt_many(tokens, key, backend=FERNET):
+    """Расшифровывает набор токенов одним шифром"""
+    return [data.decode() for data in get_cipher(key, backend).decrypt_many(tokens)]
+
 def generate_encryption_key():
     """Генерирует ключ шифрования"""
     return base64.urlsafe_b64encode(os.urandom(32))
 
 def encrypt_ip(ip, key):
     """Шифрует IP-адрес с помощью ключа"""
-    f = Fernet(key)
-    return f.encrypt(ip.encode())
+    return get_cipher(key).encrypt(ip.encode())
 
 def decrypt_ip(encrypted_ip, key):
     """Расшифровывает IP-адрес с помощью ключа"""
-    f = Fernet(key)
-    return f.decrypt(encrypted_ip).decode()
+    return get_cipher(key).decrypt(encrypted_ip).decode()
 
 def encrypt_data(data, key):
     """Шифрует данные с использованием ключа"""
-    if isinstance(key, str):
-        key = key.encode()
     if isinstance(data, str):
         data = data.encode()
-    f = Fernet(key)
-    return f.encrypt(data)
+    return get_cipher(key).encrypt(data)
 
 def decrypt_data(encrypted_data, key):
     """Расшифровывает данные с использованием ключа"""
-    if isinstance(key, str):
-        key = key.encode()
-    f = Fernet(key)
-    decrypted_data = f.decrypt(encrypted_data)
-    return decrypted_data.decode()
+    return get_cipher(key).decrypt(encrypted_data).decode()
 
 def save_key_to_file(server_ip, filename):
     """Сохраняет ключ и зашифрованный IP в файл"""
@@ -60,6 +281,46 @@ def load_key_from_file(filename):
     ip = decrypt_ip(encrypted_ip, key)
     return key, ip
 
+def rotate_key_file(filename, grace=KEY_GRACE):
+    """Записывает в key.2pk новый ключ; прежний принимается еще grace секунд.
+
+    Сервер перечитывает файл по SIGHUP и рассылает новый ключ подключенным клиентам.
+    """
+    with open(filename, 'r') as f:
+        data = json.load(f)
+    now = time.time()
+    old_id = data.get('key_id', 0)
+    key_id = (old_id + 1) % 256
+    previous = [item for item in data.get('previous_keys', [])
+                if item['expires'] > now and item['key_id'] not in (old_id, key_id)]
+    previous.append({'key_id': old_id, 'key': data['key'], 'expires': now + grace})
+    ip = decrypt_ip(base64.b64decode(data['encrypted_ip']), data['key'])
+    key = generate_encryption_key()
+    data = {
+        'key': key.decode(),
+        'key_id': key_id,
+        'encrypted_ip': base64.b64encode(encrypt_ip(ip, key)).decode(),
+        'previous_keys': previous
+    }
+    replace_key_file(filename, data)
+    return key_id, key
+
+def update_key_file(filename, key, key_id):
+    """Записывает в файл ключа клиента новый ключ сервера, полученный по MSG_REKEY"""
+    with open(filename, 'r') as f:
+        data = json.load(f)
+    ip = decrypt_ip(base64.b64decode(data['encrypted_ip']), data['key'])
+    data.update(key=key.decode(), key_id=key_id,
+                encrypted_ip=base64.b64encode(encrypt_ip(ip, key)).decode())
+    replace_key_file(filename, data)
+
+def replace_key_file(filename, data):
+    """Перезаписывает файл ключа через временный файл: прерванная запись не испортит ключ"""
+    temp = filename + '.tmp'
+    with open(temp, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp, filename)
+
 def generate_password():
     """Генерирует случайный пароль"""
     return ''.join(random.choices(string.ascii_letters + string.digits, k=16)) 
\ No newline at end of file
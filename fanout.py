@@ -0,0 +1,176 @@
+import asyncio
+import socket
+import threading
+from collections import deque
+
+# Политики для медленных клиентов, у которых переполнилась очередь отправки
+DROP_OLDEST = 'drop_oldest'  # Выбрасывать самые старые кадры
+DISCONNECT = 'disconnect'  # Отключать клиента
+BACKPRESSURE = 'backpressure'  # Притормаживать отправителя, пока очередь не освободится
+
+SLOW_CLIENT_POLICIES = (DROP_OLDEST, DISCONNECT, BACKPRESSURE)
+
+
+class ClientOutbox:
+    """Ограниченная очередь исходящих кадров клиента со своим потоком-писателем.
+
+    Кадры в очереди — неизменяемые bytes, один и тот же объект кладется
+    всем получателям. Ошибка отправки не вызывает рассылку: писатель только
+    закрывает сокет на чтение и запись, а удаление клиента выполняет поток
+    чтения, когда получит конец потока.
+    """
+
+    def __init__(self, sock, maxsize=256, policy=DROP_OLDEST, block_timeout=5.0):
+        self.sock = sock
+        self.maxsize = maxsize
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, frame):
+        """Ставит кадр в очередь; False, если клиент отключен"""
+        with self.cond:
+            if self.closed:
+                return False
+            if len(self.queue) >= self.maxsize:
+                if self.policy == DROP_OLDEST:
+                    self.queue.popleft()
+                    self.dropped += 1
+                elif self.policy == DISCONNECT:
+                    self._abort()
+                    return False
+                else:
+                    has_space = self.cond.wait_for(
+                        lambda: self.closed or len(self.queue) < self.maxsize,
+                        self.block_timeout
+                    )
+                    if not has_space:
+                        self._abort()
+                    if self.closed:
+                        return False
+            self.queue.append(frame)
+            self.cond.notify_all()
+            return True
+
+    def close(self):
+        """Останавливает писателя, не дожидаясь отправки очереди"""
+        with self.cond:
+            self.closed = True
+            self.queue.clear()
+            self.cond.notify_all()
+
+    def _abort(self):
+        """Прерывает соединение; вызывается под self.cond"""
+        self.closed = True
+        self.queue.clear()
+        self.cond.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.closed or self.queue)
+                if self.closed:
+                    return
+                # Забираем все накопленное и отправляем одним системным вызовом
+                batch = list(self.queue)
+                self.queue.clear()
+                self.cond.notify_all()
+            try:
+                self.sock.sendall(b''.join(batch))
+            except OSError:
+                with self.cond:
+                    self._abort()
+                return
+
+
+class AsyncClientOutbox:
+    """Ограниченная очередь исходящих кадров клиента для asyncio-сервера.
+
+    put() не блокирует цикл событий. При политике BACKPRESSURE очередь
+    может временно превысить предел, а сервер перестает читать от
+    отправителя, пока получатель не освободит место (см. wait_for_space).
+    Переполненная очередь сама добавляет себя в общий набор congested и
+    убирает из него, освободившись: отправителю не нужно обходить всех
+    участников комнаты.
+    """
+
+    def __init__(self, writer, maxsize=256, policy=DROP_OLDEST, block_timeout=5.0, congested=None):
+        self.writer = writer
+        self.congested_set = congested if congested is not None else set()
+        self.maxsize = maxsize
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.queue = deque()
+        self.wakeup = asyncio.Event()
+        self.space = asyncio.Event()
+        self.space.set()
+        self.closed = False
+        self.dropped = 0
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def put(self, frame):
+        """Ставит кадр в очередь; False, если клиент отключен"""
+        if self.closed:
+            return False
+        if len(self.queue) >= self.maxsize:
+            if self.policy == DROP_OLDEST:
+                self.queue.popleft()
+                self.dropped += 1
+            elif self.policy == DISCONNECT:
+                self._abort()
+                return False
+            elif self.space.is_set():
+                self.space.clear()
+                self.congested_set.add(self)
+        self.queue.append(frame)
+        self.wakeup.set()
+        return True
+
+    def congested(self):
+        """Очередь переполнена и отправителя нужно притормозить"""
+        return not self.closed and not self.space.is_set()
+
+    async def wait_for_space(self):
+        """Ждет освобождения очереди; отключает клиента по таймауту"""
+        try:
+            await asyncio.wait_for(self.space.wait(), self.block_timeout)
+        except asyncio.TimeoutError:
+            self._abort()
+
+    def close(self):
+        """Останавливает писателя, не дожидаясь отправки очереди"""
+        self.closed = True
+        self.queue.clear()
+        self._release()
+        self.wakeup.set()
+
+    def _release(self):
+        self.space.set()
+        self.congested_set.discard(self)
+
+    def _abort(self):
+        self.close()
+        self.writer.close()
+
+    async def _run(self):
+        try:
+            while not self.closed:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.queue and not self.closed:
+                    batch = list(self.queue)
+                    self.queue.clear()
+                    self._release()
+                    self.writer.writelines(batch)
+                    await self.writer.drain()
+        except (ConnectionError, OSError):
+            self._abort()
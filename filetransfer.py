@@ -0,0 +1,301 @@
+import base64
+import binascii
+import hashlib
+import json
+import os
+import re
+import struct
+import threading
+
+CHUNK_SIZE = 256 * 1024  # Размер куска файла по умолчанию
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+MAX_FILE_SIZE = 2 * 1024 * 1024 * 1024
+DOWNLOAD_WINDOW = 8  # Сколько кусков клиент запрашивает за раз
+
+HASH_PATTERN = re.compile('[0-9a-f]{64}')  # sha256 в виде hexdigest()
+
+# Открытый текст кадра MSG_FILE_CHUNK: sha256 файла (32 байта), номер куска, данные
+CHUNK_HEADER = struct.Struct('!32sI')
+
+
+def pack_chunk(file_id, index, data):
+    """Упаковывает кусок файла для отправки"""
+    return CHUNK_HEADER.pack(bytes.fromhex(file_id), index) + data
+
+
+def unpack_chunk(payload):
+    """Разбирает кусок файла: (file_id, номер, данные без копирования)"""
+    view = memoryview(payload)
+    digest, index = CHUNK_HEADER.unpack_from(view)
+    return digest.hex(), index, view[CHUNK_HEADER.size:]
+
+
+def describe_file(path, chunk_size=CHUNK_SIZE):
+    """Читает файл один раз и строит манифест: хэш файла и хэши кусков"""
+    file_hash = hashlib.sha256()
+    chunks = []
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            file_hash.update(data)
+            chunks.append(hashlib.sha256(data).hexdigest())
+            size += len(data)
+    return {
+        'file_id': file_hash.hexdigest(),
+        'name': os.path.basename(path),
+        'size': size,
+        'chunk_size': chunk_size,
+        'chunks': chunks
+    }
+
+
+def iter_chunks(path, chunk_size, indexes):
+    """Читает с диска только нужные куски файла"""
+    with open(path, 'rb') as f:
+        for index in indexes:
+            f.seek(index * chunk_size)
+            yield index, f.read(chunk_size)
+
+
+def validate_hash(value):
+    """Проверяет, что значение - sha256 в нижнем регистре, как его пишет hexdigest()"""
+    if not isinstance(value, str) or not HASH_PATTERN.fullmatch(value):
+        raise ValueError(f"Недопустимый хэш: {value!r:.80}")
+    return value
+
+
+def validate_manifest(manifest):
+    """Проверяет манифест, присланный клиентом"""
+    size = int(manifest['size'])
+    chunk_size = int(manifest['chunk_size'])
+    chunks = manifest['chunks']
+    if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+        raise ValueError(f"Недопустимый размер куска: {chunk_size}")
+    if not 0 <= size <= MAX_FILE_SIZE:
+        raise ValueError(f"Недопустимый размер файла: {size}")
+    if len(chunks) != (size + chunk_size - 1) // chunk_size:
+        raise ValueError("Число кусков не совпадает с размером файла")
+    validate_hash(manifest['file_id'])
+    for chunk_hash in chunks:
+        validate_hash(chunk_hash)
+    return {
+        'file_id': manifest['file_id'],
+        'name': os.path.basename(str(manifest['name'])) or 'file',
+        'size': size,
+        'chunk_size': chunk_size,
+        'chunks': list(chunks)
+    }
+
+
+def parse_legacy_file(text):
+    """Файл старого клиента из текста кадра (с меткой "FILE:" или без): {"data"} или {"file_id"}; None - не файл"""
+    if text.startswith("FILE:"):
+        text = text[5:]
+    try:
+        file_data = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(file_data, dict):
+        return None
+    if isinstance(file_data.get('data'), str) or isinstance(file_data.get('file_id'), str):
+        return file_data
+    return None
+
+
+def file_reference(manifest, sender=None):
+    """Короткая ссылка на файл для истории и рассылки"""
+    reference = {'file_id': manifest['file_id'], 'name': manifest['name'], 'size': manifest['size']}
+    if sender is not None:
+        reference['from'] = sender
+    return reference
+
+
+class ChunkStore:
+    """Хранилище кусков на диске с адресацией по sha256 содержимого.
+
+    Одинаковые куски разных файлов хранятся один раз. Манифест файла
+    лежит отдельно и ссылается на куски по хэшам.
+    """
+
+    def __init__(self, root='files'):
+        self.root = root
+        self.chunks_dir = os.path.join(root, 'chunks')
+        self.manifests_dir = os.path.join(root, 'manifests')
+        os.makedirs(self.chunks_dir, exist_ok=True)
+        os.makedirs(self.manifests_dir, exist_ok=True)
+
+    def chunk_path(self, chunk_hash):
+        return os.path.join(self.chunks_dir, chunk_hash[:2], chunk_hash)
+
+    def manifest_path(self, file_id):
+        return os.path.join(self.manifests_dir, file_id + '.json')
+
+    def has_chunk(self, chunk_hash):
+        return os.path.exists(self.chunk_path(chunk_hash))
+
+    def put_chunk(self, chunk_hash, data):
+        """Сохраняет кусок, если его хэш совпадает с ожидаемым"""
+        if hashlib.sha256(data).hexdigest() != chunk_hash:
+            raise ValueError("Хэш куска не совпадает")
+        path = self.chunk_path(chunk_hash)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get_chunk(self, chunk_hash):
+        with open(self.chunk_path(chunk_hash), 'rb') as f:
+            return f.read()
+
+    def save_manifest(self, manifest):
+        path = self.manifest_path(manifest['file_id'])
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, path)
+
+    def load_manifest(self, file_id):
+        """Возвращает манифест или None"""
+        validate_hash(file_id)  # Не даем подставить путь вместо хэша
+        try:
+            with open(self.manifest_path(file_id), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def missing_chunks(self, manifest):
+        """Номера кусков, которых еще нет на диске"""
+        return [index for index, chunk_hash in enumerate(manifest['chunks'])
+                if not self.has_chunk(chunk_hash)]
+
+    def verify_file(self, manifest):
+        """Проверяет хэш собранного файла, читая куски по одному"""
+        file_hash = hashlib.sha256()
+        for chunk_hash in manifest['chunks']:
+            file_hash.update(self.get_chunk(chunk_hash))
+        return file_hash.hexdigest() == manifest['file_id']
+
+    def prepare_upload(self, manifest):
+        """Сохраняет манифест загрузки (или берет уже сохраненный): (манифест, номера недостающих кусков)"""
+        stored = self.load_manifest(manifest['file_id'])
+        if stored is None or stored['chunks'] != manifest['chunks']:
+            self.save_manifest(manifest)
+        else:
+            manifest = stored
+        return manifest, self.missing_chunks(manifest)
+
+    def finish_upload(self, manifest):
+        """Проверяет собранный файл и отмечает его готовым; False, если хэш не совпал"""
+        if manifest.get('complete'):
+            return True
+        if not self.verify_file(manifest):
+            return False
+        manifest['complete'] = True
+        self.save_manifest(manifest)
+        return True
+
+    def read_request(self, file_id, indexes, limit):
+        """Ответ на запрос файла: (готовый манифест или None, [(номер, кусок)] или None - нужен только манифест)"""
+        manifest = self.load_manifest(file_id)
+        if manifest is None or not manifest.get('complete'):
+            return None, None
+        if indexes is None:
+            return manifest, None
+        chunks = [(index, self.get_chunk(manifest['chunks'][index]))
+                  for index in indexes[:limit] if 0 <= index < len(manifest['chunks'])]
+        return manifest, chunks
+
+    def legacy_manifest(self, file_data):
+        """Манифест файла старого клиента (см. parse_legacy_file): содержимое сохраняется,
+        а file_id должен указывать на готовый файл хранилища; None - ссылаться не на что"""
+        if isinstance(file_data.get('data'), str):
+            try:
+                data = base64.b64decode(file_data['data'], validate=True)
+            except binascii.Error:
+                return None
+            name = file_data.get('name')
+            return self.put_bytes(name if isinstance(name, str) else 'file', data)
+        try:
+            manifest = self.load_manifest(file_data['file_id'])
+        except ValueError:
+            return None
+        if manifest is None or not manifest.get('complete'):
+            return None
+        return manifest
+
+    def put_bytes(self, name, data, chunk_size=CHUNK_SIZE):
+        """Сохраняет файл, целиком пришедший в памяти, и возвращает манифест"""
+        chunks = []
+        for offset in range(0, len(data), chunk_size):
+            chunk = data[offset:offset + chunk_size]
+            chunk_hash = hashlib.sha256(chunk).hexdigest()
+            self.put_chunk(chunk_hash, chunk)
+            chunks.append(chunk_hash)
+        manifest = {
+            'file_id': hashlib.sha256(data).hexdigest(),
+            'name': os.path.basename(name) or 'file',
+            'size': len(data),
+            'chunk_size': chunk_size,
+            'chunks': chunks,
+            'complete': True
+        }
+        self.save_manifest(manifest)
+        return manifest
+
+
+class FileDownload:
+    """Скачивание файла по кускам в файл .part с докачкой.
+
+    При повторном запуске уже записанные куски проверяются по хэшам
+    и не запрашиваются снова.
+    """
+
+    def __init__(self, manifest, target_path):
+        self.manifest = manifest
+        self.target_path = target_path
+        self.part_path = target_path + '.part'
+        self.received = set()
+        self.requested = set()  # Окно кусков, запрошенных и еще не полученных
+        mode = 'r+b' if os.path.exists(self.part_path) else 'w+b'
+        self.file = open(self.part_path, mode)
+        self._scan_existing()
+
+    def _scan_existing(self):
+        chunk_size = self.manifest['chunk_size']
+        for index, chunk_hash in enumerate(self.manifest['chunks']):
+            self.file.seek(index * chunk_size)
+            data = self.file.read(chunk_size)
+            if data and hashlib.sha256(data).hexdigest() == chunk_hash:
+                self.received.add(index)
+
+    def missing(self):
+        return [index for index in range(len(self.manifest['chunks']))
+                if index not in self.received]
+
+    def write_chunk(self, index, data):
+        """Записывает кусок на свое место; False, если хэш не совпал"""
+        if hashlib.sha256(data).hexdigest() != self.manifest['chunks'][index]:
+            return False
+        self.file.seek(index * self.manifest['chunk_size'])
+        self.file.write(data)
+        self.received.add(index)
+        return True
+
+    def is_complete(self):
+        return len(self.received) == len(self.manifest['chunks'])
+
+    def finish(self):
+        """Закрывает файл и переименовывает .part в итоговое имя"""
+        self.file.truncate(self.manifest['size'])
+        self.file.close()
+        os.replace(self.part_path, self.target_path)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
@@ -0,0 +1,121 @@
+import time
+from protocol import MSG_FILE_CHUNK
+
+# Что делать с клиентом, который шлет быстрее предела
+THROTTLE = 'throttle'  # Не читать от него, пока не наберется запас (TCP притормозит отправителя)
+DISCONNECT = 'disconnect'  # Отключать сразу
+FLOOD_POLICIES = (THROTTLE, DISCONNECT)
+
+MESSAGES_PER_SEC = 20  # Кадров в секунду от клиента (куски файлов считаются только в байтах)
+BYTES_PER_SEC = 4 * 1024 * 1024  # Байт в секунду от клиента
+BURST_SECONDS = 2.0  # Запас ведра: столько секунд работы на пределе можно отправить разом
+
+
+class FloodError(Exception):
+    """Клиент превысил предел при политике DISCONNECT"""
+
+
+class TokenBucket:
+    """Ведро жетонов: пополняется со скоростью rate до burst.
+
+    Расход сверх запаса уводит ведро в минус, и этот долг - пауза, которую
+    клиент должен выждать, прежде чем его кадры будут обработаны.
+    """
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def configure(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = min(self.tokens, burst)
+
+    def charge(self, amount, now):
+        """Списывает amount жетонов; возвращает паузу в секундах (0 - в пределах)"""
+        if not self.rate:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class RateLimit:
+    """Предел на клиента: кадров и байт в секунду; 0 - без ограничения"""
+
+    def __init__(self, messages_per_sec=MESSAGES_PER_SEC, bytes_per_sec=BYTES_PER_SEC):
+        self.messages_per_sec = messages_per_sec
+        self.bytes_per_sec = bytes_per_sec
+
+    @classmethod
+    def parse(cls, text):
+        """Разбирает предел вида "кадров:байт" из командной строки"""
+        messages, _, nbytes = text.partition(':')
+        return cls(float(messages), float(nbytes or BYTES_PER_SEC))
+
+    def buckets(self):
+        return ((self.messages_per_sec, self.messages_per_sec * BURST_SECONDS),
+                (self.bytes_per_sec, self.bytes_per_sec * BURST_SECONDS))
+
+
+class ClientLimiter:
+    """Ведра кадров и байт одного клиента; пределы берутся из его текущей комнаты"""
+
+    def __init__(self, limit, room):
+        (message_rate, message_burst), (byte_rate, byte_burst) = limit.buckets()
+        self.messages = TokenBucket(message_rate, message_burst)
+        self.bytes = TokenBucket(byte_rate, byte_burst)
+        self.room = room
+
+    def configure(self, limit, room):
+        (message_rate, message_burst), (byte_rate, byte_burst) = limit.buckets()
+        self.messages.configure(message_rate, message_burst)
+        self.bytes.configure(byte_rate, byte_burst)
+        self.room = room
+
+
+class FloodControl:
+    """Пределы входящего трафика клиентов, общий и для отдельных комнат.
+
+    charge() вызывается до расшифровки, по заголовкам кадров одного чтения:
+    клиент сверх предела не тратит процессор сервера на проверку шифротекста.
+    Каждого клиента обслуживает один поток (или цикл событий), поэтому
+    замков здесь нет.
+    """
+
+    def __init__(self, limit=None, room_limits=None, policy=THROTTLE):
+        self.limit = limit or RateLimit()
+        self.room_limits = dict(room_limits or {})  # {комната: RateLimit}
+        self.policy = policy
+        self.limiters = {}  # {client_socket: ClientLimiter}
+
+    def limit_for(self, room):
+        return self.room_limits.get(room, self.limit)
+
+    def charge(self, client, room, frames):
+        """Списывает кадры одного чтения; возвращает паузу в секундах.
+
+        При политике DISCONNECT превышение вызывает FloodError.
+        """
+        limiter = self.limiters.get(client)
+        if limiter is None:
+            limiter = self.limiters[client] = ClientLimiter(self.limit_for(room), room)
+        elif limiter.room != room:
+            limiter.configure(self.limit_for(room), room)
+        messages = 0
+        nbytes = 0
+        for msg_type, payload in frames:
+            nbytes += len(payload)
+            if msg_type != MSG_FILE_CHUNK:
+                messages += 1
+        now = time.monotonic()
+        delay = max(limiter.messages.charge(messages, now), limiter.bytes.charge(nbytes, now))
+        if delay and self.policy == DISCONNECT:
+            raise FloodError(f"Превышен предел комнаты {room}: {messages} кадров, {nbytes} байт")
+        return delay
+
+    def remove(self, client):
+        self.limiters.pop(client, None)
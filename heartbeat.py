@@ -0,0 +1,147 @@
+import math
+import socket
+import threading
+import time
+
+PING_INTERVAL = 30.0  # Сколько клиент может молчать, прежде чем получит PING, секунд
+PING_TIMEOUT = 10.0  # Сколько ждать ответа на PING, секунд
+REAPER_TICK = 1.0  # Шаг колеса таймеров, секунд
+
+# TCP keepalive: ядро само проверяет собеседника, который долго молчит
+KEEPALIVE_IDLE = 60  # Молчание до первой проверки, секунд; 0 - keepalive выключен
+KEEPALIVE_INTERVAL = 10  # Пауза между проверками, секунд
+KEEPALIVE_COUNT = 5  # Сколько проверок без ответа до разрыва соединения
+
+
+def set_keepalive(sock, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL, count=KEEPALIVE_COUNT):
+    """Включает TCP keepalive на сокете; параметры, которых нет на платформе, пропускаются"""
+    if not idle:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, int(idle))
+    elif hasattr(socket, 'TCP_KEEPALIVE'):  # macOS
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, int(idle))
+    if hasattr(socket, 'TCP_KEEPINTVL'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, int(interval))
+    if hasattr(socket, 'TCP_KEEPCNT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, int(count))
+
+
+class TimerWheel:
+    """Колесо таймеров: срок округляется вверх до тика, каждый слот - словарь ключей.
+
+    schedule() и cancel() стоят O(1). advance() обходит только слоты прошедших
+    тиков; пока сроки не дальше одного оборота колеса (slots * tick), в этих
+    слотах лежат только истекшие ключи, и работа пропорциональна их числу,
+    а не числу всех таймеров.
+    """
+
+    def __init__(self, tick=REAPER_TICK, slots=512, now=None):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]  # {ключ: номер тика срока}
+        self.where = {}  # {ключ: номер тика срока}
+        self.position = int((time.monotonic() if now is None else now) / tick)  # Последний обработанный тик
+
+    def __len__(self):
+        return len(self.where)
+
+    def schedule(self, key, deadline):
+        """Ставит (или переставляет) таймер ключа на момент deadline"""
+        self.cancel(key)
+        due = max(math.ceil(deadline / self.tick), self.position + 1)
+        self.slots[due % len(self.slots)][key] = due
+        self.where[key] = due
+
+    def cancel(self, key):
+        due = self.where.pop(key, None)
+        if due is not None:
+            self.slots[due % len(self.slots)].pop(key, None)
+
+    def advance(self, now=None):
+        """Продвигает колесо до момента now и возвращает ключи с истекшим сроком"""
+        target = int((time.monotonic() if now is None else now) / self.tick)
+        expired = []
+        # После долгой паузы хватает одного оборота: каждый слот просматривается не больше раза
+        for position in range(max(self.position + 1, target - len(self.slots) + 1), target + 1):
+            slot = self.slots[position % len(self.slots)]
+            due_keys = [key for key, due in slot.items() if due <= target]
+            for key in due_keys:
+                del slot[key]
+                del self.where[key]
+            expired.extend(due_keys)
+        self.position = max(self.position, target)
+        return expired
+
+
+class HeartbeatMonitor:
+    """Следит за входящим трафиком клиентов: молчащим шлет PING, не ответившим - отключает.
+
+    На каждый входящий кадр - только запись времени (touch); таймер клиента
+    в колесе переставляется лениво, когда его срок истек, а клиент успел
+    что-то прислать.
+    """
+
+    def __init__(self, send_ping, evict, interval=PING_INTERVAL, timeout=PING_TIMEOUT, tick=REAPER_TICK):
+        self.send_ping = send_ping  # send_ping(client)
+        self.evict = evict  # evict(client): разорвать соединение, удалением займется сервер
+        self.interval = interval
+        self.timeout = timeout
+        self.tick = tick
+        self.wheel = TimerWheel(tick)
+        self.last_seen = {}  # {client: время последнего входящего кадра}
+        self.pinged = {}  # {client: время PING, на который еще нет ответа}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.last_seen)
+
+    def add(self, client):
+        now = time.monotonic()
+        with self.lock:
+            self.last_seen[client] = now
+            self.wheel.schedule(client, now + self.interval)
+
+    def touch(self, client):
+        """Отмечает входящий трафик; клиенты без heartbeat пропускаются"""
+        if client in self.last_seen:
+            self.last_seen[client] = time.monotonic()
+
+    def remove(self, client):
+        with self.lock:
+            self.wheel.cancel(client)
+            self.last_seen.pop(client, None)
+            self.pinged.pop(client, None)
+
+    def expire(self, now=None):
+        """Обрабатывает истекшие таймеры; вызывается раз в тик. Возвращает (пингов, отключений)"""
+        if now is None:
+            now = time.monotonic()
+        to_ping = []
+        to_evict = []
+        with self.lock:
+            for client in self.wheel.advance(now):
+                last = self.last_seen.get(client)
+                if last is None:
+                    continue
+                pinged_at = self.pinged.get(client)
+                if pinged_at is not None and last < pinged_at:
+                    to_evict.append(client)  # Из last_seen уберет remove() при удалении клиента
+                elif pinged_at is not None or now - last < self.interval:
+                    # Клиент что-то присылал: следующий срок - от последнего кадра
+                    self.pinged.pop(client, None)
+                    self.wheel.schedule(client, last + self.interval)
+                else:
+                    self.pinged[client] = now
+                    self.wheel.schedule(client, now + self.timeout)
+                    to_ping.append(client)
+        for client in to_ping:
+            self.send_ping(client)
+        for client in to_evict:
+            self.evict(client)
+        return len(to_ping), len(to_evict)
+
+    def run(self, stopped):
+        """Цикл потока-жнеца для многопоточного движка; stopped - threading.Event"""
+        while not stopped.wait(self.tick):
+            self.expire()
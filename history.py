@@ -0,0 +1,176 @@
+import itertools
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+DEFAULT_ROOM = 'main'
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+MAX_ROOMS = 1000  # Сколько комнат держат историю в памяти и сколько может быть открыто одновременно
+
+
+def make_entry(entry_id, room, text, ts=None):
+    """Запись истории в том виде, в котором она уходит клиенту"""
+    return {'id': entry_id, 'room': room, 'ts': ts if ts is not None else time.time(), 'text': text}
+
+
+class MemoryHistory:
+    """История в памяти: кольцевой буфер фиксированного размера на комнату.
+
+    Буферов не больше max_rooms: при создании лишнего удаляется буфер комнаты,
+    в которую дольше всех не писали (кроме общей), поэтому клиент не может
+    занять память, перебирая имена комнат.
+    """
+
+    def __init__(self, capacity=1000, max_rooms=MAX_ROOMS):
+        self.capacity = capacity
+        self.max_rooms = max_rooms
+        self.rooms = OrderedDict()  # {room: deque записей, по возрастанию id}, от давно не писавших комнат
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def append(self, text, room=DEFAULT_ROOM):
+        """Добавляет сообщение и возвращает запись"""
+        with self.lock:
+            entry = make_entry(next(self.ids), room, text)
+            self._buffer(room).append(entry)  # Самая старая запись вытесняется за O(1)
+        return entry
+
+    def insert(self, entry):
+        """Добавляет запись с уже выданным id (история, общая для нескольких процессов)"""
+        with self.lock:
+            self._buffer(entry['room']).append(entry)
+
+    def _buffer(self, room):
+        buffer = self.rooms.get(room)
+        if buffer is not None:
+            self.rooms.move_to_end(room)
+            return buffer
+        if len(self.rooms) >= self.max_rooms:
+            for stale in self.rooms:
+                if stale != DEFAULT_ROOM:
+                    del self.rooms[stale]
+                    break
+        buffer = self.rooms[room] = deque(maxlen=self.capacity)
+        return buffer
+
+    def entries_by_room(self):
+        """Все записи: [(комната, [записи по возрастанию id])], от давно не писавших комнат"""
+        with self.lock:
+            return [(room, list(buffer)) for room, buffer in self.rooms.items()]
+
+    def page(self, room=DEFAULT_ROOM, before_id=None, limit=DEFAULT_PAGE_SIZE):
+        """Возвращает до limit записей старше before_id (от старых к новым)"""
+        with self.lock:
+            buffer = self.rooms.get(room)
+            if not buffer:
+                return []
+            end = len(buffer)
+            if before_id is not None:
+                end = self._index_of(buffer, before_id)
+            return list(itertools.islice(buffer, max(0, end - limit), end))
+
+    def page_after(self, room=DEFAULT_ROOM, after_id=0, limit=DEFAULT_PAGE_SIZE):
+        """Возвращает до limit записей новее after_id (от старых к новым)"""
+        with self.lock:
+            buffer = self.rooms.get(room)
+            if not buffer:
+                return []
+            start = self._index_of(buffer, after_id + 1)
+            return list(itertools.islice(buffer, start, start + limit))
+
+    def revision(self, room=DEFAULT_ROOM):
+        """id последней записи комнаты: меняется при каждом добавлении"""
+        with self.lock:
+            buffer = self.rooms.get(room)
+            return buffer[-1]['id'] if buffer else 0
+
+    @staticmethod
+    def _index_of(buffer, entry_id):
+        """Бинарный поиск позиции первой записи с id >= entry_id"""
+        lo, hi = 0, len(buffer)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if buffer[mid]['id'] < entry_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def close(self):
+        pass
+
+
+class SQLiteHistory:
+    """Постоянная история в SQLite с индексами по комнате и времени"""
+
+    def __init__(self, path='history.db'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room TEXT NOT NULL,
+            ts REAL NOT NULL,
+            text TEXT NOT NULL
+        )''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS messages_room_id ON messages (room, id)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS messages_room_ts ON messages (room, ts)')
+        self.db.commit()
+
+    def append(self, text, room=DEFAULT_ROOM):
+        """Добавляет сообщение и возвращает запись"""
+        ts = time.time()
+        with self.lock:
+            cursor = self.db.execute(
+                'INSERT INTO messages (room, ts, text) VALUES (?, ?, ?)', (room, ts, text)
+            )
+            self.db.commit()
+        return make_entry(cursor.lastrowid, room, text, ts)
+
+    def page(self, room=DEFAULT_ROOM, before_id=None, limit=DEFAULT_PAGE_SIZE):
+        """Возвращает до limit записей старше before_id (от старых к новым)"""
+        if before_id is None:
+            query = 'SELECT id, room, text, ts FROM messages WHERE room = ? ORDER BY id DESC LIMIT ?'
+            args = (room, limit)
+        else:
+            query = ('SELECT id, room, text, ts FROM messages WHERE room = ? AND id < ? '
+                     'ORDER BY id DESC LIMIT ?')
+            args = (room, before_id, limit)
+        with self.lock:
+            rows = self.db.execute(query, args).fetchall()
+        return [make_entry(*row) for row in reversed(rows)]
+
+    def page_after(self, room=DEFAULT_ROOM, after_id=0, limit=DEFAULT_PAGE_SIZE):
+        """Возвращает до limit записей новее after_id (от старых к новым)"""
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT id, room, text, ts FROM messages WHERE room = ? AND id > ? ORDER BY id LIMIT ?',
+                (room, after_id, limit)
+            ).fetchall()
+        return [make_entry(*row) for row in rows]
+
+    def revision(self, room=DEFAULT_ROOM):
+        """id последней записи комнаты; учитывает записи других процессов в тот же файл"""
+        with self.lock:
+            row = self.db.execute('SELECT MAX(id) FROM messages WHERE room = ?', (room,)).fetchone()
+        return row[0] or 0
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+HISTORY_BACKENDS = ('memory', 'sqlite')
+
+
+def create_history(backend='memory', capacity=1000, path='history.db', max_rooms=MAX_ROOMS):
+    """Создает хранилище истории по имени"""
+    if backend == 'memory':
+        return MemoryHistory(capacity, max_rooms)
+    if backend == 'sqlite':
+        return SQLiteHistory(path)
+    raise ValueError(f"Неизвестное хранилище истории: {backend}")
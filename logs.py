@@ -0,0 +1,80 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+SAMPLE_EVERY = 100  # Из частых событий уровня DEBUG в журнал попадает каждое N-е
+
+_listener = None
+
+
+def get_logger(name):
+    """Логгер подсистемы: safespace.<name>"""
+    return logging.getLogger(f'safespace.{name}')
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает каждое N-е событие уровня DEBUG с одним и тем же шаблоном.
+
+    Записи уровня INFO и выше проходят всегда. Фильтр стоит до очереди,
+    поэтому отброшенные записи не форматируются вовсе.
+    """
+
+    def __init__(self, every=SAMPLE_EVERY):
+        super().__init__()
+        self.every = every
+        self.counts = {}  # {(логгер, шаблон): сколько раз встречалось}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.every <= 1:
+            return True
+        key = (record.name, record.msg)
+        with self.lock:
+            count = self.counts.get(key, 0)
+            self.counts[key] = count + 1
+        if count % self.every:
+            return False
+        if count:
+            record.msg = f"{record.msg} (пропущено {self.every - 1})"
+        return True
+
+
+def setup_logging(level='INFO', sample_every=SAMPLE_EVERY, stream=None):
+    """Настраивает журнал: запись в поток вывода идет в отдельном потоке через очередь.
+
+    Вызывающий поток только кладет запись в очередь и не ждет вывода.
+    """
+    global _listener
+    _stop_listener()
+
+    records = queue.SimpleQueue() if hasattr(queue, 'SimpleQueue') else queue.Queue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    queue_handler.addFilter(SamplingFilter(sample_every))
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    root = logging.getLogger('safespace')
+    root.setLevel(level)
+    root.handlers[:] = [queue_handler]
+    root.propagate = False
+
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+    return _listener
+
+
+def _stop_listener():
+    """Выводит остаток очереди и останавливает поток журнала"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(_stop_listener)
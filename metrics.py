@@ -0,0 +1,166 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logs import get_logger
+
+log = get_logger('metrics')
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class Counter:
+    """Монотонный счетчик"""
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+
+class Gauge:
+    """Текущее значение, которое вычисляется при каждом чтении"""
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, read):
+        self.name = name
+        self.help = help_text
+        self.read = read
+
+    def samples(self):
+        return [(self.name, self.read())]
+
+
+class Histogram:
+    """Гистограмма задержек в духе HDR: корзины по степеням двойки, каждая делится на 16 равных.
+
+    Значения хранятся в микросекундах, относительная ошибка квантилей — не больше 1/16.
+    Запись — один подсчет индекса и одно увеличение счетчика, без выделения памяти.
+    """
+    kind = 'summary'
+    SUB_BITS = 4
+    SUB_BUCKETS = 1 << SUB_BITS
+    MAX_BUCKETS = 64 * SUB_BUCKETS
+
+    def __init__(self, name, help_text, scale=1e6):
+        self.name = name
+        self.help = help_text
+        self.scale = scale  # Секунды -> единицы корзин (микросекунды)
+        self.counts = [0] * self.MAX_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def _index(cls, value):
+        if value < 2 * cls.SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - cls.SUB_BITS - 1
+        return min(shift * cls.SUB_BUCKETS + (value >> shift), cls.MAX_BUCKETS - 1)
+
+    @classmethod
+    def _bounds(cls, index):
+        """Границы корзины [нижняя, верхняя) в единицах корзин"""
+        shift = max(0, index // cls.SUB_BUCKETS - 1)
+        mantissa = index - shift * cls.SUB_BUCKETS
+        return mantissa << shift, (mantissa + 1) << shift
+
+    def observe(self, seconds):
+        index = self._index(max(0, int(seconds * self.scale)))
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+
+    def quantile(self, q):
+        """Оценка квантиля в секундах (середина корзины)"""
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+        if not count:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for index, bucket in enumerate(counts):
+            seen += bucket
+            if bucket and seen >= rank:
+                low, high = self._bounds(index)
+                return (low + high) / 2 / self.scale
+        return 0.0
+
+    def samples(self):
+        result = [(f'{self.name}{{quantile="{q}"}}', self.quantile(q)) for q in QUANTILES]
+        result.append((f'{self.name}_sum', self.total))
+        result.append((f'{self.name}_count', self.count))
+        return result
+
+
+class MetricsRegistry:
+    """Набор метрик процесса и их вывод в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text):
+        return self._add(Counter(name, help_text))
+
+    def gauge(self, name, help_text, read):
+        return self._add(Gauge(name, help_text, read))
+
+    def histogram(self, name, help_text):
+        return self._add(Histogram(name, help_text))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, value in metric.samples():
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """HTTP-сервер с одной страницей /metrics в отдельном потоке"""
+
+    def __init__(self, registry, host='127.0.0.1', port=9100):
+        self.registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path != '/metrics':
+                    handler.send_error(404)
+                    return
+                body = registry.render().encode()
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                log.debug("Запрос метрик: " + format, *args)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        host, port = self.httpd.server_address[:2]
+        log.info("Метрики доступны на http://%s:%s/metrics", host, port)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
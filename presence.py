@@ -0,0 +1,132 @@
+import threading
+from history import DEFAULT_ROOM
+
+PRESENCE_WINDOW = 0.5  # Входы и выходы за это время уходят одной сводкой на комнату, секунд
+NAMES_SHOWN = 10  # Сколько ников перечислять в текстовой сводке для старых клиентов
+
+
+def presence_text(room, joined, left):
+    """Текстовая сводка входов и выходов - для клиентов без MSG_PRESENCE"""
+    lines = []
+    if joined:
+        where = "к чату" if room == DEFAULT_ROOM else f"к комнате {room}"
+        if len(joined) == 1:
+            lines.append(f"{joined[0]} присоединился {where}")
+        else:
+            lines.append(f"Присоединились {where}: {name_list(joined)}")
+    if left:
+        where = "чат" if room == DEFAULT_ROOM else f"комнату {room}"
+        if len(left) == 1:
+            lines.append(f"{left[0]} покинул {where}")
+        else:
+            lines.append(f"Покинули {where}: {name_list(left)}")
+    return "\n".join(lines)
+
+
+def name_list(names):
+    shown = ", ".join(names[:NAMES_SHOWN])
+    if len(names) > NAMES_SHOWN:
+        shown += f" и еще {len(names) - NAMES_SHOWN}"
+    return shown
+
+
+class PresenceTracker:
+    """Кто в какой комнате и какие входы и выходы еще не разосланы.
+
+    join() и leave() только записывают событие и ничего не отправляют, поэтому
+    их можно вызывать откуда угодно, в том числе при удалении клиента после
+    ошибки отправки. flush() раз в окно отдает по комнате один список вошедших
+    и вышедших; вход и выход одного ника внутри окна гасят друг друга. Ник
+    с несколькими подключениями присутствует, пока открыто хотя бы одно.
+
+    В кластере подключения этого процесса (local) и других процессов (remote)
+    считаются раздельно. Другим процессам уходят только переходы local через
+    ноль, а сводка для клиентов появляется, только когда ник появился или
+    исчез во всем кластере.
+    """
+
+    def __init__(self, window=PRESENCE_WINDOW):
+        self.window = window
+        self.local = {}  # {комната: {ник: число подключений к этому процессу}}
+        self.remote = {}  # {комната: {ник: в скольких других процессах ник подключен}}
+        self.pending = {}  # {комната: {ник: +1 вошел / -1 вышел}} - сводка для клиентов
+        self.outgoing = {}  # {комната: {ник: +1 / -1}} - переходы local для других процессов
+        self.lock = threading.Lock()
+
+    def join(self, room, nickname):
+        with self.lock:
+            if self._count(self.local, room, nickname, 1):
+                self._record(self.outgoing, room, nickname, 1)
+                if not self._get(self.remote, room, nickname):
+                    self._record(self.pending, room, nickname, 1)
+
+    def leave(self, room, nickname):
+        with self.lock:
+            if self._count(self.local, room, nickname, -1):
+                self._record(self.outgoing, room, nickname, -1)
+                if not self._get(self.remote, room, nickname):
+                    self._record(self.pending, room, nickname, -1)
+
+    def apply(self, room, joined, left):
+        """Учитывает переходы другого процесса кластера; сводка - только если ник появился или исчез везде"""
+        with self.lock:
+            changes = [(nickname, 1) for nickname in joined] + [(nickname, -1) for nickname in left]
+            for nickname, change in changes:
+                if (self._count(self.remote, room, nickname, change)
+                        and not self._get(self.local, room, nickname)):
+                    self._record(self.pending, room, nickname, change)
+
+    def members_of(self, room):
+        """Ники участников комнаты во всем кластере по алфавиту"""
+        with self.lock:
+            return sorted(set(self.local.get(room, ())) | set(self.remote.get(room, ())))
+
+    def flush(self):
+        """Забирает накопленное: (сводки для клиентов, переходы для других процессов),
+        каждое - [(комната, вошедшие, вышедшие)]"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            outgoing, self.outgoing = self.outgoing, {}
+        return self._digests(pending), self._digests(outgoing)
+
+    def run(self, stopped, flush):
+        """Цикл потока сводок для многопоточного движка: flush() раз в окно; stopped - threading.Event"""
+        while not stopped.wait(self.window):
+            flush()
+
+    @staticmethod
+    def _digests(changes_by_room):
+        digests = []
+        for room, changes in changes_by_room.items():
+            joined = sorted(nickname for nickname, change in changes.items() if change > 0)
+            left = sorted(nickname for nickname, change in changes.items() if change < 0)
+            if joined or left:
+                digests.append((room, joined, left))
+        return digests
+
+    @staticmethod
+    def _get(counts, room, nickname):
+        return counts.get(room, {}).get(nickname, 0)
+
+    @staticmethod
+    def _count(counts, room, nickname, delta):
+        """Меняет счетчик ника; True, если он перешел через ноль"""
+        room_counts = counts.setdefault(room, {})
+        before = room_counts.get(nickname, 0)
+        after = max(before + delta, 0)
+        if after:
+            room_counts[nickname] = after
+        else:
+            room_counts.pop(nickname, None)
+            if not room_counts:
+                del counts[room]
+        return (before == 0) != (after == 0)
+
+    @staticmethod
+    def _record(pending, room, nickname, change):
+        changes = pending.setdefault(room, {})
+        change += changes.pop(nickname, 0)
+        if change:
+            changes[nickname] = change
+        elif not changes:
+            del pending[room]
@@ -0,0 +1,147 @@
+import struct
+
+# Формат кадра: версия (1 байт), тип (1 байт), длина полезной нагрузки (4 байта, big-endian),
+# затем сама нагрузка (обычно токен Fernet)
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('!BBI')
+HEADER_SIZE = HEADER.size
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # Защита от заведомо неверной длины
+RECV_BUFFER_SIZE = 64 * 1024  # Буфер чтения: один recv может вместить много кадров
+
+# Типы кадров
+MSG_HELLO = 1  # Рукопожатие: зашифрованный никнейм
+MSG_TEXT = 2  # Текстовое сообщение
+MSG_FILE = 3  # Файл (JSON-описание)
+MSG_HISTORY = 4  # Страница истории (JSON-список записей)
+MSG_HISTORY_REQUEST = 5  # Запрос страницы истории: {"before" или "after": id записи, "limit": n, "id": номер запроса}
+MSG_FILE_OFFER = 6  # Манифест файла: имя, размер, хэши кусков
+MSG_FILE_STATUS = 7  # Каких кусков файла не хватает серверу: {"file_id", "missing", "complete"}
+MSG_FILE_CHUNK = 8  # Кусок файла (двоичный, см. filetransfer.pack_chunk)
+MSG_FILE_REQUEST = 9  # Запрос манифеста или кусков файла: {"file_id", "chunks"}
+MSG_JOIN = 10  # Переход в комнату: {"room": имя}; сервер подтверждает тем же типом
+MSG_LEAVE = 11  # Выход из комнаты обратно в общую
+MSG_ENTRY = 12  # Новое сообщение вместе с записью истории: {"id", "room", "ts", "text"}
+MSG_PING = 13  # Проверка связи от сервера; клиент отвечает MSG_PONG с той же нагрузкой
+MSG_PONG = 14
+MSG_REKEY = 15  # Новый ключ сервера: {"key_id", "key", "resume"}, под прежним ключом сессии
+MSG_PRESENCE = 16  # Сводка входов и выходов {"room", "joined", "left"}; запрос {"id"} - список {"id", "room", "members"}
+MSG_HISTORY_PAGE = 17  # Ответ на запрос истории с "id": {"id", "entries"}; без "id" ответ - MSG_HISTORY
+
+MESSAGE_TYPES = {MSG_HELLO, MSG_TEXT, MSG_FILE, MSG_HISTORY, MSG_HISTORY_REQUEST,
+                 MSG_FILE_OFFER, MSG_FILE_STATUS, MSG_FILE_CHUNK, MSG_FILE_REQUEST,
+                 MSG_JOIN, MSG_LEAVE, MSG_ENTRY, MSG_PING, MSG_PONG, MSG_REKEY,
+                 MSG_PRESENCE, MSG_HISTORY_PAGE}
+
+
+class ProtocolError(Exception):
+    """Нарушение формата кадров"""
+
+
+def encode_frame(msg_type, payload):
+    """Упаковывает полезную нагрузку в кадр"""
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Кадр слишком большой: {len(payload)} байт")
+    return HEADER.pack(PROTOCOL_VERSION, msg_type, len(payload)) + payload
+
+
+class FrameDecoder:
+    """Потоковая сборка кадров из произвольно нарезанных данных сокета.
+
+    feed() возвращает список (тип, memoryview) — срезы ссылаются на уже
+    полученные данные без копирования. Копируется только незавершенный
+    хвост, который ждет следующего recv.
+
+    recv_into() читает сокет прямо в заранее выделенный буфер декодера.
+    Возвращаемые срезы указывают в этот буфер и действительны только до
+    следующего вызова recv_into: их нужно расшифровать раньше.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, buffer_size=RECV_BUFFER_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer_size = buffer_size
+        self._pending = bytearray()
+        self._buffer = None  # Буфер для recv_into, выделяется при первом чтении
+        self._view = None
+        self._start = 0  # Начало необработанных данных в буфере
+        self._end = 0  # Конец прочитанных данных в буфере
+
+    def feed(self, data):
+        """Добавляет данные и возвращает все полностью полученные кадры"""
+        if self._pending:
+            # Старый буфер больше не изменяется, поэтому срезы из него безопасны
+            self._pending += data
+            data, self._pending = self._pending, bytearray()
+
+        view = memoryview(data)
+        frames, offset = self._parse(view, 0, len(view))
+        if offset < len(view):
+            self._pending += view[offset:]
+        return frames
+
+    def recv_into(self, sock):
+        """Читает сокет в буфер декодера: (прочитано байт, полученные кадры)"""
+        self._prepare_buffer()
+        nbytes = sock.recv_into(self._view[self._end:])
+        if not nbytes:
+            return 0, []
+        self._end += nbytes
+        frames, self._start = self._parse(self._view, self._start, self._end)
+        return nbytes, frames
+
+    def _prepare_buffer(self):
+        """Освобождает место в буфере под следующее чтение"""
+        if self._buffer is None:
+            # Хвост, оставшийся после feed() (например, после рукопожатия)
+            tail, self._pending = self._pending, bytearray()
+            self._allocate(max(self.buffer_size, len(tail) + HEADER_SIZE))
+            self._buffer[:len(tail)] = tail
+            self._start, self._end = 0, len(tail)
+
+        remaining = self._end - self._start
+        if remaining == 0:
+            self._start = self._end = 0
+            if len(self._buffer) > self.buffer_size:
+                self._allocate(self.buffer_size)  # Большой кадр обработан, возвращаем обычный размер
+            return
+
+        needed = HEADER_SIZE
+        if remaining >= HEADER_SIZE:
+            needed += HEADER.unpack_from(self._view, self._start)[2]
+        if needed > len(self._buffer):
+            # Кадр не помещается в буфер: переносим начало кадра в буфер побольше
+            tail = bytes(self._view[self._start:self._end])
+            self._allocate(needed)
+        elif self._start:
+            # Сдвигаем незавершенный кадр в начало; копируется только он
+            tail = bytes(self._view[self._start:self._end])
+        else:
+            return
+        self._buffer[:remaining] = tail
+        self._start, self._end = 0, remaining
+
+    def _allocate(self, size):
+        # Прежний буфер не меняется: срезы, выданные из него, остаются целыми
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+
+    def _parse(self, view, offset, end):
+        """Разбирает полные кадры в view[offset:end]; возвращает (кадры, конец разобранного)"""
+        frames = []
+        while end - offset >= HEADER_SIZE:
+            version, msg_type, length = HEADER.unpack_from(view, offset)
+            if version != PROTOCOL_VERSION:
+                raise ProtocolError(f"Неподдерживаемая версия протокола: {version}")
+            if msg_type not in MESSAGE_TYPES:
+                raise ProtocolError(f"Неизвестный тип кадра: {msg_type}")
+            if length > self.max_frame_size:
+                raise ProtocolError(f"Кадр слишком большой: {length} байт")
+            start = offset + HEADER_SIZE
+            if end - start < length:
+                break
+            frames.append((msg_type, view[start:start + length]))
+            offset = start + length
+        return frames, offset
+
+    def has_pending(self):
+        """Есть ли незавершенный кадр в буфере"""
+        return bool(self._pending) or self._end > self._start
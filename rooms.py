@@ -0,0 +1,82 @@
+from history import DEFAULT_ROOM, MAX_ROOMS
+
+MAX_ROOM_NAME = 64
+
+
+def validate_room_name(name):
+    """Проверяет имя комнаты из запроса клиента"""
+    if not isinstance(name, str):
+        raise ValueError("Имя комнаты должно быть строкой")
+    name = name.strip()
+    if not 0 < len(name) <= MAX_ROOM_NAME:
+        raise ValueError(f"Недопустимое имя комнаты: {name!r}")
+    return name
+
+
+class RoomLimitError(ValueError):
+    """Открыто предельное число комнат"""
+
+
+class Room:
+    """Комната: свой список участников и их очередей отправки"""
+
+    def __init__(self, name):
+        self.name = name
+        self.members = {}  # {client_socket: очередь отправки}
+
+    def __len__(self):
+        return len(self.members)
+
+
+class RoomRegistry:
+    """Индексы маршрутизации: комната -> участники и клиент -> комната.
+
+    Клиент находится ровно в одной комнате. Пустые комнаты удаляются,
+    их история остается в хранилище. Новую комнату нельзя открыть, если
+    непустых уже max_rooms (общая открывается всегда). Синхронизация — на
+    стороне вызывающего.
+    """
+
+    def __init__(self, max_rooms=MAX_ROOMS):
+        self.max_rooms = max_rooms
+        self.rooms = {}  # {имя: Room}
+        self.client_rooms = {}  # {client_socket: имя комнаты}
+
+    def join(self, client_socket, outbox, name=DEFAULT_ROOM, enforce_limit=True):
+        """Переводит клиента в комнату; возвращает имя прежней комнаты или None.
+
+        RoomLimitError - комната новая, а открыто уже max_rooms; клиент остается, где был.
+        enforce_limit=False - для возобновления сессии: комната из токена сервера уже была открыта.
+        """
+        room = self.rooms.get(name)
+        if (enforce_limit and room is None and name != DEFAULT_ROOM
+                and len(self.rooms) >= self.max_rooms):
+            raise RoomLimitError(f"Открыто слишком много комнат: {len(self.rooms)}")
+        previous = self.leave(client_socket)
+        room = self.rooms.get(name)  # Могла удалиться, если клиент был в ней один
+        if room is None:
+            room = self.rooms[name] = Room(name)
+        room.members[client_socket] = outbox
+        self.client_rooms[client_socket] = name
+        return previous
+
+    def leave(self, client_socket):
+        """Убирает клиента из его комнаты; возвращает имя комнаты или None"""
+        name = self.client_rooms.pop(client_socket, None)
+        if name is None:
+            return None
+        room = self.rooms[name]
+        room.members.pop(client_socket, None)
+        if not room.members:
+            del self.rooms[name]
+        return name
+
+    def room_of(self, client_socket):
+        return self.client_rooms.get(client_socket)
+
+    def members(self, name):
+        """Снимок участников комнаты: [(client_socket, очередь отправки)]"""
+        room = self.rooms.get(name)
+        if room is None:
+            return []
+        return list(room.members.items())
@@ -1,42 +1,168 @@
+import argparse
 import socket
 import threading
+import time
 import json
 import os
 import base64
-from cryptography.fernet import Fernet
+import signal
+from collections import OrderedDict
+from compression import COMPRESSION_METHODS, compressed_cipher, encrypt_uncompressed, negotiate_compression
+from crypto import (CIPHER_BACKENDS, InvalidToken, KEY_GRACE, KeyRing, encrypt_ip, get_cipher,
+                    negotiate_cipher, rotate_key_file)
+from fanout import ClientOutbox, DROP_OLDEST, SLOW_CLIENT_POLICIES
+from floodcontrol import FloodControl, FloodError, FLOOD_POLICIES, RateLimit, THROTTLE
+from heartbeat import (HeartbeatMonitor, KEEPALIVE_COUNT, KEEPALIVE_IDLE, KEEPALIVE_INTERVAL,
+                       PING_INTERVAL, PING_TIMEOUT, set_keepalive)
+from filetransfer import (ChunkStore, file_reference, pack_chunk, parse_legacy_file, unpack_chunk,
+                          validate_manifest)
+from history import (create_history, DEFAULT_PAGE_SIZE, DEFAULT_ROOM,
+                     HISTORY_BACKENDS, MAX_PAGE_SIZE, MAX_ROOMS)
+from logs import LOG_LEVELS, get_logger, setup_logging
+from metrics import MetricsRegistry, MetricsServer
+from presence import PresenceTracker, PRESENCE_WINDOW, presence_text
+from protocol import (FrameDecoder, encode_frame, RECV_BUFFER_SIZE, MSG_HELLO, MSG_TEXT,
+                      MSG_FILE, MSG_HISTORY, MSG_HISTORY_REQUEST, MSG_FILE_OFFER,
+                      MSG_FILE_STATUS, MSG_FILE_CHUNK, MSG_FILE_REQUEST, MSG_JOIN,
+                      MSG_LEAVE, MSG_ENTRY, MSG_PING, MSG_PONG, MSG_REKEY, MSG_PRESENCE,
+                      MSG_HISTORY_PAGE)
+from rooms import RoomLimitError, RoomRegistry, validate_room_name
+
+MAX_CHUNKS_PER_REQUEST = 32  # Сколько кусков файла сервер отдает на один запрос
+HISTORY_SNAPSHOTS = 256  # Сколько готовых кадров истории (комната, шифр) держать в кэше
+KEY_FILE = 'key.2pk'
+# Страницы истории смешивают тексты разных пользователей: сжатие перед шифрованием
+# выдавало бы их содержимое длиной кадра, поэтому они идут без сжатия
+UNCOMPRESSED_TYPES = {MSG_HISTORY, MSG_HISTORY_PAGE}
+
+log = get_logger('server')
 
 class ChatServer:
-    def __init__(self, host='0.0.0.0', port=5000):
+    def __init__(self, host='0.0.0.0', port=5000, send_queue_size=256,
+                 slow_client_policy=DROP_OLDEST, cipher_backends=CIPHER_BACKENDS,
+                 compression_methods=COMPRESSION_METHODS,
+                 history_backend='memory', max_history=1000, history_path='history.db',
+                 files_dir='files', backlog=1024, handshake_timeout=5.0,
+                 max_handshakes=256, reuse_port=False, metrics_host='127.0.0.1',
+                 metrics_port=0, ping_interval=PING_INTERVAL, ping_timeout=PING_TIMEOUT,
+                 keepalive_idle=KEEPALIVE_IDLE, keepalive_interval=KEEPALIVE_INTERVAL,
+                 keepalive_count=KEEPALIVE_COUNT, rate_limit=None, room_rate_limits=None,
+                 flood_policy=THROTTLE, presence_window=PRESENCE_WINDOW, max_rooms=MAX_ROOMS):
         self.host = host
         self.port = port
         self.server_socket = None
         self.clients = {}  # {client_socket: nickname}
-        self.encryption_key = None
-        self.message_history = []  # История сообщений
-        self.max_history = 100  # Максимальное количество сообщений в истории
+        self.outboxes = {}  # {client_socket: очередь отправки клиента}
+        self.client_ciphers = {}  # {client_socket: шифр, согласованный при рукопожатии}
+        self.entry_clients = set()  # Клиенты, которые получают новые сообщения с id записи (MSG_ENTRY)
+        self.presence_clients = set()  # Клиенты, которые получают сводки входов и выходов кадром MSG_PRESENCE
+        self.rekey_clients = {}  # {client_socket: (шифр, сжатие)} клиенты, принимающие новый ключ на лету
+        self.session_ciphers = {}  # {(шифр, сжатие, номер ключа): KeyedCipher}, общий для клиентов
+        self.cipher_backends = cipher_backends  # Шифры сессии, которые готов использовать сервер
+        self.compression_methods = compression_methods  # Методы сжатия; пустой набор - без сжатия
+        self.clients_lock = threading.Lock()
+        self.send_queue_size = send_queue_size  # Предел очереди отправки на клиента
+        self.slow_client_policy = slow_client_policy  # Что делать с медленным клиентом
+        self.encryption_key = None  # Текущий ключ
+        self.keyring = None  # Текущий и прежние ключи (crypto.KeyRing)
+        self.max_history = max_history  # Размер истории в памяти
+        self.history = create_history(history_backend, max_history, history_path, max_rooms)
+        self.history_page_size = DEFAULT_PAGE_SIZE  # Сколько сообщений получает новый клиент
+        self.history_snapshots = OrderedDict()  # {(комната, шифр): (ревизия истории, кадр)}
+        self.snapshots_lock = threading.Lock()
+        self.file_store = ChunkStore(files_dir)  # Куски файлов на диске по хэшу содержимого
+        self.uploads = {}  # {client_socket: {file_id: манифест незавершенной загрузки}}
+        self.rooms = RoomRegistry(max_rooms)  # Участники комнат для маршрутизации рассылки
+        self.presence = PresenceTracker(presence_window)  # Кто в комнатах и неразосланные входы и выходы
+        self.recv_size = RECV_BUFFER_SIZE  # Буфер чтения на клиента: один recv может вместить много кадров
+        self.backlog = backlog  # Очередь listen: выдерживает всплески переподключений
+        self.handshake_timeout = handshake_timeout  # Срок на рукопожатие, секунд
+        self.max_handshakes = max_handshakes  # Сколько рукопожатий идет одновременно
+        self.handshake_slots = threading.BoundedSemaphore(max_handshakes)
+        self.reuse_port = reuse_port  # SO_REUSEPORT: один порт слушают несколько процессов
+        self.bus = None  # Шина между процессами кластера (см. cluster.py)
+        self.keepalive = (keepalive_idle, keepalive_interval, keepalive_count)  # TCP keepalive, 0 - выключен
+        self.ping_interval = ping_interval  # 0 - не проверять клиентов PING
+        self.heartbeat = None  # Клиенты с PING/PONG и жнец неотвечающих (heartbeat.py)
+        if ping_interval:
+            self.heartbeat = HeartbeatMonitor(self.send_ping, self.evict_client, ping_interval, ping_timeout)
+        self.reaper_stopped = threading.Event()
+        self.flood = FloodControl(rate_limit, room_rate_limits, flood_policy)  # Пределы входящего трафика
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port  # 0 - страница метрик выключена
+        self.metrics_server = None
+        self.metrics = MetricsRegistry()
+        self.setup_metrics()
         self.load_or_create_key()
 
+    def setup_metrics(self):
+        """Создает счетчики и гистограммы задержек сервера"""
+        metrics = self.metrics
+        metrics.gauge('safespace_clients', "Подключенные клиенты", lambda: len(self.clients))
+        metrics.gauge('safespace_rooms', "Непустые комнаты", lambda: len(self.rooms.rooms))
+        metrics.gauge('safespace_dropped_frames', "Кадры, выброшенные из очередей подключенных клиентов",
+                      lambda: sum(outbox.dropped for outbox in list(self.outboxes.values())))
+        self.handshake_seconds = metrics.histogram('safespace_handshake_seconds',
+                                                   "Длительность проверки ключа при рукопожатии")
+        self.handshake_failures = metrics.counter('safespace_handshake_failures_total',
+                                                  "Отклоненные рукопожатия")
+        self.received_bytes = metrics.counter('safespace_received_bytes_total', "Байт получено от клиентов")
+        self.received_frames = metrics.counter('safespace_received_frames_total', "Кадров получено от клиентов")
+        self.decrypt_seconds = metrics.histogram('safespace_decrypt_seconds',
+                                                 "Расшифровка кадров одного чтения из сокета")
+        self.decrypt_failures = metrics.counter('safespace_decrypt_failures_total',
+                                                "Кадры, которые не удалось расшифровать")
+        self.broadcast_seconds = metrics.histogram('safespace_broadcast_seconds',
+                                                   "Шифрование и постановка рассылки в очереди")
+        self.broadcast_frames = metrics.counter('safespace_broadcast_frames_total',
+                                                "Кадров рассылки поставлено получателям")
+        self.sent_bytes = metrics.counter('safespace_sent_bytes_total', "Байт поставлено в очереди отправки")
+        self.history_seconds = metrics.histogram('safespace_history_append_seconds', "Запись в историю")
+        self.pings_sent = metrics.counter('safespace_pings_total', "Отправлено PING молчащим клиентам")
+        self.flood_delays = metrics.counter('safespace_flood_delays_total',
+                                            "Чтения, отложенные из-за превышения предела трафика")
+        self.flood_delay_seconds = metrics.counter('safespace_flood_delay_seconds_total',
+                                                   "Суммарная пауза клиентов сверх предела трафика")
+        self.flood_disconnects = metrics.counter('safespace_flood_disconnects_total',
+                                                 "Клиенты, отключенные за превышение предела трафика")
+        self.evicted_clients = metrics.counter('safespace_evicted_clients_total',
+                                               "Клиенты, отключенные за отсутствие ответа на PING")
+        self.rekeyed_clients = metrics.counter('safespace_rekeyed_clients_total',
+                                               "Сессии, переведенные на новый ключ без переподключения")
+        self.presence_digests = metrics.counter('safespace_presence_digests_total',
+                                                "Сводки входов и выходов, разосланные комнатам")
+        self.presence_events = metrics.counter('safespace_presence_events_total',
+                                               "Входы и выходы, вошедшие в сводки")
+
+    def start_metrics(self):
+        """Запускает страницу метрик, если задан порт"""
+        if self.metrics_port:
+            self.metrics_server = MetricsServer(self.metrics, self.metrics_host, self.metrics_port)
+            self.metrics_server.start()
+
     def load_or_create_key(self):
         """Загружает существующий ключ или создает новый"""
         try:
-            if os.path.exists('key.2pk'):
-                print("Загрузка существующего ключа...")
-                with open('key.2pk', 'r') as f:
+            if os.path.exists(KEY_FILE):
+                log.info("Загрузка существующего ключа...")
+                with open(KEY_FILE, 'r') as f:
                     data = json.load(f)
-                self.encryption_key = data['key'].encode()
-                print("Ключ успешно загружен")
+                self.keyring = KeyRing.from_file_data(data)
+                self.encryption_key = self.keyring.current_key
+                log.info("Ключ %s успешно загружен", self.keyring.current)
             else:
-                print("Создание нового ключа...")
+                log.info("Создание нового ключа...")
                 self.create_new_key()
-                print("Новый ключ создан и сохранен")
+                log.info("Новый ключ создан и сохранен")
         except Exception as e:
-            print(f"Ошибка при работе с ключом: {e}")
-            print("Создание нового ключа...")
+            log.error("Ошибка при работе с ключом: %s", e)
+            log.info("Создание нового ключа...")
             self.create_new_key()
 
     def create_new_key(self):
         """Создает новый ключ и сохраняет его"""
         self.encryption_key = base64.urlsafe_b64encode(os.urandom(32))
+        self.keyring = KeyRing({0: self.encryption_key}, 0)
         
         # Получаем локальный IP
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -49,184 +175,902 @@ class ChatServer:
             s.close()
 
         # Шифруем IP
-        f = Fernet(self.encryption_key)
-        encrypted_ip = f.encrypt(local_ip.encode())
+        encrypted_ip = encrypt_ip(local_ip, self.encryption_key)
 
         # Сохраняем ключ и зашифрованный IP
         data = {
             'key': self.encryption_key.decode(),
+            'key_id': 0,
             'encrypted_ip': base64.b64encode(encrypted_ip).decode()
         }
         
-        with open('key.2pk', 'w') as f:
+        with open(KEY_FILE, 'w') as f:
             json.dump(data, f)
 
-    def verify_client_key(self, client_socket):
-        """Проверяет, что клиент использует правильный ключ"""
+    def reload_keys(self):
+        """Перечитывает key.2pk (SIGHUP); новый ключ рассылается клиентам без разрыва сессий"""
         try:
-            print("Ожидание данных от клиента для проверки ключа...")
-            data = client_socket.recv(1024)
-            if not data:
-                print("Клиент закрыл соединение при проверке ключа")
-                return False, None
-                
+            with open(KEY_FILE, 'r') as f:
+                keyring = KeyRing.from_file_data(json.load(f))
+        except (OSError, ValueError, KeyError) as e:
+            log.error("Не удалось перечитать ключ: %s", e)
+            return
+        changed = keyring.current_key != self.encryption_key
+        self.keyring = keyring
+        self.encryption_key = keyring.current_key
+        self.session_ciphers = {}
+        if not changed:
+            log.info("Ключ не изменился")
+            return
+        with self.clients_lock:
+            clients = list(self.rekey_clients)
+        for client_socket in clients:
+            self.rekey_client(client_socket)
+        log.info("Новый ключ %s, отправлен клиентам: %s", keyring.current, len(clients))
+
+    def install_reload_signal(self):
+        """SIGHUP перечитывает ключ; обработчик только запускает поток, замки берет уже он"""
+        if hasattr(signal, 'SIGHUP') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGHUP,
+                          lambda signum, frame: threading.Thread(target=self.reload_keys, daemon=True).start())
+
+    def session_cipher(self, backend, compression, key_id=None):
+        """Шифр сессии с номерами ключей; один объект на набор параметров, как и compressed_cipher"""
+        cache_key = (backend, compression, key_id)
+        cipher = self.session_ciphers.get(cache_key)
+        if cipher is None:
+            cipher = self.keyring.keyed_cipher(
+                lambda key: compressed_cipher(get_cipher(key, backend), compression), key_id
+            )
+            self.session_ciphers[cache_key] = cipher
+        return cipher
+
+    def rekey_client(self, client_socket):
+        """Отправляет клиенту текущий ключ и переводит его сессию на этот ключ"""
+        session = self.rekey_clients.get(client_socket)
+        nickname = self.clients.get(client_socket)
+        if session is None or nickname is None:
+            return
+        room = self.rooms.room_of(client_socket) or DEFAULT_ROOM
+        rekey = json.dumps({'key_id': self.keyring.current, 'key': self.encryption_key.decode(),
+                            'resume': self.issue_resume_token(nickname, room)})
+        # Сначала кадр с ключом под прежним шифром, потом смена шифра: все кадры
+        # под новым ключом встанут в очередь после него, а прежний клиент еще помнит
+        self.send_encrypted_message(client_socket, rekey, MSG_REKEY)
+        with self.clients_lock:
+            if client_socket in self.client_ciphers:
+                self.client_ciphers[client_socket] = self.session_cipher(*session)
+        self.rekeyed_clients.inc()
+
+    def verify_client_key(self, client_socket, decoder):
+        """Проверяет, что клиент использует правильный ключ.
+
+        Возвращает (успех, никнейм, параметры, кадры после HELLO из того же чтения):
+        клиент мог отправить их, не дожидаясь ответа.
+        """
+        try:
+            log.debug("Ожидание данных от клиента для проверки ключа...")
+            # Общий срок на все рукопожатие, а не на каждый recv
+            deadline = time.monotonic() + self.handshake_timeout
+            frames = []
+            while not frames:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    log.info("Клиент не завершил рукопожатие за %s с", self.handshake_timeout)
+                    return False, None, None, []
+                client_socket.settimeout(remaining)
+                nbytes, frames = decoder.recv_into(client_socket)
+                if not nbytes:
+                    log.debug("Клиент закрыл соединение при проверке ключа")
+                    return False, None, None, []
+
+            msg_type, payload = frames[0]
+            if msg_type != MSG_HELLO:
+                log.warning("Ожидался кадр рукопожатия, получен тип %s", msg_type)
+                return False, None, None, []
+
             try:
-                print(f"Получены данные для проверки: {data}")
-                f = Fernet(self.encryption_key)
-                nickname = f.decrypt(data).decode()
-                print(f"Успешная проверка ключа, никнейм: {nickname}")
-                return True, nickname
+                nickname, params = self.parse_hello(payload)
+                log.debug("Успешная проверка ключа, никнейм: %s", nickname)
+                # Копии: кадры - срезы буфера декодера, следующее чтение его перезапишет
+                return True, nickname, params, [(t, bytes(p)) for t, p in frames[1:]]
             except Exception as e:
-                print(f"Ошибка проверки ключа: {str(e)}")
-                return False, None
+                log.warning("Ошибка проверки ключа: %s", e)
+                return False, None, None, []
                 
         except Exception as e:
-            print(f"Ошибка при получении данных для проверки ключа: {str(e)}")
-            return False, None
+            log.warning("Ошибка при получении данных для проверки ключа: %s", e)
+            return False, None, None, []
+
+    def parse_hello(self, payload):
+        """Расшифровывает кадр рукопожатия: никнейм и параметры сессии.
+
+        Старые клиенты присылают просто никнейм, новые — JSON-объект
+        с никнеймом и списком поддерживаемых шифров. В params['key_id']
+        сервер записывает номер ключа, которым зашифровано рукопожатие.
+        """
+        key_id, hello = self.keyring.open_hello(payload)
+        hello = hello.decode()
+        try:
+            params = json.loads(hello)
+        except ValueError:
+            params = None
+        if not isinstance(params, dict):
+            if key_id != self.keyring.current:
+                raise InvalidToken  # Самым старым клиентам нечем сообщить о смене ключа
+            return hello, None
+        params['key_id'] = key_id
+        return params.get('nickname'), params
 
     def start(self):
         """Запускает сервер"""
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         
         try:
             self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
-            print(f"Сервер запущен на {self.host}:{self.port}")
+            self.server_socket.listen(self.backlog)
+            self.start_metrics()
+            self.start_reaper()
+            self.start_presence()
+            self.install_reload_signal()
+            log.info("Сервер запущен на %s:%s", self.host, self.port)
             
             while True:
-                client_socket, address = self.server_socket.accept()
-                print(f"Новое подключение с {address}")
-                
-                # Проверяем ключ клиента
-                is_valid, nickname = self.verify_client_key(client_socket)
+                # Ограничиваем число одновременных рукопожатий; остальные ждут в очереди listen
+                self.handshake_slots.acquire()
+                try:
+                    client_socket, address = self.server_socket.accept()
+                except Exception:
+                    self.handshake_slots.release()
+                    raise
                 
-                if is_valid and nickname:
-                    print(f"Клиент {nickname} успешно подключен")
-                    self.clients[client_socket] = nickname
-                    
-                    # Отправляем приветственное сообщение
-                    welcome_msg = f"Добро пожаловать, {nickname}!"
-                    self.send_encrypted_message(client_socket, welcome_msg)
-                    
-                    # Оповещаем всех о новом участнике
-                    self.broadcast_message(f"{nickname} присоединился к чату", client_socket)
-                    
-                    # Запускаем поток для обработки сообщений клиента
-                    thread = threading.Thread(target=self.handle_client, args=(client_socket,))
-                    thread.daemon = True
-                    thread.start()
-                else:
-                    print(f"Клиент {address} использует неверный ключ")
-                    client_socket.close()
+                # Рукопожатие идет в потоке клиента, цикл приема сразу возвращается к accept
+                thread = threading.Thread(target=self.serve_connection, args=(client_socket, address))
+                thread.daemon = True
+                thread.start()
                     
         except Exception as e:
-            print(f"Ошибка сервера: {e}")
+            log.error("Ошибка сервера: %s", e)
         finally:
             if self.server_socket:
                 self.server_socket.close()
 
-    def handle_client(self, client_socket):
-        """Обрабатывает сообщения от клиента"""
-        f = Fernet(self.encryption_key)
+    def start_reaper(self):
+        """Запускает поток, который раз в тик проверяет сроки PING"""
+        if self.heartbeat is not None:
+            thread = threading.Thread(target=self.heartbeat.run, args=(self.reaper_stopped,), daemon=True)
+            thread.start()
+
+    def start_presence(self):
+        """Запускает поток, который раз в окно рассылает сводки входов и выходов"""
+        thread = threading.Thread(target=self.presence.run, args=(self.reaper_stopped, self.flush_presence),
+                                  daemon=True)
+        thread.start()
+
+    def serve_connection(self, client_socket, address):
+        """Проводит рукопожатие и обслуживает клиента в отдельном потоке"""
+        log.debug("Новое подключение с %s", address)
+        set_keepalive(client_socket, *self.keepalive)
+        decoder = FrameDecoder(buffer_size=self.recv_size)
+        started = time.perf_counter()
+        try:
+            is_valid, nickname, params, pending = self.verify_client_key(client_socket, decoder)
+        finally:
+            self.handshake_slots.release()
+        self.handshake_seconds.observe(time.perf_counter() - started)
+        
+        if not (is_valid and nickname):
+            self.handshake_failures.inc()
+            log.warning("Клиент %s использует неверный ключ", address)
+            client_socket.close()
+            return
+        
+        client_socket.settimeout(None)
+        self.admit_client(client_socket, nickname, params)
+        self.handle_client(client_socket, decoder, pending)
+
+    def admit_client(self, client_socket, nickname, params):
+        """Регистрирует проверенного клиента, приветствует его и отмечает вход в сводке комнаты"""
+        log.info("Клиент %s успешно подключен", nickname)
+        room = self.register_client(client_socket, nickname, params)
+        if room is None:
+            # Новая сессия: приветствие и последняя страница истории общей комнаты
+            room = DEFAULT_ROOM
+            self.send_encrypted_message(client_socket, f"Добро пожаловать, {nickname}!")
+            self.send_history(client_socket)
         
+        # Комната узнает о новом участнике из ближайшей сводки
+        self.presence.join(room, nickname)
+
+    def handle_client(self, client_socket, decoder, pending=()):
+        """Обрабатывает сообщения от клиента; pending - кадры, пришедшие вместе с рукопожатием"""
+        frames = list(pending)
         try:
-            # Отправляем историю сообщений новому клиенту
-            if self.message_history:
-                history_message = "HISTORY:" + json.dumps(self.message_history)
-                self.send_encrypted_message(client_socket, history_message)
-            
             while True:
                 try:
-                    data = client_socket.recv(4096)  # Увеличиваем размер буфера для файлов
-                    if not data:
-                        print("Клиент закрыл соединение")
-                        break
-                        
-                    print(f"Получены данные от клиента: {data}")
-                    
-                    # Расшифровываем сообщение
-                    decrypted_message = f.decrypt(data).decode()
-                    print(f"Расшифровано сообщение: {decrypted_message}")
-                    
-                    # Проверяем тип сообщения
-                    if decrypted_message.startswith("FILE:"):
-                        # Обработка файла
-                        file_data = json.loads(decrypted_message[5:])
-                        file_message = f"FILE:{json.dumps(file_data)}"
-                        self.add_to_history(file_message)
-                        self.broadcast_message(file_message)
-                    else:
-                        # Обычное текстовое сообщение
-                        nickname = self.clients.get(client_socket, "Unknown")
-                        full_message = f"{nickname}: {decrypted_message}"
-                        self.add_to_history(full_message)
-                        self.broadcast_message(full_message)
-                    
+                    if not frames:
+                        # Чтение прямо в буфер декодера; кадры - срезы этого буфера без копирования
+                        nbytes, frames = decoder.recv_into(client_socket)
+                        if not nbytes:
+                            log.debug("Клиент закрыл соединение")
+                            break
+                        self.received_bytes.inc(nbytes)
+                        if self.heartbeat is not None:
+                            self.heartbeat.touch(client_socket)
+
+                    # Предел трафика - до расшифровки; пауза в потоке клиента притормозит его через TCP
+                    delay = self.check_flood(client_socket, frames)
+                    if delay:
+                        time.sleep(delay)
+
+                    # За одно чтение может прийти несколько кадров или часть кадра;
+                    # шифр читается заново - после смены ключа он другой
+                    messages = self.decrypt_frames(self.client_ciphers[client_socket], frames)
+                    for (msg_type, _), decrypted_message in zip(frames, messages):
+                        self.process_message(client_socket, msg_type, decrypted_message)
+                    frames = []
+
                 except Exception as e:
-                    print(f"Ошибка обработки сообщения: {str(e)}")
+                    log.warning("Ошибка обработки сообщения: %s", e)
                     break
                     
         except Exception as e:
-            print(f"Ошибка соединения с клиентом: {str(e)}")
+            log.warning("Ошибка соединения с клиентом: %s", e)
         finally:
             self.remove_client(client_socket)
 
-    def broadcast_message(self, message, sender_socket=None):
-        """Отправляет сообщение всем клиентам"""
-        print(f"Рассылка сообщения: {message}")
-        f = Fernet(self.encryption_key)
-        encrypted_message = f.encrypt(message.encode())
-        print(f"Зашифрованное сообщение для рассылки: {encrypted_message}")
+    def check_flood(self, client_socket, frames):
+        """Списывает кадры одного чтения с пределов клиента; возвращает паузу в секундах"""
+        try:
+            delay = self.flood.charge(client_socket, self.rooms.room_of(client_socket), frames)
+        except FloodError as e:
+            self.flood_disconnects.inc()
+            log.info("Клиент %s отключен: %s", self.clients.get(client_socket), e)
+            raise
+        if delay:
+            self.flood_delays.inc()
+            self.flood_delay_seconds.inc(delay)
+            log.debug("Клиент превысил предел трафика, пауза %.3f с", delay)
+        return delay
+
+    def decrypt_frames(self, cipher, frames):
+        """Расшифровывает кадры одного чтения и учитывает их в метриках"""
+        if not frames:
+            return []
+        started = time.perf_counter()
+        try:
+            messages = cipher.decrypt_many(payload for _, payload in frames)
+        except InvalidToken:
+            self.decrypt_failures.inc()
+            raise
+        self.decrypt_seconds.observe(time.perf_counter() - started)
+        self.received_frames.inc(len(frames))
+        return messages
+
+    def process_message(self, client_socket, msg_type, data):
+        """Обрабатывает расшифрованное сообщение клиента"""
+        if msg_type == MSG_FILE_CHUNK:
+            self.handle_file_chunk(client_socket, data)
+            return
+        if msg_type == MSG_PONG:
+            return  # Входящий трафик уже отмечен в heartbeat.touch
+
+        decrypted_message = data.decode()
+        log.debug("Кадр типа %s от клиента, %s байт", msg_type, len(data))
+        if msg_type == MSG_HISTORY_REQUEST:
+            request = json.loads(decrypted_message)
+            request_id = request.get('id') if isinstance(request, dict) else None
+            if not isinstance(request_id, int) or isinstance(request_id, bool):
+                request_id = None  # Старый клиент: ответ - MSG_HISTORY, по порядку запросов
+            try:
+                before, after, limit = self.parse_history_request(request)
+            except (TypeError, ValueError, OverflowError) as e:
+                # Отвечаем пустой страницей: клиент ждет ответа на каждый запрос
+                log.warning("Неверный запрос истории: %s", e)
+                self.send_history_page(client_socket, [], request_id)
+                return
+            if after is not None:
+                self.send_newer_history(client_socket, after, limit, request_id)
+            else:
+                self.send_history(client_socket, before, limit, request_id=request_id)
+        elif msg_type == MSG_JOIN:
+            self.change_room(client_socket, validate_room_name(json.loads(decrypted_message)['room']))
+        elif msg_type == MSG_PRESENCE:
+            request = json.loads(decrypted_message) if decrypted_message else {}
+            self.send_presence(client_socket, request.get('id') if isinstance(request, dict) else None)
+        elif msg_type == MSG_LEAVE:
+            self.change_room(client_socket, DEFAULT_ROOM)
+        elif msg_type == MSG_FILE_OFFER:
+            self.handle_file_offer(client_socket, json.loads(decrypted_message))
+        elif msg_type == MSG_FILE_REQUEST:
+            self.handle_file_request(client_socket, json.loads(decrypted_message))
+        elif msg_type in (MSG_FILE, MSG_TEXT):
+            file_data = self.legacy_file(msg_type, decrypted_message)
+            if file_data is not None:
+                # Файл целиком в одном сообщении или ссылка на него (старые клиенты)
+                self.publish_legacy_file(client_socket, self.file_store.legacy_manifest(file_data))
+            elif msg_type == MSG_FILE:
+                log.warning("Отклонен кадр файла без содержимого и file_id от %s", self.clients.get(client_socket))
+            else:
+                # Обычное текстовое сообщение уходит только в комнату отправителя
+                nickname = self.clients.get(client_socket, "Unknown")
+                room = self.rooms.room_of(client_socket)
+                self.publish_entry(f"{nickname}: {decrypted_message}", room)
+        else:
+            log.warning("Неожиданный тип кадра от клиента: %s", msg_type)
+
+    def parse_history_request(self, request):
+        """Проверяет запрос страницы истории: (before, after, limit), limit от 1 до MAX_PAGE_SIZE"""
+        limit = max(1, min(int(request.get('limit', self.history_page_size)), MAX_PAGE_SIZE))
+        before, after = request.get('before'), request.get('after')
+        for name, value in (('before', before), ('after', after)):
+            if value is not None and (not isinstance(value, int) or isinstance(value, bool)):
+                raise ValueError(f"{name} должен быть целым числом")
+        return before, after, limit
+
+    @staticmethod
+    def legacy_file(msg_type, text):
+        """Файл старого клиента: любой кадр MSG_FILE или MSG_TEXT с меткой "FILE:"; None - обычный текст"""
+        if msg_type == MSG_TEXT and not text.startswith("FILE:"):
+            return None
+        return parse_legacy_file(text)
+
+    def publish_legacy_file(self, client_socket, manifest):
+        """Рассылает ссылку на файл старого клиента; ссылку строит сервер, а не клиент"""
+        if manifest is None:
+            log.warning("Отклонена ссылка на неизвестный файл от %s", self.clients.get(client_socket))
+            return
+        reference = file_reference(manifest, self.clients.get(client_socket, "Unknown"))
+        self.publish_file(reference, self.rooms.room_of(client_socket))
+
+    def publish_file(self, reference, room=DEFAULT_ROOM):
+        """Сохраняет ссылку на файл в истории комнаты и рассылает ее"""
+        self.publish_entry(f"FILE:{json.dumps(reference)}", room)
+
+    def change_room(self, client_socket, name):
+        """Переводит клиента в другую комнату и отправляет ему ее историю"""
+        with self.clients_lock:
+            nickname = self.clients.get(client_socket)
+            outbox = self.outboxes.get(client_socket)
+            if outbox is None:
+                return
+            try:
+                previous = self.rooms.join(client_socket, outbox, name)
+            except RoomLimitError as e:
+                log.warning("Клиент %s не переведен в комнату: %s", nickname, e)
+                refused = True  # Клиент остается в своей комнате
+            else:
+                refused = False
+        if refused:
+            self.send_encrypted_message(client_socket, "Сейчас нельзя открыть новую комнату, попробуйте позже")
+            return
+        if previous == name:
+            return
+        if previous is not None:
+            self.presence.leave(previous, nickname)
+        # Вместе с подтверждением - новый токен возобновления: сессия вернется в эту комнату
+        reply = {'room': name, 'resume': self.issue_resume_token(nickname, name)}
+        self.send_encrypted_message(client_socket, json.dumps(reply), MSG_JOIN)
+        self.send_history(client_socket, room=name)
+        self.presence.join(name, nickname)
+
+    # Работа с диском в обработчиках файлов - отдельные вызовы file_store: асинхронный
+    # движок выполняет их в пуле потоков, а остальное - в цикле событий (AsyncChatServer)
+
+    def handle_file_offer(self, client_socket, offer):
+        """Принимает манифест загружаемого файла и сообщает, каких кусков не хватает"""
+        manifest, missing = self.file_store.prepare_upload(validate_manifest(offer))
+        if missing:
+            self.upload_pending(client_socket, manifest, missing)
+        else:
+            # Все куски уже есть (повторная отправка или докачка завершена)
+            self.complete_upload(client_socket, manifest)
+
+    def upload_pending(self, client_socket, manifest, missing):
+        self.uploads.setdefault(client_socket, {})[manifest['file_id']] = (manifest, set(missing))
+        status = {'file_id': manifest['file_id'], 'missing': missing, 'complete': False}
+        self.send_encrypted_message(client_socket, json.dumps(status), MSG_FILE_STATUS)
+
+    def handle_file_chunk(self, client_socket, data):
+        """Сохраняет кусок загружаемого файла на диск"""
+        upload = self.find_upload(client_socket, data)
+        if upload is None:
+            return
+        manifest, pending, index, chunk = upload
+        self.file_store.put_chunk(manifest['chunks'][index], chunk)
+        pending.discard(index)
+        if not pending:
+            self.complete_upload(client_socket, manifest)
+
+    def find_upload(self, client_socket, data):
+        """Загрузка, к которой относится кусок: (манифест, недостающие номера, номер, данные) или None"""
+        file_id, index, chunk = unpack_chunk(data)
+        upload = self.uploads.get(client_socket, {}).get(file_id)
+        if upload is None or not 0 <= index < len(upload[0]['chunks']):
+            log.warning("Кусок неизвестного файла %s или неверный номер %s", file_id, index)
+            return None
+        return upload[0], upload[1], index, chunk
+
+    def complete_upload(self, client_socket, manifest):
+        """Проверяет собранный файл и публикует ссылку на него"""
+        self.upload_verified(client_socket, manifest, self.file_store.finish_upload(manifest))
+
+    def upload_verified(self, client_socket, manifest, verified):
+        self.uploads.get(client_socket, {}).pop(manifest['file_id'], None)
+        status = {'file_id': manifest['file_id'], 'missing': [], 'complete': True}
+        if not verified:
+            log.warning("Хэш файла %s не совпал", manifest['file_id'])
+            status['complete'] = False
+            status['missing'] = list(range(len(manifest['chunks'])))
+            self.send_encrypted_message(client_socket, json.dumps(status), MSG_FILE_STATUS)
+            return
+        self.send_encrypted_message(client_socket, json.dumps(status), MSG_FILE_STATUS)
+        room = self.rooms.room_of(client_socket)
+        if room is not None:  # Клиент мог отключиться, пока файл проверялся
+            self.publish_file(file_reference(manifest, self.clients.get(client_socket)), room)
+
+    def handle_file_request(self, client_socket, request):
+        """Отдает манифест файла или запрошенные куски, читая их с диска по одному"""
+        manifest, chunks = self.file_store.read_request(request['file_id'], request.get('chunks'),
+                                                        MAX_CHUNKS_PER_REQUEST)
+        self.send_file_reply(client_socket, request['file_id'], manifest, chunks)
+
+    def send_file_reply(self, client_socket, file_id, manifest, chunks):
+        if manifest is None:
+            status = {'file_id': file_id, 'missing': [], 'complete': False}
+            self.send_encrypted_message(client_socket, json.dumps(status), MSG_FILE_STATUS)
+        elif chunks is None:
+            self.send_encrypted_message(client_socket, json.dumps(manifest), MSG_FILE_OFFER)
+        else:
+            for index, chunk in chunks:
+                self.send_encrypted_message(
+                    client_socket, pack_chunk(manifest['file_id'], index, chunk), MSG_FILE_CHUNK
+                )
+
+    def create_outbox(self, client_socket):
+        """Создает очередь отправки для клиента"""
+        return ClientOutbox(client_socket, self.send_queue_size, self.slow_client_policy)
+
+    def register_client(self, client_socket, nickname, params=None):
+        """Регистрирует клиента после успешного рукопожатия.
+
+        Возвращает комнату, если клиент возобновил сессию по токену (пропущенные
+        сообщения уже в его очереди), и None для новой сессии.
+        """
+        outbox = self.create_outbox(client_socket)
+        cipher = get_cipher(self.encryption_key)
+        room = None
+        heartbeat = False
+        session = None
+        if params is not None:
+            # Согласуем шифр и сжатие сессии; ответ идет еще под ключом рукопожатия
+            backend = negotiate_cipher(params.get('ciphers', []), self.cipher_backends)
+            compression = negotiate_compression(params.get('compression', []), self.compression_methods)
+            room = self.read_resume_token(params.get('resume'), nickname)
+            heartbeat = self.heartbeat is not None and bool(params.get('heartbeat'))
+            # Ответ - тем ключом, которым клиент зашифровал рукопожатие (он может быть прежним)
+            key_id = params['key_id']
+            key = self.keyring.get(key_id) or self.encryption_key
+            if params.get('rekey'):
+                session = (backend, compression)
+            reply = json.dumps({'cipher': backend, 'compression': compression,
+                                'resume': self.issue_resume_token(nickname, room or DEFAULT_ROOM),
+                                'resumed': room is not None,
+                                'ping_interval': self.ping_interval if heartbeat else None,
+                                'key_id': key_id if session else None})
+            outbox.put(encode_frame(MSG_HELLO, get_cipher(key).encrypt(reply.encode())))
+            if session:
+                cipher = self.session_cipher(backend, compression, key_id)
+            else:
+                cipher = compressed_cipher(get_cipher(key, backend), compression)
+        with self.clients_lock:
+            self.clients[client_socket] = nickname
+            self.outboxes[client_socket] = outbox
+            self.client_ciphers[client_socket] = cipher
+            if params is not None and 'resume' in params:
+                self.entry_clients.add(client_socket)
+            if params is not None and params.get('presence'):
+                self.presence_clients.add(client_socket)
+            if session:
+                self.rekey_clients[client_socket] = session
+            if heartbeat:
+                # Старые клиенты не отвечают на PING, их проверяет только TCP keepalive
+                self.heartbeat.add(client_socket)
+            self.rooms.join(client_socket, outbox, room or DEFAULT_ROOM, enforce_limit=False)
+            if room is not None:
+                # Под тем же замком, под которым рассылка выбирает получателей: запись,
+                # не попавшая в страницу пропущенного, придет клиенту обычной рассылкой
+                self.send_missed_history(client_socket, room, params.get('last_id'))
+        if session and params['key_id'] != self.keyring.current:
+            self.rekey_client(client_socket)  # Подключился со старым ключом в льготный срок
+        return room
+
+    def issue_resume_token(self, nickname, room):
+        """Токен возобновления сессии: никнейм и комната под ключом сервера"""
+        state = json.dumps({'nickname': nickname, 'room': room})
+        return self.keyring.seal(state.encode())
+
+    def read_resume_token(self, token, nickname):
+        """Комната из токена возобновления; None, если токена нет или он чужой"""
+        if not isinstance(token, str):
+            return None
+        try:
+            state = json.loads(self.keyring.unseal(token))
+        except (InvalidToken, ValueError):
+            log.debug("Неверный токен возобновления от %s", nickname)
+            return None
+        if state.get('nickname') != nickname:
+            return None
+        return state.get('room')
+
+    def publish_entry(self, text, room=DEFAULT_ROOM):
+        """Записывает сообщение в историю комнаты и рассылает его вместе с записью"""
+        entry = self.add_to_history(text, room)
+        if entry is None:
+            return  # История кластера: запись с id придет с шины (handle_bus_event)
+        self.deliver_entry(entry)
+        if self.bus is not None:
+            self.bus.publish({'type': 'entry', 'entry': entry})
+
+    def deliver_entry(self, entry):
+        """Рассылает запись истории участникам комнаты, подключенным к этому процессу"""
+        text = entry['text']
+        if text.startswith("FILE:"):
+            self.deliver_message(text[5:], MSG_FILE, entry['room'], entry)
+        else:
+            self.deliver_message(text, MSG_TEXT, entry['room'], entry)
+
+    def broadcast_message(self, message, sender_socket=None, msg_type=MSG_TEXT, room=DEFAULT_ROOM):
+        """Отправляет сообщение всем участникам комнаты, в том числе в других процессах"""
+        self.deliver_message(message, msg_type, room)
+        if self.bus is not None:
+            self.bus.publish({'type': 'broadcast', 'message': message, 'msg_type': msg_type, 'room': room})
+
+    def deliver_message(self, message, msg_type=MSG_TEXT, room=DEFAULT_ROOM, entry=None):
+        """Отправляет сообщение участникам комнаты, подключенным к этому процессу.
+
+        Если сообщение записано в историю (entry), клиенты из entry_clients
+        получают кадр MSG_ENTRY с id записи, остальные - обычный кадр msg_type.
+        """
+        if entry is None:
+            self.deliver_frames(room, msg_type, message.encode())
+        else:
+            self.deliver_frames(room, msg_type, message.encode(),
+                                self.entry_clients, MSG_ENTRY, json.dumps(entry).encode())
+
+    def deliver_frames(self, room, msg_type, data, rich_clients=(), rich_type=None, rich_data=None):
+        """Рассылает участникам комнаты в этом процессе кадр msg_type с data,
+        а клиентам из rich_clients - кадр rich_type с rich_data"""
+        started = time.perf_counter()
         
-        # Создаем копию списка клиентов, чтобы избежать изменения во время итерации
-        clients = list(self.clients.items())
+        # Копия списка участников комнаты: клиенты могут отключаться во время рассылки
+        with self.clients_lock:
+            recipients = [(outbox, self.client_ciphers[client_socket], client_socket in rich_clients)
+                          for client_socket, outbox in self.rooms.members(room)]
         
-        for client_socket, nickname in clients:
-            try:
-                print(f"Отправка сообщения клиенту {nickname}")
-                client_socket.send(encrypted_message)
-                print(f"Сообщение успешно отправлено клиенту {nickname}")
-            except Exception as e:
-                print(f"Ошибка отправки клиенту {nickname}: {e}")
-                self.remove_client(client_socket)
+        # Шифруем один раз на каждый шифр и формат: очереди получают один и тот же объект bytes
+        frames = {}
+        sent_bytes = 0
+        for outbox, cipher, rich in recipients:
+            frame = frames.get((cipher, rich))
+            if frame is None:
+                if rich:
+                    frame = encode_frame(rich_type, cipher.encrypt(rich_data))
+                else:
+                    frame = encode_frame(msg_type, cipher.encrypt(data))
+                frames[cipher, rich] = frame
+            outbox.put(frame)
+            sent_bytes += len(frame)
+        self.broadcast_seconds.observe(time.perf_counter() - started)
+        self.broadcast_frames.inc(len(recipients))
+        self.sent_bytes.inc(sent_bytes)
+        log.debug("Рассылка в комнату %s: %s получателей, кадров: %s", room, len(recipients), len(frames))
+
+    def flush_presence(self):
+        """Раз в окно: сводки - участникам комнат здесь, переходы своих подключений - другим процессам"""
+        digests, changes = self.presence.flush()
+        for room, joined, left in digests:
+            self.deliver_presence(room, joined, left)
+        if self.bus is not None:
+            for room, joined, left in changes:
+                self.bus.publish({'type': 'presence', 'room': room, 'joined': joined, 'left': left})
+
+    def deliver_presence(self, room, joined, left):
+        """Один кадр на комнату: MSG_PRESENCE для presence_clients, текст - для остальных"""
+        digest = json.dumps({'room': room, 'joined': joined, 'left': left}).encode()
+        self.deliver_frames(room, MSG_TEXT, presence_text(room, joined, left).encode(),
+                            self.presence_clients, MSG_PRESENCE, digest)
+        self.presence_digests.inc()
+        self.presence_events.inc(len(joined) + len(left))
+
+    def send_presence(self, client_socket, request_id=None):
+        """Отвечает на запрос MSG_PRESENCE списком участников комнаты клиента"""
+        room = self.rooms.room_of(client_socket) or DEFAULT_ROOM
+        reply = {'room': room, 'members': self.presence.members_of(room)}
+        if request_id is not None:
+            reply['id'] = request_id
+        self.send_encrypted_message(client_socket, json.dumps(reply), MSG_PRESENCE)
+
+    def handle_bus_event(self, event):
+        """Применяет событие, пришедшее от других процессов кластера"""
+        if event['type'] == 'broadcast':
+            self.deliver_message(event['message'], event['msg_type'], event['room'])
+        elif event['type'] == 'presence':
+            # Сводку для своих клиентов соберет ближайший flush_presence
+            self.presence.apply(event['room'], event['joined'], event['left'])
+        elif event['type'] == 'entry':
+            self.deliver_entry(event['entry'])
+        elif event['type'] == 'history':
+            self.history.apply(event['entry'])
+            self.deliver_entry(event['entry'])
+        elif event['type'] == 'history_snapshot':
+            # История, накопленная до запуска этого процесса (см. cluster.MessageBus)
+            for entry in event['entries']:
+                self.history.apply(entry)
 
-    def send_encrypted_message(self, client_socket, message):
+    def send_encrypted_message(self, client_socket, message, msg_type=MSG_TEXT):
         """Отправляет зашифрованное сообщение конкретному клиенту"""
+        outbox = self.outboxes.get(client_socket)
+        if outbox is None:
+            return
+        if isinstance(message, str):
+            message = message.encode()
         try:
-            f = Fernet(self.encryption_key)
-            encrypted_message = f.encrypt(message.encode())
-            client_socket.send(encrypted_message)
+            cipher = self.client_ciphers[client_socket]
+            if msg_type in UNCOMPRESSED_TYPES:
+                frame = encode_frame(msg_type, encrypt_uncompressed(cipher, message))
+            else:
+                frame = encode_frame(msg_type, cipher.encrypt(message))
+            outbox.put(frame)
+            self.sent_bytes.inc(len(frame))
         except Exception as e:
-            print(f"Ошибка отправки сообщения: {e}")
+            log.error("Ошибка отправки сообщения: %s", e)
+
+    def send_ping(self, client_socket):
+        """Проверяет молчащего клиента; ответ MSG_PONG отметит heartbeat.touch"""
+        self.pings_sent.inc()
+        self.send_encrypted_message(client_socket, b'', MSG_PING)
+
+    def evict_client(self, client_socket):
+        """Разрывает соединение клиента, не ответившего на PING; удалит его поток чтения"""
+        log.info("Клиент %s не ответил на проверку связи, отключаем", self.clients.get(client_socket))
+        self.evicted_clients.inc()
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
     def remove_client(self, client_socket):
-        """Удаляет клиента и оповещает остальных"""
-        if client_socket in self.clients:
-            nickname = self.clients[client_socket]
-            del self.clients[client_socket]
-            client_socket.close()
-            self.broadcast_message(f"{nickname} покинул чат")
-            print(f"Клиент {nickname} отключен")
+        """Удаляет клиента; остальные узнают о выходе из сводки, отсюда ничего не рассылается"""
+        with self.clients_lock:
+            nickname = self.clients.pop(client_socket, None)
+            outbox = self.outboxes.pop(client_socket, None)
+            self.client_ciphers.pop(client_socket, None)
+            self.entry_clients.discard(client_socket)
+            self.presence_clients.discard(client_socket)
+            self.rekey_clients.pop(client_socket, None)
+            if self.heartbeat is not None:
+                self.heartbeat.remove(client_socket)
+            self.flood.remove(client_socket)
+            self.uploads.pop(client_socket, None)
+            room = self.rooms.leave(client_socket)
+        if nickname is None:
+            return
+        if outbox:
+            outbox.close()
+        client_socket.close()
+        # Только запись в сводку: удаление бывает вызвано ошибкой отправки, и рассылка
+        # отсюда порождала бы новые ошибки и новые удаления
+        self.presence.leave(room, nickname)
+        log.info("Клиент %s отключен", nickname)
 
     def stop(self):
         """Останавливает сервер"""
+        self.reaper_stopped.set()
         if self.server_socket:
             self.server_socket.close()
-        for client_socket in list(self.clients.keys()):
+        if self.metrics_server:
+            self.metrics_server.stop()
+        for client_socket, outbox in list(self.outboxes.items()):
+            outbox.close()
             client_socket.close()
-        print("Сервер остановлен")
+        self.history.close()
+        log.info("Сервер остановлен")
 
-    def add_to_history(self, message):
-        """Добавляет сообщение в историю"""
-        self.message_history.append(message)
-        if len(self.message_history) > self.max_history:
-            self.message_history.pop(0)  # Удаляем самое старое сообщение
+    def add_to_history(self, message, room=DEFAULT_ROOM):
+        """Добавляет сообщение в историю комнаты"""
+        started = time.perf_counter()
+        entry = self.history.append(message, room)
+        self.history_seconds.observe(time.perf_counter() - started)
+        return entry
 
-if __name__ == "__main__":
-    server = ChatServer()
+    def send_history(self, client_socket, before_id=None, limit=None, room=None, request_id=None):
+        """Отправляет клиенту страницу истории его комнаты старше before_id"""
+        if room is None:
+            room = self.rooms.room_of(client_socket) or DEFAULT_ROOM
+        if before_id is None and limit is None:
+            self.send_history_snapshot(client_socket, room)
+            return
+        # На запрос отвечаем всегда, даже пустой страницей: клиент сопоставляет ответы запросам
+        entries = self.history.page(room, before_id, limit or self.history_page_size)
+        self.send_history_page(client_socket, entries, request_id)
+
+    def send_newer_history(self, client_socket, after_id, limit, request_id=None):
+        """Отправляет страницу истории комнаты клиента новее after_id - для прокрутки вниз"""
+        room = self.rooms.room_of(client_socket) or DEFAULT_ROOM
+        entries = self.history.page_after(room, after_id, limit)
+        self.send_history_page(client_socket, entries, request_id)
+
+    def send_history_page(self, client_socket, entries, request_id=None):
+        """Ответ на запрос истории: MSG_HISTORY_PAGE с номером запроса или MSG_HISTORY для старых клиентов"""
+        if request_id is None:
+            self.send_encrypted_message(client_socket, json.dumps(entries), MSG_HISTORY)
+        else:
+            self.send_encrypted_message(client_socket, json.dumps({'id': request_id, 'entries': entries}),
+                                        MSG_HISTORY_PAGE)
+
+    def send_missed_history(self, client_socket, room, last_id):
+        """Отправляет записи комнаты новее last_id; если пропущено слишком много - последние"""
+        if not isinstance(last_id, int):
+            last_id = 0
+        entries = self.history.page_after(room, last_id, MAX_PAGE_SIZE + 1)
+        if len(entries) > MAX_PAGE_SIZE:
+            entries = self.history.page(room, None, MAX_PAGE_SIZE)
+        if entries:
+            self.send_encrypted_message(client_socket, json.dumps(entries), MSG_HISTORY)
+
+    def send_history_snapshot(self, client_socket, room):
+        """Отправляет последнюю страницу истории из кэша готовых зашифрованных кадров"""
+        outbox = self.outboxes.get(client_socket)
+        cipher = self.client_ciphers.get(client_socket)
+        if outbox is None or cipher is None:
+            return
+        frame = self.history_snapshot(room, cipher)
+        if frame is not None:
+            outbox.put(frame)
+            self.sent_bytes.inc(len(frame))
+
+    def history_snapshot(self, room, cipher):
+        """Кадр с последней страницей истории комнаты под шифром cipher.
+
+        Страница сериализуется и шифруется один раз и пересобирается только
+        после изменения истории комнаты, а не при каждом входе клиента.
+        """
+        key = (room, cipher)
+        with self.snapshots_lock:
+            revision = self.history.revision(room)
+            cached = self.history_snapshots.get(key)
+            if cached is not None and cached[0] == revision:
+                return cached[1]
+            entries = self.history.page(room, None, self.history_page_size)
+            frame = None
+            if entries:
+                frame = encode_frame(MSG_HISTORY, encrypt_uncompressed(cipher, json.dumps(entries).encode()))
+            self.history_snapshots[key] = (revision, frame)
+            self.history_snapshots.move_to_end(key)
+            while len(self.history_snapshots) > HISTORY_SNAPSHOTS:
+                self.history_snapshots.popitem(last=False)
+            return frame
+
+def main():
+    parser = argparse.ArgumentParser(description="Сервер SafeSpace")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--queue-size', type=int, default=256,
+                        help="Предел очереди отправки на клиента (кадров)")
+    parser.add_argument('--slow-policy', choices=SLOW_CLIENT_POLICIES, default=DROP_OLDEST,
+                        help="Что делать с клиентом, который не успевает принимать сообщения")
+    parser.add_argument('--ciphers', default=','.join(CIPHER_BACKENDS),
+                        help="Шифры сессии через запятую, в порядке предпочтения")
+    parser.add_argument('--compression', default=','.join(COMPRESSION_METHODS),
+                        help="Методы сжатия через запятую; none - без сжатия")
+    parser.add_argument('--history', choices=HISTORY_BACKENDS, default='memory',
+                        help="Хранилище истории: memory - кольцевой буфер, sqlite - файл на диске")
+    parser.add_argument('--history-size', type=int, default=1000,
+                        help="Размер истории в памяти (сообщений на комнату)")
+    parser.add_argument('--history-path', default='history.db')
+    parser.add_argument('--files-dir', default='files',
+                        help="Каталог для кусков переданных файлов")
+    parser.add_argument('--backlog', type=int, default=1024,
+                        help="Длина очереди входящих подключений (listen)")
+    parser.add_argument('--handshake-timeout', type=float, default=5.0,
+                        help="Сколько секунд дается клиенту на рукопожатие")
+    parser.add_argument('--max-handshakes', type=int, default=256,
+                        help="Сколько рукопожатий может идти одновременно")
+    parser.add_argument('--engine', choices=['thread', 'async'], default='thread',
+                        help="thread - поток на клиента, async - цикл событий asyncio")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Число процессов сервера на одном порту (SO_REUSEPORT, только Unix)")
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default='INFO',
+                        help="Уровень журнала; DEBUG включает выборочные записи о каждом сообщении")
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help="Порт страницы метрик Prometheus (/metrics); 0 - выключена")
+    parser.add_argument('--metrics-host', default='127.0.0.1')
+    parser.add_argument('--rate-limit', type=RateLimit.parse, default=RateLimit(),
+                        help="Предел на клиента: кадров:байт в секунду, 0 - без ограничения (по умолчанию 20:4194304)")
+    parser.add_argument('--room-rate-limit', action='append', default=[], metavar='КОМНАТА=КАДРОВ:БАЙТ',
+                        help="Отдельный предел для комнаты; можно указать несколько раз")
+    parser.add_argument('--flood-policy', choices=FLOOD_POLICIES, default=THROTTLE,
+                        help="Что делать с клиентом сверх предела: притормозить или отключить")
+    parser.add_argument('--ping-interval', type=float, default=PING_INTERVAL,
+                        help="Через сколько секунд молчания клиент получает PING; 0 - не проверять")
+    parser.add_argument('--ping-timeout', type=float, default=PING_TIMEOUT,
+                        help="Сколько секунд ждать ответа на PING до отключения клиента")
+    parser.add_argument('--keepalive-idle', type=int, default=KEEPALIVE_IDLE,
+                        help="TCP keepalive: секунд молчания до первой проверки; 0 - выключен")
+    parser.add_argument('--keepalive-interval', type=int, default=KEEPALIVE_INTERVAL,
+                        help="TCP keepalive: секунд между проверками")
+    parser.add_argument('--keepalive-count', type=int, default=KEEPALIVE_COUNT,
+                        help="TCP keepalive: проверок без ответа до разрыва")
+    parser.add_argument('--max-rooms', type=int, default=MAX_ROOMS,
+                        help="Сколько комнат может быть открыто одновременно и сколько хранят историю в памяти")
+    parser.add_argument('--presence-window', type=float, default=PRESENCE_WINDOW,
+                        help="За сколько секунд входы и выходы собираются в одну сводку на комнату")
+    parser.add_argument('--rotate-key', action='store_true',
+                        help="Записать в key.2pk новый ключ и выйти; запущенный сервер подхватит его по SIGHUP")
+    parser.add_argument('--key-grace', type=float, default=KEY_GRACE,
+                        help="Сколько секунд после --rotate-key принимается прежний ключ")
+    args = parser.parse_args()
+    setup_logging(args.log_level)
+    if args.rotate_key:
+        key_id, _ = rotate_key_file(KEY_FILE, args.key_grace)
+        log.info("Новый ключ %s записан в %s, прежний принимается еще %s с; "
+                 "отправьте серверу SIGHUP, чтобы разослать ключ клиентам", key_id, KEY_FILE, args.key_grace)
+        return
+    cipher_backends = tuple(name.strip() for name in args.ciphers.split(',') if name.strip())
+    room_rate_limits = {}
+    for item in args.room_rate_limit:
+        room, _, limit = item.partition('=')
+        room_rate_limits[validate_room_name(room)] = RateLimit.parse(limit)
+    compression_methods = tuple(name.strip() for name in args.compression.split(',')
+                                if name.strip() and name.strip() != 'none')
+
+    options = dict(
+        host=args.host,
+        port=args.port,
+        send_queue_size=args.queue_size,
+        slow_client_policy=args.slow_policy,
+        cipher_backends=cipher_backends,
+        compression_methods=compression_methods,
+        history_backend=args.history,
+        max_history=args.history_size,
+        history_path=args.history_path,
+        files_dir=args.files_dir,
+        backlog=args.backlog,
+        handshake_timeout=args.handshake_timeout,
+        max_handshakes=args.max_handshakes,
+        metrics_host=args.metrics_host,
+        metrics_port=args.metrics_port,
+        ping_interval=args.ping_interval,
+        ping_timeout=args.ping_timeout,
+        keepalive_idle=args.keepalive_idle,
+        keepalive_interval=args.keepalive_interval,
+        keepalive_count=args.keepalive_count,
+        rate_limit=args.rate_limit,
+        room_rate_limits=room_rate_limits,
+        flood_policy=args.flood_policy,
+        presence_window=args.presence_window,
+        max_rooms=args.max_rooms
+    )
+
+    if args.workers > 1:
+        from cluster import run_cluster
+        run_cluster(args.workers, args.engine, options, args.log_level)
+        return
+
+    if args.engine == 'async':
+        from async_server import AsyncChatServer
+        server = AsyncChatServer(**options)
+    else:
+        server = ChatServer(**options)
     try:
         server.start()
     except KeyboardInterrupt:
-        print("\nОстановка сервера...")
-        server.stop() 
\ No newline at end of file
+        log.info("Остановка сервера...")
+        server.stop()
+
+if __name__ == "__main__":
+    main()
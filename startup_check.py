@@ -0,0 +1,88 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Проверка времени запуска клиента: python -X importtime -c "import cgs".
+# Код возврата 1 - модуль импортируется дольше бюджета или тянет при запуске
+# то, что должно загружаться лениво.
+
+DEFAULT_MODULE = 'cgs'
+DEFAULT_BUDGET_MS = 400.0
+LAZY_MODULES = ('cryptography', 'playsound', 'pystray', 'PIL', 'PySide6.QtMultimedia', 'sqlite3')
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_importtime(stderr):
+    """Разбирает вывод -X importtime: {модуль: накопленное время в микросекундах}"""
+    cumulative = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue  # Строка заголовка
+        cumulative[fields[2].strip()] = int(fields[1])
+    return cumulative
+
+
+def measure(module):
+    """Один запуск интерпретатора; возвращает накопленные времена импорта"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=SOURCE_DIR, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()
+        raise RuntimeError(f"Не удалось импортировать {module}: {error[-1] if error else result.returncode}")
+    return parse_importtime(result.stderr)
+
+
+def run(module, runs, budget_ms, lazy_modules):
+    samples = [measure(module) for _ in range(runs)]
+    last = samples[-1]
+    import_ms = statistics.median(sample.get(module, 0) for sample in samples) / 1000
+    eager = [lazy for lazy in lazy_modules
+             if any(name == lazy or name.startswith(lazy + '.') for name in last)]
+    slowest = sorted(last.items(), key=lambda item: item[1], reverse=True)
+    return {
+        'module': module,
+        'runs': runs,
+        'import_ms': round(import_ms, 1),
+        'budget_ms': budget_ms,
+        'eager_lazy_modules': eager,  # Должны грузиться лениво, но импортированы при запуске
+        'slowest': [{'module': name, 'ms': round(us / 1000, 1)} for name, us in slowest[:10]],
+        'ok': import_ms <= budget_ms and not eager
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бюджет времени импорта клиента SafeSpace")
+    parser.add_argument('--module', default=DEFAULT_MODULE, help="Какой модуль импортировать")
+    parser.add_argument('--runs', type=int, default=5, help="Сколько запусков; берется медиана")
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS,
+                        help="Допустимое накопленное время импорта модуля, мс")
+    parser.add_argument('--lazy', default=','.join(LAZY_MODULES),
+                        help="Модули через запятую, которых не должно быть среди импортов при запуске")
+    args = parser.parse_args()
+
+    lazy_modules = tuple(name.strip() for name in args.lazy.split(',') if name.strip())
+    try:
+        report = run(args.module, args.runs, args.budget_ms, lazy_modules)
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if not report['ok']:
+        if report['import_ms'] > args.budget_ms:
+            print(f"Импорт {args.module}: {report['import_ms']} мс, бюджет {args.budget_ms} мс",
+                  file=sys.stderr)
+        if report['eager_lazy_modules']:
+            print(f"Импортированы при запуске: {', '.join(report['eager_lazy_modules'])}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()